@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# This script demonstrates conforming an edit decision list over TAMS Flows into a new Flow using segment metadata only
+
+from typing import Any, Optional
+from argparse import ArgumentParser
+from bisect import bisect_right
+from decimal import Decimal
+from fractions import Fraction
+from urllib.parse import urlparse
+from uuid import UUID, uuid4
+import asyncio
+import dataclasses
+import json
+import logging
+import math
+import os
+import time
+
+import aiohttp
+from mediatimestamp import TimeRange, Timestamp
+import mediajson
+
+from utils.credentials import Credentials, BasicCredentials, OAuth2ClientCredentials
+from utils.client import put_request, SegmentRegistrationBatcher
+from utils.segments import SegmentLister
+from utils.segment_index import SegmentIndex
+from utils.timeline import SegmentTable, counts_to_timerange, timerange_to_counts, timestamp_to_count
+from simple_edit import get_flow
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DEFAULT_LIST_CONCURRENCY = 8
+DEFAULT_BATCH_SIZE = 500
+
+# Flow properties copied from the first input Flow to the output Flow
+COPIED_FLOW_PROPERTIES = ["format", "codec", "container", "essence_parameters"]
+
+
+@dataclasses.dataclass
+class EditEvent:
+    """An event in an edit decision list: a timerange of a Flow, or a gap of `duration` if `flow_id` is None"""
+    flow_id: Optional[UUID]
+    source_timerange: Optional[TimeRange] = None
+    duration: Optional[Timestamp] = None
+
+
+def parse_cut_list(edl: dict) -> tuple[list[EditEvent], Optional[Fraction]]:
+    """Parse a JSON cut list, returning the events and the edit rate if given
+
+    The cut list is an object with an optional `edit_rate` (e.g. "50" or "30000/1001") and a list of `events`, each
+    either `{"flow_id": <Flow ID>, "timerange": <timerange>}` or `{"gap": <duration timestamp>}`. The events are
+    placed one after the other on the output timeline.
+    """
+    events = []
+    for event in edl["events"]:
+        if "gap" in event:
+            events.append(EditEvent(None, duration=Timestamp.from_str(str(event["gap"]))))
+        else:
+            events.append(EditEvent(UUID(event["flow_id"]), TimeRange.from_str(event["timerange"])))
+
+    edit_rate = Fraction(str(edl["edit_rate"])) if "edit_rate" in edl else None
+    return (events, edit_rate)
+
+
+def _otio_rate(rational_time: dict) -> Fraction:
+    """Returns the rate of an OpenTimelineIO RationalTime, which is a float, e.g. 29.97002997002997 for 30000/1001
+
+    The rate is snapped to the nearest fraction with a denominator of at most 1001, which covers the standard
+    rates, as the float isn't the exact rate.
+    """
+    return Fraction(rational_time["rate"]).limit_denominator(1001)
+
+
+def _otio_time(rational_time: dict) -> Fraction:
+    return Fraction(rational_time["value"]) / _otio_rate(rational_time)
+
+
+def _otio_timestamp(seconds: Fraction) -> Timestamp:
+    """Returns the time rounded down to the nanosecond, in the same way as the sample times of a Flow"""
+    return Timestamp.from_nanosec(math.floor(seconds * 1_000_000_000))
+
+
+def parse_otio(timeline: dict) -> tuple[list[EditEvent], Optional[Fraction]]:
+    """Parse an OpenTimelineIO timeline (JSON), returning the events of its first video track and the edit rate
+
+    Clips must reference TAMS Flows using an `ExternalReference` with a `tams://<host>/flows/<Flow ID>` target URL,
+    as described in AppNote 0015, where the `source_range` is on the Flow's timeline. Clips referencing Sources (a
+    `MissingReference`) must be linked to a Flow first. Gaps and disabled clips become gaps in the output.
+    """
+    if not timeline.get("OTIO_SCHEMA", "").startswith("Timeline."):
+        raise ValueError("The OpenTimelineIO file doesn't contain a Timeline")
+
+    tracks = timeline["tracks"]["children"]
+    video_tracks = [track for track in tracks if track.get("kind") == "Video"]
+    if not video_tracks and not tracks:
+        raise ValueError("The OpenTimelineIO Timeline doesn't have any tracks")
+    track = (video_tracks or tracks)[0]
+
+    events = []
+    edit_rate = None
+    for item in track["children"]:
+        schema = item["OTIO_SCHEMA"].split(".")[0]
+        if schema == "Gap" or (schema == "Clip" and not item.get("enabled", True)):
+            source_range = item["source_range"]
+            events.append(EditEvent(None, duration=_otio_timestamp(_otio_time(source_range["duration"]))))
+            continue
+        if schema != "Clip":
+            raise ValueError(f"OpenTimelineIO {item['OTIO_SCHEMA']} can't be conformed by reference")
+
+        references = item.get("media_references") or {"DEFAULT_MEDIA": item.get("media_reference")}
+        reference = references.get(item.get("active_media_reference_key", "DEFAULT_MEDIA"))
+        if reference is None or not reference["OTIO_SCHEMA"].startswith("ExternalReference."):
+            raise ValueError(f"Clip '{item.get('name')}' doesn't have an ExternalReference to a TAMS Flow")
+
+        target_url = urlparse(reference["target_url"])
+        path = target_url.path.rstrip("/").split("/")
+        if target_url.scheme != "tams" or len(path) < 2 or path[-2] != "flows":
+            raise ValueError(f"Clip '{item.get('name')}' target URL {reference['target_url']} isn't a TAMS Flow")
+
+        source_range = item["source_range"]
+        start = _otio_time(source_range["start_time"])
+        duration = _otio_time(source_range["duration"])
+        events.append(EditEvent(
+            UUID(path[-1]),
+            TimeRange.from_start_length(
+                _otio_timestamp(start), _otio_timestamp(duration), TimeRange.INCLUDE_START
+            )
+        ))
+
+        # The duration is counted in edit units, whereas the start is a Flow timestamp in nanoseconds
+        if edit_rate is None:
+            edit_rate = _otio_rate(source_range["duration"])
+
+    return (events, edit_rate)
+
+
+def load_edl(filename: str) -> tuple[list[EditEvent], Optional[Fraction]]:
+    """Load an OpenTimelineIO (.otio) file or a JSON cut list"""
+    with open(filename, "r") as f:
+        # Parse numbers exactly, as OpenTimelineIO nanosecond timestamps don't fit in a float
+        edl = json.load(f, parse_float=Decimal)
+
+    if isinstance(edl, dict) and "OTIO_SCHEMA" in edl:
+        return parse_otio(edl)
+    return parse_cut_list(edl)
+
+
+async def resolve_events(
+    session: aiohttp.ClientSession,
+    credentials: Credentials,
+    tams_url: str,
+    events: list[EditEvent],
+    edit_rate: Fraction,
+    segment_lister: SegmentLister,
+    list_concurrency: int
+) -> SegmentTable:
+    """Returns the segments of the output timeline, starting at sample 0, for the edit events
+
+    The timeranges referenced in each Flow are merged where they overlap or are adjacent, and the segments in
+    each merged timerange are listed once, with up to `list_concurrency` listings in progress at a time, into a
+    `SegmentIndex`. Each event then takes its samples from the segments found in the index of the merged
+    timerange that contains it.
+    """
+    event_counts = [
+        timerange_to_counts(event.source_timerange, edit_rate) if event.source_timerange is not None else None
+        for event in events
+    ]
+
+    # Merge the ranges referenced in each Flow
+    merged: dict[UUID, list[list[int]]] = {}
+    for event, counts in zip(events, event_counts):
+        if event.flow_id is not None and counts is not None:
+            merged.setdefault(event.flow_id, []).append(list(counts))
+    for flow_id, ranges in merged.items():
+        ranges.sort()
+        combined = [ranges[0]]
+        for start, end in ranges[1:]:
+            if start <= combined[-1][1]:
+                combined[-1][1] = max(combined[-1][1], end)
+            else:
+                combined.append([start, end])
+        merged[flow_id] = combined
+
+    list_slots = asyncio.Semaphore(list_concurrency)
+
+    async def list_range(flow_id: UUID, start: int, end: int) -> SegmentIndex:
+        async with list_slots:
+            return await SegmentIndex.from_listing(segment_lister.segments(
+                session, credentials, f"{tams_url}/flows/{flow_id}/segments", counts_to_timerange(start, end, edit_rate)
+            ))
+
+    listings = {
+        flow_id: [asyncio.create_task(list_range(flow_id, start, end)) for start, end in ranges]
+        for flow_id, ranges in merged.items()
+    }
+    try:
+        await asyncio.gather(*(task for tasks in listings.values() for task in tasks))
+    finally:
+        for tasks in listings.values():
+            for task in tasks:
+                task.cancel()
+    merged_starts = {flow_id: [start for start, _ in ranges] for flow_id, ranges in merged.items()}
+
+    # Place each event after the previous one on the output timeline
+    tables = []
+    position = 0
+    for index, (event, counts) in enumerate(zip(events, event_counts)):
+        if event.flow_id is None or counts is None:
+            assert event.duration is not None
+            position += timestamp_to_count(event.duration, edit_rate)
+            continue
+
+        start, end = counts
+        merged_index = bisect_right(merged_starts[event.flow_id], start) - 1
+        segment_index = listings[event.flow_id][merged_index].result()
+        table = SegmentTable.from_segments(
+            segment_index.overlapping(counts_to_timerange(start, end, edit_rate)), edit_rate
+        ).window(start, end)
+
+        covered = int((table.ends - table.starts).sum())
+        if covered < end - start:
+            logger.warning(
+                f"Event {index} has segments for {covered} of {end - start} samples of "
+                f"{event.source_timerange!s} in Flow {event.flow_id}"
+            )
+
+        tables.append(table.offset(position - start))
+        position += end - start
+
+    return SegmentTable.concat(tables) if tables else SegmentTable(edit_rate)
+
+
+async def conform(
+    tams_url: str,
+    credentials: Credentials,
+    events: list[EditEvent],
+    edit_rate: Optional[Fraction],
+    output_flow_id: UUID,
+    output_source_id: UUID,
+    label: Optional[str] = None,
+    segment_lister: Optional[SegmentLister] = None,
+    list_concurrency: int = DEFAULT_LIST_CONCURRENCY,
+    batch_size: int = DEFAULT_BATCH_SIZE
+) -> TimeRange:
+    """Create an output Flow that references the segments of the input Flows as given by the edit events
+
+    The output Flow copies the format, codec, container and essence parameters of the first input Flow, and its
+    timeline starts at 0. The edit rate defaults to the first input Flow's frame rate, or sample rate for audio.
+    The segments are registered in bulk, up to `batch_size` segments per request. Returns the output timerange.
+    """
+    flow_ids = list(dict.fromkeys(event.flow_id for event in events if event.flow_id is not None))
+    if not flow_ids:
+        raise ValueError("The edit decision list doesn't reference any Flows")
+    if segment_lister is None:
+        segment_lister = SegmentLister()
+
+    start_time = time.monotonic()
+    async with aiohttp.ClientSession(trust_env=True) as session:
+        flows = await asyncio.gather(*(get_flow(session, credentials, tams_url, flow_id) for flow_id in flow_ids))
+        first_flow = flows[0]
+        for flow in flows[1:]:
+            for prop in COPIED_FLOW_PROPERTIES[:3]:
+                if flow.get(prop) != first_flow.get(prop):
+                    logger.warning(
+                        f"Flow {flow['id']} {prop} '{flow.get(prop)}' differs from '{first_flow.get(prop)}'"
+                    )
+
+        if edit_rate is None:
+            essence_parameters = first_flow.get("essence_parameters", {})
+            if "frame_rate" in essence_parameters:
+                rate = essence_parameters["frame_rate"]
+                edit_rate = Fraction(rate["numerator"], rate.get("denominator", 1))
+            elif "sample_rate" in essence_parameters:
+                edit_rate = Fraction(essence_parameters["sample_rate"])
+            else:
+                raise ValueError("An edit rate is required as the first Flow doesn't have a frame or sample rate")
+
+        table = await resolve_events(
+            session, credentials, tams_url, events, edit_rate, segment_lister, list_concurrency
+        )
+        logger.info(
+            f"Resolved {len(events)} events to {len(table)} segments from {len(flow_ids)} Flows "
+            f"in {time.monotonic() - start_time:.3f}s"
+        )
+
+        flow_metadata: dict[str, Any] = {
+            prop: first_flow[prop] for prop in COPIED_FLOW_PROPERTIES if prop in first_flow
+        }
+        flow_metadata |= {
+            "id": str(output_flow_id),
+            "source_id": str(output_source_id),
+            "label": label or "Conform Edit Flow",
+            "tags": {"_conform_flow_ids": [str(flow_id) for flow_id in flow_ids]}
+        }
+        logger.info(f"Creating Flow {output_flow_id}")
+        async with put_request(session, credentials, f"{tams_url}/flows/{output_flow_id}", json=flow_metadata):
+            pass  # Context manager will raise on failure
+
+        async with SegmentRegistrationBatcher(
+            session, credentials, tams_url, output_flow_id, max_segments=batch_size
+        ) as segment_batcher:
+            for segment in table.to_segments():
+                await segment_batcher.add(mediajson.encode_value(segment))
+
+    output_timerange = (
+        counts_to_timerange(table.start, table.end, edit_rate)
+        if table.start is not None and table.end is not None else TimeRange.never()
+    )
+    logger.info(
+        f"Conformed {len(table)} segments to Flow {output_flow_id} at {output_timerange!s} "
+        f"in {time.monotonic() - start_time:.3f}s"
+    )
+    return output_timerange
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        prog="conform",
+        description="Conform an edit decision list over TAMS Flows into a new Flow"
+    )
+
+    parser.add_argument(
+        "--tams-url", type=str, required=True,
+        help=("URL of the top level endpoint in the TAMS service.")
+    )
+    parser.add_argument(
+        "--oauth2-url", type=str, default=os.environ.get("OAUTH2_URL"),
+        help="OAuth2 URL for getting credential token. Defaults to the 'OAUTH2_URL' environment variable"
+    )
+    parser.add_argument(
+        "--client-id", type=str, default=os.environ.get("CLIENT_ID"),
+        help="Keycloak client secret. Defaults to the 'CLIENT_ID' environment variable"
+    )
+    parser.add_argument(
+        "--client-secret", type=str, default=os.environ.get("CLIENT_SECRET"),
+        help="Keycloak client secret. Defaults to the 'CLIENT_SECRET' environment variable"
+    )
+    parser.add_argument(
+        "--username", type=str, default=os.environ.get("USERNAME"),
+        help="Basic auth username. Defaults to the 'USERNAME' environment variable"
+    )
+    parser.add_argument(
+        "--password", type=str, default=os.environ.get("PASSWORD"),
+        help="Basic auth password. Defaults to the 'PASSWORD' environment variable"
+    )
+    parser.add_argument(
+        "--edl", type=str, required=True,
+        help="OpenTimelineIO (.otio) file or JSON cut list describing the edit"
+    )
+    parser.add_argument(
+        "--edit-rate", type=Fraction, default=None,
+        help=("Edit rate, e.g. 50 or 30000/1001. Default is the rate given in the edit decision list, or the rate "
+              "of the first Flow")
+    )
+    parser.add_argument(
+        "--output-flow-id", type=UUID,
+        help="Output Flow ID. Default is to generate an ID"
+    )
+    parser.add_argument(
+        "--output-source-id", type=UUID,
+        help="Output Source ID. Default is to generate an ID"
+    )
+    parser.add_argument(
+        "--label", type=str, default=None,
+        help="Label of the output Flow"
+    )
+    parser.add_argument(
+        "--list-concurrency", type=int, default=DEFAULT_LIST_CONCURRENCY,
+        help="Maximum number of timeranges whose segments are listed concurrently"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+        help="Maximum number of segments registered on the output Flow per request"
+    )
+
+    args = parser.parse_args()
+
+    credentials: Credentials
+    if args.oauth2_url and args.client_id and args.client_secret:
+        credentials = OAuth2ClientCredentials(args.oauth2_url, args.client_id, args.client_secret)
+    elif args.username and args.password:
+        credentials = BasicCredentials(args.username, args.password)
+    else:
+        logger.error(
+            "Require either OAuth2 credentials (--oauth2-url, --client-id, --client-secret) "
+            "or basic credentials (--username, --password)"
+        )
+
+    events, edl_edit_rate = load_edl(args.edl)
+    output_flow_id = args.output_flow_id or uuid4()
+    asyncio.run(conform(
+        args.tams_url.rstrip("/"),
+        credentials,
+        events,
+        args.edit_rate or edl_edit_rate,
+        output_flow_id,
+        args.output_source_id or uuid4(),
+        label=args.label,
+        list_concurrency=args.list_concurrency,
+        batch_size=args.batch_size
+    ))
+
+    print(f"Finished writing output {output_flow_id}")
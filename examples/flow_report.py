@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# This script demonstrates checking the timelines of TAMS Flows for gaps, overlaps and ts_offset discontinuities
+
+from typing import Any, AsyncGenerator, Optional, TextIO
+from argparse import ArgumentParser
+from contextlib import nullcontext
+from uuid import UUID
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import sys
+import time
+
+import aiohttp
+from mediatimestamp import TimeRange, Timestamp
+
+from utils.credentials import Credentials, BasicCredentials, OAuth2ClientCredentials
+from utils.client import get_request
+from utils.segments import SegmentLister, DEFAULT_PAGE_LIMIT
+from utils.segment_index import end_position, positions_to_timerange, start_position
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DEFAULT_MAX_ISSUES = 100
+DEFAULT_FLOW_CONCURRENCY = 4
+
+
+@dataclasses.dataclass
+class TimelineReport:
+    """Summarises the timeline of a Flow from its segments, which are added in timeline order
+
+    Each segment is looked at once and only the end of the timeline so far is kept, so a report takes O(n) time
+    and constant memory. At most `max_issues` of each type of issue are listed, though all are counted.
+
+    Positions are as for `SegmentIndex`, i.e. twice the time in nanoseconds, adjusted for inclusivity.
+    """
+    max_issues: int = DEFAULT_MAX_ISSUES
+    segment_count: int = 0
+    covered: int = 0
+    gap_count: int = 0
+    gap_total: int = 0
+    gaps: list[str] = dataclasses.field(default_factory=list)
+    overlap_count: int = 0
+    overlap_total: int = 0
+    overlaps: list[str] = dataclasses.field(default_factory=list)
+    discontinuity_count: int = 0
+    discontinuities: list[dict[str, str]] = dataclasses.field(default_factory=list)
+
+    # The first segment, which is needed to merge with the report of the preceding shard
+    first_start: Optional[int] = None
+    first_end: Optional[int] = None
+    first_ts_offset: Optional[int] = None
+
+    # The end of the timeline covered so far, and the end and `ts_offset` of the last segment
+    covered_to: Optional[int] = None
+    last_end: Optional[int] = None
+    last_ts_offset: Optional[int] = None
+
+    def _add_gap(self, start: int, end: int) -> None:
+        self.gap_count += 1
+        self.gap_total += end - start
+        if len(self.gaps) < self.max_issues:
+            self.gaps.append(str(positions_to_timerange(start, end)))
+
+    def _add_overlap(self, start: int, end: int) -> None:
+        self.overlap_count += 1
+        self.overlap_total += end - start
+        if len(self.overlaps) < self.max_issues:
+            self.overlaps.append(str(positions_to_timerange(start, end)))
+
+    def _add_discontinuity(self, position: int, from_ts_offset: int, to_ts_offset: int) -> None:
+        self.discontinuity_count += 1
+        if len(self.discontinuities) < self.max_issues:
+            self.discontinuities.append({
+                "at": str(Timestamp.from_nanosec(position // 2)),
+                "from_ts_offset": str(Timestamp.from_nanosec(from_ts_offset)),
+                "to_ts_offset": str(Timestamp.from_nanosec(to_ts_offset))
+            })
+
+    def _check_following(self, start: int, end: int, ts_offset: int) -> None:
+        """Check a segment that follows the timeline so far"""
+        assert self.covered_to is not None and self.last_end is not None and self.last_ts_offset is not None
+        if start > self.covered_to:
+            self._add_gap(self.covered_to, start)
+        elif start < self.covered_to:
+            self._add_overlap(start, min(end, self.covered_to))
+
+        # The media timeline should continue across contiguous segments unless the ts_offset is changed
+        if start == self.last_end and ts_offset != self.last_ts_offset:
+            self._add_discontinuity(start, self.last_ts_offset, ts_offset)
+
+    def add(self, segment: dict) -> None:
+        timerange = TimeRange.from_str(segment["timerange"])
+        start = start_position(timerange)
+        end = end_position(timerange)
+        ts_offset = Timestamp.from_str(segment.get("ts_offset", "0:0")).to_nanosec()
+
+        if self.covered_to is None:
+            self.first_start = start
+            self.first_end = end
+            self.first_ts_offset = ts_offset
+            self.covered_to = start
+        else:
+            self._check_following(start, end, ts_offset)
+
+        self.segment_count += 1
+        self.covered += max(end - max(start, self.covered_to), 0)
+        self.covered_to = max(self.covered_to, end)
+        self.last_end = end
+        self.last_ts_offset = ts_offset
+
+    def extend(self, following: "TimelineReport") -> None:
+        """Add the report of the part of the timeline that follows this one, e.g. of the next shard
+
+        Only the first segment of the following report is compared with the end of this report, so an overlap
+        between a segment of this report and later segments of the following report isn't detected.
+        """
+        if following.first_start is None or following.first_end is None or following.first_ts_offset is None:
+            return
+        if self.covered_to is None:
+            for field in dataclasses.fields(self):
+                setattr(self, field.name, getattr(following, field.name))
+            return
+
+        self._check_following(following.first_start, following.first_end, following.first_ts_offset)
+
+        # The following report counted the whole of its first segment as covered
+        already_covered = max(min(following.first_end, self.covered_to) - following.first_start, 0)
+        self.segment_count += following.segment_count
+        self.covered += following.covered - already_covered
+        self.gap_count += following.gap_count
+        self.gap_total += following.gap_total
+        self.gaps = (self.gaps + following.gaps)[:self.max_issues]
+        self.overlap_count += following.overlap_count
+        self.overlap_total += following.overlap_total
+        self.overlaps = (self.overlaps + following.overlaps)[:self.max_issues]
+        self.discontinuity_count += following.discontinuity_count
+        self.discontinuities = (self.discontinuities + following.discontinuities)[:self.max_issues]
+        self.covered_to = max(self.covered_to, following.covered_to or self.covered_to)
+        self.last_end = following.last_end
+        self.last_ts_offset = following.last_ts_offset
+
+    def to_json(self) -> dict[str, Any]:
+        if self.first_start is None or self.covered_to is None:
+            return {"segment_count": 0}
+
+        segments_timerange = positions_to_timerange(self.first_start, self.covered_to)
+        length = segments_timerange.length.to_nanosec()
+        return {
+            "segment_count": self.segment_count,
+            "segments_timerange": str(segments_timerange),
+            "covered_duration": str(Timestamp.from_nanosec(self.covered // 2)),
+            "coverage": (self.covered // 2) / length if length > 0 else 1.0,
+            "gap_count": self.gap_count,
+            "gap_duration": str(Timestamp.from_nanosec(self.gap_total // 2)),
+            "gaps": self.gaps,
+            "overlap_count": self.overlap_count,
+            "overlap_duration": str(Timestamp.from_nanosec(self.overlap_total // 2)),
+            "overlaps": self.overlaps,
+            "ts_offset_discontinuity_count": self.discontinuity_count,
+            "ts_offset_discontinuities": self.discontinuities
+        }
+
+
+async def list_flow_ids(
+    session: aiohttp.ClientSession,
+    credentials: Credentials,
+    tams_url: str
+) -> AsyncGenerator[UUID, None]:
+    """Generator of the IDs of all the Flows in the store, following the pages of the Flows listing"""
+    flows_url = f"{tams_url}/flows"
+    while True:
+        async with get_request(session, credentials, flows_url) as resp:
+            for flow in await resp.json():
+                yield UUID(flow["id"])
+
+            try:
+                flows_url = str(resp.links["next"]["url"])
+            except KeyError:
+                break
+
+
+async def report_flow(
+    session: aiohttp.ClientSession,
+    credentials: Credentials,
+    tams_url: str,
+    flow_id: UUID,
+    timerange: TimeRange,
+    shard_count: int = 1,
+    page_limit: int = DEFAULT_PAGE_LIMIT,
+    max_issues: int = DEFAULT_MAX_ISSUES
+) -> dict[str, Any]:
+    """Returns a report of the timeline of the Flow within the timerange, see `TimelineReport`
+
+    The segments are listed once. If `shard_count` is more than 1 then the timerange (limited to the Flow's
+    timerange) is split into that number of shards that are listed and reported on concurrently, and the reports
+    are then combined.
+    """
+    start_time = time.monotonic()
+    segments_url = f"{tams_url}/flows/{flow_id}/segments"
+
+    if shard_count > 1 and (timerange.start is None or timerange.end is None):
+        async with get_request(session, credentials, f"{tams_url}/flows/{flow_id}") as resp:
+            flow = await resp.json()
+        if "timerange" in flow:
+            timerange = timerange.intersect_with(TimeRange.from_str(flow["timerange"]))
+
+    shards = SegmentLister(parallelism=shard_count).split_timerange(timerange)
+
+    async def report_shard(index: int) -> TimelineReport:
+        # Segments spanning shards are reported in the first shard they overlap
+        previous_shard = shards[index - 1] if index > 0 else None
+        report = TimelineReport(max_issues)
+        async for segment in SegmentLister(page_limit).segments(session, credentials, segments_url, shards[index]):
+            if previous_shard is None or not TimeRange.from_str(segment["timerange"]).overlaps_with_timerange(
+                previous_shard
+            ):
+                report.add(segment)
+        return report
+
+    shard_reports = await asyncio.gather(*(report_shard(index) for index in range(len(shards))))
+    report = shard_reports[0]
+    for shard_report in shard_reports[1:]:
+        report.extend(shard_report)
+
+    return {"flow_id": str(flow_id), "timerange": str(timerange)} | report.to_json() | {
+        "report_duration": round(time.monotonic() - start_time, 3)
+    }
+
+
+async def flow_report(
+    tams_url: str,
+    credentials: Credentials,
+    flow_ids: Optional[list[UUID]],
+    timerange: TimeRange,
+    output: TextIO,
+    shard_count: int = 1,
+    flow_concurrency: int = DEFAULT_FLOW_CONCURRENCY,
+    page_limit: int = DEFAULT_PAGE_LIMIT,
+    max_issues: int = DEFAULT_MAX_ISSUES
+) -> int:
+    """Write a JSON report line for each of the Flows, or all the Flows in the store, to `output`
+
+    Up to `flow_concurrency` Flows are reported on concurrently. Returns the number of Flows with gaps or overlaps,
+    or whose report failed. Changes of `ts_offset` are reported but not counted as issues, as objects that each start
+    at media time 0 legitimately have a different `ts_offset` for every segment.
+    """
+    flows_with_issues = 0
+    flow_slots = asyncio.Semaphore(flow_concurrency)
+
+    async with aiohttp.ClientSession(trust_env=True) as session:
+        async def report(flow_id: UUID) -> None:
+            nonlocal flows_with_issues
+            try:
+                flow_report = await report_flow(
+                    session, credentials, tams_url, flow_id, timerange, shard_count, page_limit, max_issues
+                )
+            except Exception as e:
+                logger.error(f"Failed to report on Flow {flow_id}: {e!r}")
+                flow_report = {"flow_id": str(flow_id), "error": repr(e)}
+            finally:
+                flow_slots.release()
+
+            if flow_report.get("error") or flow_report.get("gap_count") or flow_report.get("overlap_count"):
+                flows_with_issues += 1
+            output.write(json.dumps(flow_report) + "\n")
+
+        async def all_flow_ids() -> AsyncGenerator[UUID, None]:
+            if flow_ids is not None:
+                for flow_id in flow_ids:
+                    yield flow_id
+            else:
+                async for flow_id in list_flow_ids(session, credentials, tams_url):
+                    yield flow_id
+
+        tasks = []
+        async for flow_id in all_flow_ids():
+            await flow_slots.acquire()
+            tasks.append(asyncio.create_task(report(flow_id)))
+        await asyncio.gather(*tasks)
+
+    logger.info(f"Reported on {len(tasks)} Flows, of which {flows_with_issues} have issues")
+    return flows_with_issues
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        prog="flow_report",
+        description="Report the gaps, overlaps and ts_offset discontinuities in the timelines of TAMS Flows"
+    )
+
+    parser.add_argument(
+        "--tams-url", type=str, required=True,
+        help=("URL of the top level endpoint in the TAMS service.")
+    )
+    parser.add_argument(
+        "--oauth2-url", type=str, default=os.environ.get("OAUTH2_URL"),
+        help="OAuth2 URL for getting credential token. Defaults to the 'OAUTH2_URL' environment variable"
+    )
+    parser.add_argument(
+        "--client-id", type=str, default=os.environ.get("CLIENT_ID"),
+        help="Keycloak client secret. Defaults to the 'CLIENT_ID' environment variable"
+    )
+    parser.add_argument(
+        "--client-secret", type=str, default=os.environ.get("CLIENT_SECRET"),
+        help="Keycloak client secret. Defaults to the 'CLIENT_SECRET' environment variable"
+    )
+    parser.add_argument(
+        "--username", type=str, default=os.environ.get("USERNAME"),
+        help="Basic auth username. Defaults to the 'USERNAME' environment variable"
+    )
+    parser.add_argument(
+        "--password", type=str, default=os.environ.get("PASSWORD"),
+        help="Basic auth password. Defaults to the 'PASSWORD' environment variable"
+    )
+    parser.add_argument(
+        "--flow-id", type=UUID, action="append", default=None,
+        help="Report on this Flow. Can be given more than once. Default is to report on all the Flows in the store"
+    )
+    parser.add_argument(
+        "--timerange", type=TimeRange.from_str, default=TimeRange.eternity(),
+        help="Timerange of each Flow to report on"
+    )
+    parser.add_argument(
+        "--output", type=str, default=None,
+        help="JSON lines file to write a report for each Flow to. Default is stdout"
+    )
+    parser.add_argument(
+        "--shards", type=int, default=1,
+        help="Split the timerange of each Flow into this number of shards which are listed concurrently"
+    )
+    parser.add_argument(
+        "--flow-concurrency", type=int, default=DEFAULT_FLOW_CONCURRENCY,
+        help="Maximum number of Flows to report on concurrently"
+    )
+    parser.add_argument(
+        "--segment-page-limit", type=int, default=DEFAULT_PAGE_LIMIT,
+        help="Initial number of segments requested per page, which is then adapted to the response time"
+    )
+    parser.add_argument(
+        "--max-issues", type=int, default=DEFAULT_MAX_ISSUES,
+        help="Maximum number of each type of issue listed in the report of a Flow. All issues are counted"
+    )
+
+    args = parser.parse_args()
+
+    credentials: Credentials
+    if args.oauth2_url and args.client_id and args.client_secret:
+        credentials = OAuth2ClientCredentials(args.oauth2_url, args.client_id, args.client_secret)
+    elif args.username and args.password:
+        credentials = BasicCredentials(args.username, args.password)
+    else:
+        logger.error(
+            "Require either OAuth2 credentials (--oauth2-url, --client-id, --client-secret) "
+            "or basic credentials (--username, --password)"
+        )
+
+    with open(args.output, "w") if args.output else nullcontext(sys.stdout) as output:
+        flows_with_issues = asyncio.run(flow_report(
+            args.tams_url.rstrip("/"),
+            credentials,
+            args.flow_id,
+            args.timerange,
+            output,
+            shard_count=args.shards,
+            flow_concurrency=args.flow_concurrency,
+            page_limit=args.segment_page_limit,
+            max_issues=args.max_issues
+        ))
+
+    sys.exit(1 if flows_with_issues else 0)
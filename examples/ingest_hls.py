@@ -2,9 +2,19 @@
 # This script demonstrates ingest of media from an HLS playlist into TAMS
 
 import json
-from typing import Generator, Any, AsyncGenerator, Optional
+from typing import Generator, Any, AsyncGenerator, Optional, AsyncIterable, Awaitable, Callable, Iterable, TypeVar
 import asyncio
+import dataclasses
+import functools
+from collections import deque
+from itertools import islice
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import AsyncExitStack, nullcontext
+import math
+import mmap
 import os
+import tempfile
+import time
 import logging
 from argparse import ArgumentParser
 from uuid import UUID, uuid4
@@ -16,12 +26,36 @@ import mediajson
 import av
 
 from utils.credentials import Credentials, BasicCredentials, OAuth2ClientCredentials
-from utils.client import post_request, put_request
+from utils.client import post_request, put_request, SegmentRegistrationBatcher
+from utils.mpegts import extract_mpegts_timerange, build_gop_index, GopIndexStore
+from utils.journal import IngestJournal
+from utils.metrics import metrics
 
 logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+DEFAULT_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+
+ProbeResult = TypeVar("ProbeResult")
+
+# Flow codecs for the PyAV (FFmpeg) codec names of streams in multi-essence files
+STREAM_CODECS = {
+    "h264": "video/h264",
+    "hevc": "video/h265",
+    "aac": "audio/aac",
+    "mp2": "audio/mpeg",
+    "mp3": "audio/mpeg",
+    "ac3": "audio/ac3",
+}
+
+DEFAULT_MULTI_FLOW_METADATA = {
+    "label": "Demo Multi-Flow",
+    "description": "Flow created to demonstrate ingest of multi-essence content",
+    "format": "urn:x-nmos:format:multi",
+    "container": "video/mp2t"
+}
+
 DEFAULT_FLOW_METADATA = {
     "label": "Demo Flow",
     "description": "Flow created to demonstrate manual upload",
@@ -70,29 +104,141 @@ async def put_flow(
         pass  # Context manager will raise on failure
 
 
-async def get_media_storage_urls(
-    session: aiohttp.ClientSession,
-    credentials: Credentials,
-    tams_url: str,
-    flow_id: UUID,
-    segment_count: int
-) -> AsyncGenerator[dict, None]:
-    """Get media storage URLs for uploading media segments"""
-    while True:
+@dataclasses.dataclass
+class SegmentFile:
+    """A segment media file to ingest, along with its metadata from the HLS playlist if available
+
+    The `key` identifies the segment file in an ingest journal. If a journal shows that the preceding
+    segment has already been ingested then that segment is set in `previous_segment`.
+    """
+    filename: str
+    key: str
+    media_sequence: Optional[int] = None
+    discontinuity: bool = False
+    duration: Optional[float] = None
+    available_at: Optional[float] = None
+    previous_segment: Optional[dict[str, Any]] = None
+
+
+class MediaStorageAllocator:
+    """Allocates media storage for uploading media objects
+
+    The next batch of media storage is requested in the background once the number of unused media objects
+    drops to the low-water mark, so that ingest doesn't have to wait for the storage request. The low-water
+    mark is raised if needed to cover the time taken by previous storage requests.
+
+    The batch size adapts to the rate at which media objects are used, aiming to request enough for
+    `refill_interval` seconds of ingest. It is limited such that media objects are likely to be used within
+    `max_object_age` seconds, which defaults to the minimum pre-signed URL timeout allowed by the TAMS API.
+    """
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        credentials: Credentials,
+        tams_url: str,
+        flow_id: UUID,
+        initial_batch_size: int = 10,
+        min_batch_size: int = 1,
+        max_batch_size: int = 100,
+        low_water_mark: int = 2,
+        refill_interval: float = 10.0,
+        max_object_age: float = 30.0,
+        on_allocated: Optional[Callable[[list[dict[str, Any]]], None]] = None
+    ) -> None:
+        self.session = session
+        self.credentials = credentials
+        self.storage_url = f"{tams_url}/flows/{flow_id}/storage"
+        self.initial_batch_size = initial_batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.low_water_mark = low_water_mark
+        self.refill_interval = refill_interval
+        self.max_object_age = max_object_age
+        self.on_allocated = on_allocated
+
+        self._object_urls: deque[dict[str, Any]] = deque()
+        self._refill: Optional[asyncio.Task] = None
+        self._refill_duration: Optional[float] = None
+        self._use_times: deque[float] = deque(maxlen=20)
+
+    async def get(self) -> dict[str, Any]:
+        """Returns the next media object, with an `object_id` and `put_url`"""
+        self._use_times.append(time.monotonic())
+        metrics.gauge("unused_media_objects", len(self._object_urls))
+
+        start_time = time.monotonic()
+        while True:
+            if self._refill is not None and self._refill.done():
+                refill = self._refill
+                self._refill = None
+                refill.result()  # Raises if the storage request failed
+
+            if self._refill is None and len(self._object_urls) <= self._low_water_mark():
+                self._refill = asyncio.create_task(self._allocate(self._next_batch_size()))
+
+            if self._object_urls:
+                metrics.timing("allocate_wait", time.monotonic() - start_time)
+                return self._object_urls.popleft()
+
+            await asyncio.wait([self._refill])
+
+    async def close(self) -> None:
+        """Stop allocating media storage and release the unused media objects"""
+        if self._refill is not None:
+            self._refill.cancel()
+            await asyncio.gather(self._refill, return_exceptions=True)
+            self._refill = None
+
+        # The TAMS garbage collects media objects that are not registered against a Flow Segment
+        if self._object_urls:
+            logger.info(f"Releasing {len(self._object_urls)} unused media objects")
+        self._object_urls.clear()
+
+    def reuse(self, object_urls: Iterable[dict[str, Any]]) -> None:
+        """Add media objects that were allocated previously, which will be used before any new media objects"""
+        self._object_urls.extendleft(reversed(list(object_urls)))
+
+    def _use_rate(self) -> Optional[float]:
+        """Returns the rate at which media objects are being used (per second)"""
+        if len(self._use_times) < 2 or self._use_times[-1] <= self._use_times[0]:
+            return None
+
+        return (len(self._use_times) - 1) / (self._use_times[-1] - self._use_times[0])
+
+    def _low_water_mark(self) -> int:
+        rate = self._use_rate()
+        if rate is None or self._refill_duration is None:
+            return self.low_water_mark
+
+        return max(self.low_water_mark, math.ceil(2 * rate * self._refill_duration))
+
+    def _next_batch_size(self) -> int:
+        rate = self._use_rate()
+        if rate is None:
+            return self.initial_batch_size
+
+        batch_size = math.ceil(rate * min(self.refill_interval, self.max_object_age))
+        return max(self.min_batch_size, min(self.max_batch_size, batch_size))
+
+    async def _allocate(self, limit: int) -> None:
+        start_time = time.monotonic()
         async with post_request(
-            session,
-            credentials,
-            f"{tams_url}/flows/{flow_id}/storage",
+            self.session,
+            self.credentials,
+            self.storage_url,
             json={
-                "limit": segment_count
+                "limit": limit
             }
         ) as resp:
             # Context manager will raise on failure
             media_storage = await resp.json()
-            media_object_urls = media_storage["media_objects"]
+            self._object_urls.extend(media_storage["media_objects"])
+            if self.on_allocated is not None:
+                self.on_allocated(media_storage["media_objects"])
 
-            for object_url in media_object_urls:
-                yield object_url
+        self._refill_duration = time.monotonic() - start_time
+        metrics.timing("allocate", self._refill_duration, media_objects=len(media_storage["media_objects"]))
+        logger.debug(f"Allocated {len(media_storage['media_objects'])} media objects in {self._refill_duration:.3f}s")
 
 
 def get_hls_segment_filenames(hls_filename: str) -> Generator[str, None, None]:
@@ -110,11 +256,142 @@ def get_segment_list_filenames(list_filename: str) -> Generator[str, None, None]
             yield line.rstrip()
 
 
+async def get_segment_files(
+    manifest_filename: str,
+    hls_mode: bool,
+    start_segment: int,
+    segment_count: int
+) -> AsyncGenerator[SegmentFile, None]:
+    """Return the segment files from the HLS playlist or list of filenames"""
+    if hls_mode:
+        segment_filenames = get_hls_segment_filenames(manifest_filename)
+    else:
+        segment_filenames = get_segment_list_filenames(manifest_filename)
+
+    for index, segment_filename in enumerate(
+        islice(segment_filenames, start_segment, start_segment + segment_count),
+        start=start_segment
+    ):
+        yield SegmentFile(
+            os.path.join(os.path.dirname(manifest_filename), segment_filename),
+            key=f"{index}:{segment_filename}"
+        )
+
+
+async def follow_hls_playlist(
+    hls_filename: str,
+    last_media_sequence: Optional[int] = None
+) -> AsyncGenerator[SegmentFile, None]:
+    """Return the segment files from a live HLS playlist as they are added
+
+    The playlist is reloaded every half target duration and only segments with a media sequence number
+    after `last_media_sequence` are returned. This continues until the playlist has ended.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        playlist = await loop.run_in_executor(None, m3u8.load, hls_filename)
+        first_media_sequence = playlist.media_sequence or 0
+
+        if last_media_sequence is not None and first_media_sequence > last_media_sequence + 1:
+            logger.warning(
+                f"Segments with media sequence numbers {last_media_sequence + 1} to {first_media_sequence - 1} "
+                "were removed from the playlist before they could be ingested"
+            )
+
+        for index, segment in enumerate(playlist.segments):
+            media_sequence = first_media_sequence + index
+            if last_media_sequence is not None and media_sequence <= last_media_sequence:
+                continue
+
+            yield SegmentFile(
+                os.path.join(os.path.dirname(hls_filename), segment.uri),
+                key=f"{media_sequence}:{segment.uri}",
+                media_sequence=media_sequence,
+                discontinuity=segment.discontinuity,
+                duration=segment.duration,
+                available_at=time.monotonic()
+            )
+            last_media_sequence = media_sequence
+
+        if playlist.is_endlist:
+            break
+
+        await asyncio.sleep((playlist.target_duration or 1) / 2)
+
+
+async def skip_journal_segments(
+    segment_files: AsyncIterable[SegmentFile],
+    journal: IngestJournal
+) -> AsyncGenerator[SegmentFile, None]:
+    """Return the segment files that haven't already been uploaded according to the `journal`
+
+    Each returned segment file that follows skipped segments has the last skipped segment set in
+    `previous_segment`, so that the ingest can carry on from where that segment ended.
+    """
+    skipped_count = 0
+    previous_segment: Optional[dict[str, Any]] = None
+    async for segment_file in segment_files:
+        if segment_file.key in journal.segments:
+            skipped_count += 1
+            previous_segment = journal.segments[segment_file.key].segment
+            continue
+
+        if skipped_count > 0:
+            logger.info(f"Skipped {skipped_count} segments that were ingested before the ingest was resumed")
+            skipped_count = 0
+        segment_file.previous_segment = previous_segment
+        previous_segment = None
+        yield segment_file
+
+    if skipped_count > 0:
+        logger.info(f"Skipped {skipped_count} segments that were ingested before the ingest was resumed")
+
+
+class LiveIngestState:
+    """The state of a live ingest, persisted to a file so that the ingest can resume after a restart"""
+    def __init__(self, filename: Optional[str]) -> None:
+        self.filename = filename
+        self.media_sequence: Optional[int] = None
+        self.end_timestamp_in_flow: Optional[Timestamp] = None
+        self.ts_offset = Timestamp()
+
+        if self.filename is not None and os.path.exists(self.filename):
+            with open(self.filename, "r") as fp:
+                state = json.load(fp)
+            self.media_sequence = state["media_sequence"]
+            self.end_timestamp_in_flow = Timestamp.from_str(state["end_timestamp_in_flow"])
+            self.ts_offset = Timestamp.from_str(state["ts_offset"])
+
+            logger.info(f"Resuming live ingest after media sequence number {self.media_sequence}")
+
+    def update(self, media_sequence: int, segment: dict) -> None:
+        """Update the state with the last (JSON encoded) segment that was registered"""
+        self.media_sequence = media_sequence
+        self.end_timestamp_in_flow = TimeRange.from_str(segment["timerange"]).end
+        self.ts_offset = Timestamp.from_str(segment["ts_offset"])
+
+    def save(self) -> None:
+        if self.filename is None or self.media_sequence is None:
+            return
+
+        # Write to a temporary file and rename to avoid leaving a partially written file
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, "w") as fp:
+            json.dump({
+                "media_sequence": self.media_sequence,
+                "end_timestamp_in_flow": str(self.end_timestamp_in_flow),
+                "ts_offset": str(self.ts_offset)
+            }, fp)
+        os.replace(tmp_filename, self.filename)
+
+
 def extract_segment_timerange(filename: str) -> TimeRange:
     """Extract the presentation timerange from the media object
 
-    This implementation is very basic. It could be optimised further to avoid
-    reading and parsing the complete segment.
+    MPEG-TS media objects containing a single video stream are handled by
+    `extract_mpegts_timerange`, which only reads the TS packet and PES headers
+    in the first and last GOPs. Other media objects are demuxed completely,
+    which is very basic but works for any container that PyAV supports.
 
     This implementation assumes that the packet durations are known. This
     allows the segment timerange to include the last frame's duration with an
@@ -129,28 +406,274 @@ def extract_segment_timerange(filename: str) -> TimeRange:
     container or wallclock timing, which would require use of the
     FlowSegment.ts_offset property to position the segment on the Flow timeline.
     """
-    start_ts = None
-    end_ts = None
-    end_duration = None
+    mpegts_timerange = extract_mpegts_timerange(filename)
+    if mpegts_timerange is not None:
+        return mpegts_timerange
+
+    packet_timerange = PacketTimeRange()
     with av.open(filename, "r") as input:
         for pkt in input.demux():
-            if pkt.pts is None:
-                continue
+            packet_timerange.add(pkt)
+
+    return packet_timerange.timerange()
+
+
+class PacketTimeRange:
+    """Accumulates the presentation timerange of demuxed packets
+
+    The timerange starts at the lowest packet PTS and ends (exclusively) at the highest packet PTS plus
+    that packet's duration.
+    """
+    def __init__(self) -> None:
+        self.start_ts: Optional[Timestamp] = None
+        self.end_ts: Optional[Timestamp] = None
+        self.end_duration: Optional[Timestamp] = None
+
+    def add(self, pkt: av.Packet) -> None:
+        if pkt.pts is None:
+            return
+
+        ts = Timestamp.from_count(pkt.pts, 1/pkt.time_base)
+        duration = Timestamp.from_count(pkt.duration, 1/pkt.time_base)
+
+        if self.start_ts is None or self.end_ts is None:
+            self.start_ts = ts
+            self.end_ts = ts
+            self.end_duration = duration
+        else:
+            self.start_ts = min(ts, self.start_ts)
+            self.end_ts = max(ts, self.end_ts)
+            if ts == self.end_ts:
+                self.end_duration = duration
 
-            ts = Timestamp.from_count(pkt.pts, 1/pkt.time_base)
-            duration = Timestamp.from_count(pkt.duration, 1/pkt.time_base)
+    def timerange(self) -> TimeRange:
+        return TimeRange(self.start_ts, self.end_ts + self.end_duration, TimeRange.INCLUDE_START)
 
-            if start_ts is None:
-                start_ts = ts
-                end_ts = ts
-                end_duration = duration
+
+@dataclasses.dataclass
+class StreamSegment:
+    """A segment of a single stream, split out of a multi-essence segment media file"""
+    filename: str
+    timerange: TimeRange
+
+
+def get_stream_flow_metadata(filename: str) -> dict[int, dict[str, Any]]:
+    """Return Flow metadata for each audio and video stream in the media file, keyed by the stream index
+
+    Each Flow is set up for the stream to be stored in its own MPEG-TS container. The `container_mapping`
+    of the stream in the original (multi-essence) container is also returned, to be used in the
+    multi-essence Flow's `flow_collection`.
+    """
+    flow_metadata = {}
+    with av.open(filename, "r") as input:
+        for stream in input.streams:
+            codec_name = stream.codec_context.name
+            metadata: dict[str, Any] = {
+                "label": f"Demo Flow - {stream.type} stream {stream.index}",
+                "description": f"Flow created to demonstrate ingest of the {stream.type} from a multi-essence file",
+                "codec": STREAM_CODECS.get(codec_name, f"{stream.type}/{codec_name}"),
+                "container": "video/mp2t",
+            }
+            if stream.type == "video":
+                metadata["format"] = "urn:x-nmos:format:video"
+                metadata["essence_parameters"] = {
+                    "frame_width": stream.codec_context.width,
+                    "frame_height": stream.codec_context.height,
+                }
+                if stream.average_rate:
+                    metadata["essence_parameters"]["frame_rate"] = {
+                        "numerator": stream.average_rate.numerator,
+                        "denominator": stream.average_rate.denominator
+                    }
+            elif stream.type == "audio":
+                metadata["format"] = "urn:x-nmos:format:audio"
+                metadata["essence_parameters"] = {
+                    "sample_rate": stream.codec_context.sample_rate,
+                    "channels": stream.codec_context.channels
+                }
             else:
-                start_ts = min(ts, start_ts)
-                end_ts = max(ts, end_ts)
-                if ts == end_ts:
-                    end_duration = duration
+                continue
+
+            metadata["container_mapping"] = {
+                "track_index": stream.index,
+                "mp2ts_container": {
+                    "pid": stream.id
+                }
+            }
+            flow_metadata[stream.index] = metadata
+
+    return flow_metadata
+
+
+def split_segment(filename: str, output_dir: str, stream_indexes: list[int]) -> dict[int, StreamSegment]:
+    """Split the segment media file into a MPEG-TS file per stream, keyed by the stream index
+
+    The media file is demuxed once. Each packet of the selected streams is remuxed (without decoding) into
+    the stream's output file and used to extract the stream's timerange. The stream files are written to
+    `output_dir` and should be removed by the caller once they are no longer needed.
+    """
+    stream_filenames = {}
+    outputs = {}
+    packet_timeranges = {}
+    try:
+        with av.open(filename, "r") as input:
+            for stream in input.streams:
+                if stream.index not in stream_indexes:
+                    continue
+
+                fd, stream_filenames[stream.index] = tempfile.mkstemp(suffix=f".{stream.index}.ts", dir=output_dir)
+                os.close(fd)
+
+                output = av.open(stream_filenames[stream.index], "w", format="mpegts")
+                outputs[stream.index] = (output, output.add_stream_from_template(stream))
+                packet_timeranges[stream.index] = PacketTimeRange()
+
+            for pkt in input.demux():
+                if pkt.stream.index not in outputs or pkt.dts is None:
+                    continue
+
+                packet_timeranges[pkt.stream.index].add(pkt)
+
+                output, output_stream = outputs[pkt.stream.index]
+                pkt.stream = output_stream
+                output.mux(pkt)
+    except BaseException:
+        for output, _ in outputs.values():
+            output.close()
+        for stream_filename in stream_filenames.values():
+            os.remove(stream_filename)
+        raise
+
+    for output, _ in outputs.values():
+        output.close()
+
+    return {
+        stream_index: StreamSegment(stream_filename, packet_timeranges[stream_index].timerange())
+        for stream_index, stream_filename in stream_filenames.items()
+    }
+
+
+def timed_call(function: Callable[[str], ProbeResult], filename: str) -> tuple[ProbeResult, float]:
+    """Call the function, returning the result along with the time taken
+
+    This allows the time taken by a probe in a worker process to be recorded in the main process.
+    """
+    start_time = time.monotonic()
+    result = function(filename)
+    return (result, time.monotonic() - start_time)
+
+
+def init_probe_worker() -> None:
+    """Initialise a probe worker process so that PyAV is loaded before the first segment is probed"""
+    import av  # noqa: F401
+
+
+async def probe_segments(
+    segment_files: AsyncIterable[SegmentFile],
+    probe_executor: Optional[Executor],
+    probe_ahead: int,
+    probe: Callable[[str], ProbeResult]
+) -> AsyncGenerator[tuple[SegmentFile, asyncio.Future[ProbeResult]], None]:
+    """Returns the segment files along with a Future for the result of `probe`, e.g. the segment timerange
+
+    The `probe` (e.g. `extract_segment_timerange`) is started for up to `probe_ahead` segments before they
+    are returned, so that the results are (usually) known by the time the segments are ingested. Segment
+    files are returned as soon as they are available, which matters when following a live playlist.
+    """
+    loop = asyncio.get_running_loop()
+    probes: asyncio.Queue[Optional[tuple[SegmentFile, asyncio.Future[ProbeResult]]]] = asyncio.Queue()
+    probe_slots = asyncio.Semaphore(probe_ahead)
+
+    async def run_probe(filename: str) -> ProbeResult:
+        result, duration = await loop.run_in_executor(probe_executor, timed_call, probe, filename)
+        metrics.timing("probe", duration, filename=filename)
+        return result
+
+    async def start_probes() -> None:
+        try:
+            async for segment_file in segment_files:
+                await probe_slots.acquire()
+                probes.put_nowait((segment_file, asyncio.ensure_future(run_probe(segment_file.filename))))
+        finally:
+            probes.put_nowait(None)
+
+    producer = asyncio.create_task(start_probes())
+    try:
+        while (probed := await probes.get()) is not None:
+            metrics.gauge("probe_queue_depth", probes.qsize() + 1)
+            probe_slots.release()
+            yield probed
+
+        await producer  # Raises if getting the segment files failed
+    finally:
+        producer.cancel()
+        while not probes.empty():
+            probed = probes.get_nowait()
+            if probed is not None:
+                probed[1].cancel()
+
+
+async def upload_media_object(
+    session: aiohttp.ClientSession,
+    put_url: dict[str, Any],
+    filename: str,
+    part_size: int = DEFAULT_UPLOAD_PART_SIZE,
+    max_retries: int = 3
+) -> None:
+    """Upload the media object file using the `put_url` provided by the TAMS
+
+    The file is memory mapped and streamed in parts of `part_size` bytes, which are read in a worker
+    thread. The memory used therefore doesn't depend on the size of the media object.
+
+    The TAMS only provides a single URL to upload each media object to. A failed upload is therefore
+    retried from the start of the object, up to `max_retries` times, if the failure may be temporary.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def read_parts(data: mmap.mmap | bytes) -> AsyncGenerator[bytes, None]:
+        for offset in range(0, len(data), part_size):
+            yield await loop.run_in_executor(None, data.__getitem__, slice(offset, offset + part_size))
+
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        headers = put_url.get("headers", {}) | {
+            "Content-Type": put_url["content-type"],
+            "Content-Length": str(size)
+        }
 
-    return TimeRange(start_ts, end_ts + end_duration, TimeRange.INCLUDE_START)
+        # An empty file can't be memory mapped, so an empty body is uploaded instead
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else nullcontext(b"") as data:
+            attempt = 0
+            first_start_time = time.monotonic()
+            while True:
+                start_time = time.monotonic()
+                try:
+                    async with session.put(
+                        put_url["url"],
+                        data=read_parts(data),
+                        headers=headers
+                    ) as resp:
+                        resp.raise_for_status()
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if isinstance(e, aiohttp.ClientResponseError) and e.status < 500:
+                        raise
+
+                    attempt += 1
+                    if attempt > max_retries:
+                        raise
+
+                    logger.warning(f"Upload of {filename} failed ({e!r}). Retrying (attempt {attempt})")
+                    metrics.count("upload_retries", filename=filename)
+                    await asyncio.sleep(0.5 * 2**(attempt - 1))
+
+    duration = time.monotonic() - start_time
+    metrics.timing("upload", time.monotonic() - first_start_time, filename=filename, bytes=size, retries=attempt)
+    metrics.count("bytes_uploaded", size)
+    logger.info(
+        f"Uploaded {size} bytes from {filename} in {duration:.3f}s "
+        f"({size * 8 / max(duration, 1e-6) / 1e6:.1f} Mbit/s)"
+    )
 
 
 async def ingest_segment(
@@ -160,55 +683,121 @@ async def ingest_segment(
     flow_id: UUID,
     object_url: dict[str, Any],
     filename: str,
-    start_timestamp_in_flow: Optional[Timestamp] = None
+    start_timestamp_in_flow: Optional[Timestamp | asyncio.Future[Timestamp]] = None,
+    next_timestamp_in_flow: Optional[asyncio.Future[Timestamp]] = None,
+    segment_batcher: Optional[SegmentRegistrationBatcher] = None,
+    media_timerange: Optional[Awaitable[TimeRange]] = None,
+    upload_part_size: int = DEFAULT_UPLOAD_PART_SIZE,
+    media_ts_offset: Optional[Timestamp] = None,
+    on_uploaded: Optional[Callable[[dict[str, Any]], None]] = None,
+    gop_index_store: Optional[GopIndexStore] = None
 ) -> TimeRange:
     """Upload the segment's media object and register the segment
 
+    The `start_timestamp_in_flow` can be a Future that is resolved by the ingest of the previous
+    segment. The `next_timestamp_in_flow` Future is resolved with the end of this segment's timerange
+    as soon as it is known, i.e. before the upload. This allows segments to be ingested concurrently
+    whilst keeping the forced positions on the Flow timeline in strict order.
+
+    If a `segment_batcher` is given then the segment is added to it to be registered in bulk rather
+    than being registered immediately.
+
+    The `media_timerange` can be given if the extraction of the timerange from the media object has
+    already been started, e.g. by `probe_segments`.
+
+    If `start_timestamp_in_flow` isn't given then the segment is placed on the Flow timeline using the
+    media timing, offset by `media_ts_offset` if given.
+
+    The `on_uploaded` callback is called with the (JSON encoded) segment once the media object has been
+    uploaded and before the segment is registered.
+
+    If a `gop_index_store` is given then an index of the GOPs in the (MPEG-TS) media object is stored in it,
+    which `outgest_file` can use to download part of the media object.
+
     Returns the ingested segment timerange
     """
-    media_tr = await asyncio.get_running_loop().run_in_executor(
-        None,
-        extract_segment_timerange,
-        filename
-    )
+    start_time = time.monotonic()
+    try:
+        if media_timerange is None:
+            media_timerange = asyncio.get_running_loop().run_in_executor(
+                None,
+                extract_segment_timerange,
+                filename
+            )
+        media_tr = await media_timerange
+        metrics.timing("probe_wait", time.monotonic() - start_time, filename=filename)
+
+        if isinstance(start_timestamp_in_flow, asyncio.Future):
+            start_timestamp_in_flow = await start_timestamp_in_flow
+    except BaseException:
+        # Don't leave the following segment waiting for its position forever
+        if next_timestamp_in_flow is not None:
+            next_timestamp_in_flow.cancel()
+        raise
 
-    if start_timestamp_in_flow:
+    # Note that the position may be Timestamp(0), which is falsy
+    if start_timestamp_in_flow is not None:
         seg_tr = TimeRange.from_start_length(start_timestamp_in_flow, media_tr.length, TimeRange.INCLUDE_START)
         ts_offset = start_timestamp_in_flow - media_tr.start
+        if next_timestamp_in_flow is not None:
+            next_timestamp_in_flow.set_result(start_timestamp_in_flow + media_tr.length)
     else:
-        seg_tr = media_tr
-        ts_offset = Timestamp(0, 0)
+        # Without a position the following segment can't be positioned after this one
+        if next_timestamp_in_flow is not None:
+            next_timestamp_in_flow.cancel()
 
-    first_object_url = object_url["put_url"]["url"]
-    content_type = object_url["put_url"]["content-type"]
-    with open(filename, "rb") as f:
-        async with session.put(
-            first_object_url,
-            data=f,
-            headers={
-                "Content-Type": content_type
-            }
-        ) as resp:
-            resp.raise_for_status()
+        if media_ts_offset is not None:
+            seg_tr = TimeRange(media_tr.start + media_ts_offset, media_tr.end + media_ts_offset, media_tr.inclusivity)
+            ts_offset = media_ts_offset
+        else:
+            seg_tr = media_tr
+            ts_offset = Timestamp(0, 0)
+
+    await upload_media_object(session, object_url["put_url"], filename, part_size=upload_part_size)
 
     logger.info(f"Uploaded object to {object_url['object_id']} for timerange {seg_tr}")
 
-    async with post_request(
-        session,
-        credentials,
-        f"{tams_url}/flows/{flow_id}/segments",
-        json=mediajson.encode_value({
-            "object_id": object_url['object_id'],
-            "timerange": seg_tr,
-            "ts_offset": ts_offset
-        })
-    ):
-        pass  # Context manager will raise on failure
+    if gop_index_store is not None:
+        gop_index = await asyncio.get_running_loop().run_in_executor(None, build_gop_index, filename)
+        if gop_index is not None:
+            gop_index_store.put(object_url["object_id"], gop_index)
+
+    segment = mediajson.encode_value({
+        "object_id": object_url['object_id'],
+        "timerange": seg_tr,
+        "ts_offset": ts_offset
+    })
+
+    if on_uploaded is not None:
+        on_uploaded(segment)
+
+    if segment_batcher is not None:
+        await segment_batcher.add(segment)
+
+        logger.info(f"Queued flow segment for {object_url['object_id']} at {seg_tr.to_sec_nsec_range()}")
+        return seg_tr
+
+    with metrics.timed("register", url=f"{tams_url}/flows/{flow_id}/segments", segments=1):
+        async with post_request(
+            session,
+            credentials,
+            f"{tams_url}/flows/{flow_id}/segments",
+            json=segment
+        ):
+            pass  # Context manager will raise on failure
+    metrics.count("segments_registered")
 
     logger.info(f"Created flow segment for {object_url['object_id']} at {seg_tr.to_sec_nsec_range()}")
     return seg_tr
 
 
+async def stop_ingests(ingest_tasks: list[asyncio.Task]) -> None:
+    """Cancel the segment ingest tasks that are still running, e.g. if one has failed, and wait for them to stop"""
+    for task in ingest_tasks:
+        task.cancel()
+    await asyncio.gather(*ingest_tasks, return_exceptions=True)
+
+
 async def segment_ingest(
     tams_url: str,
     credentials: Credentials,
@@ -219,49 +808,421 @@ async def segment_ingest(
     source_id: UUID,
     flow_params: Optional[dict],
     hls_mode: bool = True,
-    sequence_force_start_time: Optional[Timestamp] = None
+    sequence_force_start_time: Optional[Timestamp] = None,
+    ingest_workers: int = 1,
+    segment_batch_size: int = 10,
+    segment_batch_delay: float = 1.0,
+    probe_processes: int = 0,
+    upload_part_size: int = DEFAULT_UPLOAD_PART_SIZE,
+    live: bool = False,
+    live_state_filename: Optional[str] = None,
+    journal: Optional[IngestJournal] = None,
+    gop_index_store: Optional[GopIndexStore] = None
 ) -> None:
-    """Upload segments from the HLS playlist"""
+    """Upload segments from the HLS playlist
+
+    Up to `ingest_workers` segments are ingested concurrently, overlapping the timerange extraction,
+    object upload and segment registration of different segments.
+
+    Segments are registered in bulk requests of up to `segment_batch_size` segments, or whatever has
+    been collected after `segment_batch_delay` seconds.
+
+    The segment timeranges are extracted ahead of the ingest workers. If `probe_processes` is set then
+    this is done in a pool of worker processes rather than threads, which scales across CPU cores.
+
+    If `live` is set then the HLS playlist is followed until it ends, ignoring `start_segment` and
+    `segment_count`. The last registered media sequence number is saved to `live_state_filename`, if given,
+    so that the ingest can resume from that point. Segments following a discontinuity are placed on the
+    Flow timeline directly after the previous segment.
+
+    If a `journal` is given then the progress of the ingest is recorded in it. When resuming from an existing
+    journal, segments that have already been uploaded are skipped, any of those that weren't registered are
+    registered, and media objects that were allocated recently but not used are reused.
+
+    If a `gop_index_store` is given then an index of the GOPs in each MPEG-TS media object is stored in it.
+    """
+    if journal is not None:
+        journal.start(str(flow_id), str(source_id))
+
     async with aiohttp.ClientSession(trust_env=True) as session:
         await put_flow(session, credentials, tams_url, flow_id, source_id, flow_params)
 
-        object_urls = get_media_storage_urls(session, credentials, tams_url, flow_id, segment_count)
+        media_storage = MediaStorageAllocator(
+            session,
+            credentials,
+            tams_url,
+            flow_id,
+            # Segments arrive slowly when following a live playlist, so start small to avoid URLs expiring
+            initial_batch_size=1 if live else min(segment_count, 100),
+            on_allocated=journal.allocated if journal is not None else None
+        )
+        if journal is not None:
+            media_storage.reuse(journal.unused_media_objects(media_storage.max_object_age))
 
-        if hls_mode:
-            segment_filenames = get_hls_segment_filenames(manifest_filename)
+        live_state: Optional[LiveIngestState] = None
+        segment_files: AsyncIterable[SegmentFile]
+        if live:
+            live_state = LiveIngestState(live_state_filename)
+            segment_files = follow_hls_playlist(manifest_filename, live_state.media_sequence)
         else:
-            segment_filenames = get_segment_list_filenames(manifest_filename)
-
-        position_in_flow = None
-        if sequence_force_start_time:
-            position_in_flow = sequence_force_start_time
-
-        # This sequential upload process could be optimised by using asyncio tasks to
-        # ingest segments concurrently
-        count = 0
-        for segment_filename in segment_filenames:
-            count += 1
-            if count <= start_segment:
-                continue
-            elif count > start_segment + segment_count:
-                break
+            segment_files = get_segment_files(manifest_filename, hls_mode, start_segment, segment_count)
 
-            object_url = await anext(object_urls)
+        if journal is not None:
+            segment_files = skip_journal_segments(segment_files, journal)
 
-            full_segment_filename = os.path.join(os.path.dirname(manifest_filename), segment_filename)
+        probe_executor: Optional[Executor] = None
+        if probe_processes > 0:
+            probe_executor = ProcessPoolExecutor(probe_processes, initializer=init_probe_worker)
 
-            seg_tr = await ingest_segment(
-                session,
-                credentials,
-                tams_url,
-                flow_id,
-                object_url,
-                full_segment_filename,
-                start_timestamp_in_flow=position_in_flow  # Will be None if not used
+        # The position in the Flow of each segment depends on the length of the previous segment,
+        # so it is passed along as a chain of Futures
+        position_in_flow: Optional[asyncio.Future[Timestamp]] = None
+        if sequence_force_start_time is not None:
+            position_in_flow = asyncio.get_running_loop().create_future()
+            if live_state is not None and live_state.end_timestamp_in_flow is not None:
+                position_in_flow.set_result(live_state.end_timestamp_in_flow)
+            else:
+                position_in_flow.set_result(sequence_force_start_time)
+
+        # Offset applied to the media timing when not forcing the position, which changes on discontinuities
+        media_ts_offset = live_state.ts_offset if live_state is not None else Timestamp()
+        previous_media_timerange: Optional[asyncio.Future[TimeRange]] = None
+
+        # Live segments in media sequence order and the segments that have been registered, which are
+        # used to save the last media sequence number that has been registered without any gaps
+        live_segments: deque[tuple[SegmentFile, str]] = deque()
+        registered_live_segments: dict[str, dict] = {}
+
+        def save_live_state(registered_segments: list[dict]) -> None:
+            if live_state is None:
+                return
+
+            for segment in registered_segments:
+                registered_live_segments[segment["object_id"]] = segment
+
+            while live_segments and live_segments[0][1] in registered_live_segments:
+                segment_file, object_id = live_segments.popleft()
+                assert segment_file.media_sequence is not None
+                live_state.update(segment_file.media_sequence, registered_live_segments.pop(object_id))
+
+                if segment_file.available_at is not None and segment_file.duration is not None:
+                    latency = time.monotonic() - segment_file.available_at
+                    if latency > segment_file.duration:
+                        logger.warning(
+                            f"Segment with media sequence number {segment_file.media_sequence} was registered "
+                            f"{latency:.3f}s after it became available, which is longer than its duration"
+                        )
+
+            live_state.save()
+
+        def on_registered(registered_segments: list[dict]) -> None:
+            if journal is not None:
+                journal.registered(registered_segments)
+            save_live_state(registered_segments)
+
+        workers = asyncio.Semaphore(ingest_workers)
+        ingest_tasks: list[asyncio.Task] = []
+        try:
+            async with AsyncExitStack() as exit_stack:
+                # The remaining segments are flushed on leaving the context, including if an ingest has failed. Any
+                # ingests still running are stopped first so that no segment is added after the flush
+                segment_batcher = await exit_stack.enter_async_context(SegmentRegistrationBatcher(
+                    session,
+                    credentials,
+                    tams_url,
+                    flow_id,
+                    max_segments=segment_batch_size,
+                    max_delay=segment_batch_delay,
+                    on_registered=on_registered
+                ))
+                exit_stack.push_async_callback(stop_ingests, ingest_tasks)
+
+                if journal is not None:
+                    for journal_segment in journal.unregistered_segments():
+                        logger.info(f"Registering segment {journal_segment.key} uploaded before the ingest was resumed")
+                        await segment_batcher.add(journal_segment.segment)
+
+                probed_segments = probe_segments(
+                    segment_files,
+                    probe_executor,
+                    max(ingest_workers, probe_processes),
+                    extract_segment_timerange
+                )
+                async for segment_file, media_timerange in probed_segments:
+                    await workers.acquire()
+
+                    # Stop early (re-raising the exception) if a segment ingest has already failed
+                    for task in [task for task in ingest_tasks if task.done()]:
+                        ingest_tasks.remove(task)
+                        await task
+
+                    if segment_file.previous_segment is not None:
+                        # Continue from the last segment that was ingested before the ingest was resumed
+                        previous_tr = TimeRange.from_str(segment_file.previous_segment["timerange"])
+                        media_ts_offset = Timestamp.from_str(segment_file.previous_segment["ts_offset"])
+                        if position_in_flow is not None:
+                            position_in_flow = asyncio.get_running_loop().create_future()
+                            position_in_flow.set_result(previous_tr.end)
+                        previous_media_timerange = asyncio.get_running_loop().create_future()
+                        previous_media_timerange.set_result(TimeRange(
+                            previous_tr.start - media_ts_offset,
+                            previous_tr.end - media_ts_offset,
+                            previous_tr.inclusivity
+                        ))
+
+                    if segment_file.discontinuity and position_in_flow is None:
+                        # Continue the Flow timeline from the end of the previous segment
+                        if previous_media_timerange is not None:
+                            previous_end = (await previous_media_timerange).end + media_ts_offset
+                        elif live_state is not None:
+                            previous_end = live_state.end_timestamp_in_flow
+                        else:
+                            previous_end = None
+
+                        if previous_end is not None:
+                            media_ts_offset = previous_end - (await media_timerange).start
+                            logger.info(
+                                f"Discontinuity at media sequence number {segment_file.media_sequence}. "
+                                f"Offsetting the following segments by {media_ts_offset}"
+                            )
+                    previous_media_timerange = media_timerange
+
+                    object_url = await media_storage.get()
+                    if live_state is not None:
+                        live_segments.append((segment_file, object_url["object_id"]))
+
+                    next_position_in_flow = None
+                    if position_in_flow is not None:
+                        next_position_in_flow = asyncio.get_running_loop().create_future()
+
+                    task = asyncio.create_task(ingest_segment(
+                        session,
+                        credentials,
+                        tams_url,
+                        flow_id,
+                        object_url,
+                        segment_file.filename,
+                        start_timestamp_in_flow=position_in_flow,  # Will be None if not used
+                        next_timestamp_in_flow=next_position_in_flow,
+                        segment_batcher=segment_batcher,
+                        media_timerange=media_timerange,
+                        upload_part_size=upload_part_size,
+                        media_ts_offset=media_ts_offset,
+                        on_uploaded=(
+                            (lambda segment, key=segment_file.key: journal.uploaded(key, segment))
+                            if journal is not None else None
+                        ),
+                        gop_index_store=gop_index_store
+                    ))
+                    task.add_done_callback(lambda _: workers.release())
+                    ingest_tasks.append(task)
+                    metrics.gauge("ingest_queue_depth", len(ingest_tasks))
+
+                    position_in_flow = next_position_in_flow
+
+                await asyncio.gather(*ingest_tasks)
+        finally:
+            if probe_executor is not None:
+                probe_executor.shutdown(cancel_futures=True)
+            await media_storage.close()
+            metrics.log_summary()
+
+
+@dataclasses.dataclass
+class StreamFlowIngest:
+    """The ingest into one of the Flows in a multi-Flow ingest
+
+    Each Flow has its own media storage, segment registration and limit on concurrent segment ingests.
+    The `stream_index` is None for the multi-essence Flow.
+    """
+    flow_id: UUID
+    stream_index: Optional[int]
+    media_storage: MediaStorageAllocator
+    segment_batcher: SegmentRegistrationBatcher
+    workers: asyncio.Semaphore
+
+
+async def multi_flow_ingest(
+    tams_url: str,
+    credentials: Credentials,
+    manifest_filename: str,
+    start_segment: int,
+    segment_count: int,
+    flow_id: UUID,
+    source_id: UUID,
+    flow_params: Optional[dict],
+    hls_mode: bool = True,
+    sequence_force_start_time: Optional[Timestamp] = None,
+    ingest_workers: int = 1,
+    segment_batch_size: int = 10,
+    segment_batch_delay: float = 1.0,
+    probe_processes: int = 0,
+    upload_part_size: int = DEFAULT_UPLOAD_PART_SIZE
+) -> None:
+    """Upload segments from the HLS playlist to a Flow per audio and video stream and a multi-essence Flow
+
+    The streams are found in the first segment media file and a mono-essence Flow (with a new Source) is
+    created for each one. A multi-essence Flow, with the given `flow_id` and `source_id`, collects them
+    together and has segments referencing the original segment media files.
+
+    Each segment media file is demuxed once, in the same way as the timerange extraction in `segment_ingest`,
+    to split it into a MPEG-TS file per stream and get the timerange of each stream. The stream files and the
+    original file are then uploaded and registered for each Flow independently.
+
+    If `sequence_force_start_time` is set then all the Flows are offset by the same amount so that the first
+    segment starts at that time, which keeps the streams in sync. The Flow timelines otherwise follow the
+    media timing.
+    """
+    loop = asyncio.get_running_loop()
+    async with aiohttp.ClientSession(trust_env=True) as session:
+        segment_files = get_segment_files(manifest_filename, hls_mode, start_segment, segment_count)
+        first_segment_file = await anext(aiter(segment_files))
+        stream_flow_metadata = await loop.run_in_executor(None, get_stream_flow_metadata, first_segment_file.filename)
+
+        async def all_segment_files() -> AsyncGenerator[SegmentFile, None]:
+            yield first_segment_file
+            async for segment_file in segment_files:
+                yield segment_file
+
+        flow_collection = []
+        flow_ingests: list[tuple[UUID, Optional[int]]] = []
+        for stream_index, metadata in stream_flow_metadata.items():
+            stream_flow_id = uuid4()
+            flow_collection.append({"id": str(stream_flow_id), "container_mapping": metadata.pop("container_mapping")})
+            await put_flow(session, credentials, tams_url, stream_flow_id, uuid4(), metadata)
+            flow_ingests.append((stream_flow_id, stream_index))
+
+        multi_flow_metadata = flow_params if flow_params is not None else dict(DEFAULT_MULTI_FLOW_METADATA)
+        multi_flow_metadata["flow_collection"] = flow_collection
+        await put_flow(session, credentials, tams_url, flow_id, source_id, multi_flow_metadata)
+        flow_ingests.append((flow_id, None))
+
+        stream_ingests = [
+            StreamFlowIngest(
+                ingest_flow_id,
+                stream_index,
+                MediaStorageAllocator(session, credentials, tams_url, ingest_flow_id, min(segment_count, 100)),
+                SegmentRegistrationBatcher(
+                    session,
+                    credentials,
+                    tams_url,
+                    ingest_flow_id,
+                    max_segments=segment_batch_size,
+                    max_delay=segment_batch_delay
+                ),
+                asyncio.Semaphore(ingest_workers)
             )
+            for (ingest_flow_id, stream_index) in flow_ingests
+        ]
+
+        probe_executor: Optional[Executor] = None
+        if probe_processes > 0:
+            probe_executor = ProcessPoolExecutor(probe_processes, initializer=init_probe_worker)
+
+        async def ingest_flow_segment(
+            stream_ingest: StreamFlowIngest,
+            object_url: dict[str, Any],
+            filename: str,
+            media_tr: TimeRange,
+            ts_offset: Timestamp,
+            remove_file: bool
+        ) -> None:
+            media_timerange = loop.create_future()
+            media_timerange.set_result(media_tr)
+            try:
+                await ingest_segment(
+                    session,
+                    credentials,
+                    tams_url,
+                    stream_ingest.flow_id,
+                    object_url,
+                    filename,
+                    segment_batcher=stream_ingest.segment_batcher,
+                    media_timerange=media_timerange,
+                    upload_part_size=upload_part_size,
+                    media_ts_offset=ts_offset
+                )
+            finally:
+                if remove_file:
+                    os.remove(filename)
+
+        ingest_tasks: list[asyncio.Task] = []
+        ts_offset: Optional[Timestamp] = None
+        with tempfile.TemporaryDirectory() as output_dir:
+            try:
+                async with AsyncExitStack() as segment_batchers:
+                    # The remaining segments are flushed on leaving the context, including if an ingest has failed.
+                    # Any ingests still running are stopped first so that no segment is added after the flush
+                    for stream_ingest in stream_ingests:
+                        await segment_batchers.enter_async_context(stream_ingest.segment_batcher)
+                    segment_batchers.push_async_callback(stop_ingests, ingest_tasks)
+
+                    probed_segments = probe_segments(
+                        all_segment_files(),
+                        probe_executor,
+                        max(ingest_workers, probe_processes),
+                        functools.partial(
+                            split_segment, output_dir=output_dir, stream_indexes=list(stream_flow_metadata)
+                        )
+                    )
+                    async for segment_file, split_result in probed_segments:
+                        stream_segments = await split_result
+
+                        # Stop early (re-raising the exception) if a segment ingest has already failed
+                        for task in [task for task in ingest_tasks if task.done()]:
+                            ingest_tasks.remove(task)
+                            await task
+
+                        segment_tr = TimeRange(
+                            min(stream_segment.timerange.start for stream_segment in stream_segments.values()),
+                            max(stream_segment.timerange.end for stream_segment in stream_segments.values()),
+                            TimeRange.INCLUDE_START
+                        )
+                        if ts_offset is None:
+                            ts_offset = Timestamp()
+                            if sequence_force_start_time is not None:
+                                ts_offset = sequence_force_start_time - segment_tr.start
+
+                        for stream_ingest in stream_ingests:
+                            if stream_ingest.stream_index is None:
+                                filename, media_tr, remove_file = segment_file.filename, segment_tr, False
+                            elif stream_ingest.stream_index in stream_segments:
+                                stream_segment = stream_segments.pop(stream_ingest.stream_index)
+                                filename, media_tr = stream_segment.filename, stream_segment.timerange
+                                remove_file = True
+                            else:
+                                logger.warning(
+                                    f"Stream {stream_ingest.stream_index} is missing from {segment_file.filename}"
+                                )
+                                continue
 
-            if position_in_flow:
-                position_in_flow += seg_tr.length
+                            await stream_ingest.workers.acquire()
+                            object_url = await stream_ingest.media_storage.get()
+                            task = asyncio.create_task(ingest_flow_segment(
+                                stream_ingest,
+                                object_url,
+                                filename,
+                                media_tr,
+                                ts_offset,
+                                remove_file
+                            ))
+                            task.add_done_callback(lambda _, workers=stream_ingest.workers: workers.release())
+                            ingest_tasks.append(task)
+                            metrics.gauge("ingest_queue_depth", len(ingest_tasks))
+
+                    await asyncio.gather(*ingest_tasks)
+            finally:
+                if probe_executor is not None:
+                    probe_executor.shutdown(cancel_futures=True)
+                for stream_ingest in stream_ingests:
+                    await stream_ingest.media_storage.close()
+                metrics.log_summary()
+
+        for stream_ingest in stream_ingests:
+            if stream_ingest.stream_index is None:
+                logger.info(f"Ingested multi-essence Flow {stream_ingest.flow_id}")
+            else:
+                logger.info(f"Ingested Flow {stream_ingest.flow_id} for stream {stream_ingest.stream_index}")
 
 
 if __name__ == "__main__":
@@ -343,6 +1304,54 @@ if __name__ == "__main__":
         "--force-start-time", type=Timestamp.from_str,
         help="Ignore timestamps in the input and ingest from this point, sequentially"
     )
+    parser.add_argument(
+        "--ingest-workers", type=int, default=1,
+        help="Number of segments to ingest concurrently. Default is to ingest sequentially"
+    )
+    parser.add_argument(
+        "--segment-batch-size", type=int, default=10,
+        help="Maximum number of segments to register in a single request"
+    )
+    parser.add_argument(
+        "--segment-batch-delay", type=float, default=1.0,
+        help="Maximum time in seconds to wait for a batch of segments to fill before registering them"
+    )
+    parser.add_argument(
+        "--probe-processes", type=int, nargs="?", const=os.cpu_count(), default=0,
+        help=("Extract segment timeranges in a pool of this many processes. "
+              "The pool size is the CPU count if no value is given. Default is to use threads")
+    )
+    parser.add_argument(
+        "--live", action="store_true",
+        help="Follow a live HLS playlist, ingesting new segments until the playlist ends"
+    )
+    parser.add_argument(
+        "--live-state-file", type=str,
+        help="File used to save the progress of a live ingest, allowing it to resume after a restart"
+    )
+    parser.add_argument(
+        "--journal-file", type=str,
+        help=("Journal file used to record the progress of the ingest. If the file exists then the ingest is "
+              "resumed, skipping segments that have already been uploaded")
+    )
+    parser.add_argument(
+        "--metrics-file", type=str,
+        help="JSON lines file to write timing metrics for each ingest stage to, along with counts and queue depths"
+    )
+    parser.add_argument(
+        "--split-streams", action="store_true",
+        help=("Demux each segment once to ingest each audio and video stream into its own Flow, as well as "
+              "ingesting the segments into a multi-essence Flow that collects those Flows")
+    )
+    parser.add_argument(
+        "--upload-part-size", type=int, default=DEFAULT_UPLOAD_PART_SIZE // (1024 * 1024),
+        help="Size in MiB of the parts that media objects are streamed in when uploading"
+    )
+    parser.add_argument(
+        "--gop-index-dir", type=str,
+        help=("Directory in which to store an index of the GOPs in each MPEG-TS media object, which allows "
+              "outgest_file (with the same --gop-index-dir) to download only part of a media object")
+    )
 
     args = parser.parse_args()
 
@@ -362,15 +1371,67 @@ if __name__ == "__main__":
     segment_count = args.hls_segment_count or args.segment_count
     hls_mode = (args.hls_filename is not None) or not args.use_simple_list
 
-    output_timerange = asyncio.run(segment_ingest(
-        args.tams_url.rstrip("/"),
-        credentials,
-        list_filename,
-        start_segment,
-        segment_count,
-        args.flow_id or uuid4(),
-        args.source_id or uuid4(),
-        args.flow_params,
-        hls_mode=hls_mode,
-        sequence_force_start_time=args.force_start_time
-    ))
+    if args.live and not hls_mode:
+        parser.error("Live ingest (--live) requires an HLS playlist")
+    if args.split_streams and (args.live or args.journal_file or args.gop_index_dir):
+        parser.error("Splitting streams (--split-streams) doesn't support --live, --journal-file or --gop-index-dir")
+    journal = None
+    flow_id = args.flow_id
+    source_id = args.source_id
+    if args.journal_file:
+        journal = IngestJournal(args.journal_file)
+        # Default to resuming the ingest into the Flow recorded in the journal
+        if journal.flow_id is not None and journal.source_id is not None:
+            flow_id = flow_id or UUID(journal.flow_id)
+            source_id = source_id or UUID(journal.source_id)
+
+    if args.live_state_file and not flow_id:
+        logger.warning("A live ingest can only be resumed into the same Flow when --flow-id is given")
+
+    if args.metrics_file:
+        metrics.open(args.metrics_file)
+
+    try:
+        if args.split_streams:
+            asyncio.run(multi_flow_ingest(
+                args.tams_url.rstrip("/"),
+                credentials,
+                list_filename,
+                start_segment,
+                segment_count,
+                flow_id or uuid4(),
+                source_id or uuid4(),
+                args.flow_params,
+                hls_mode=hls_mode,
+                sequence_force_start_time=args.force_start_time,
+                ingest_workers=args.ingest_workers,
+                segment_batch_size=args.segment_batch_size,
+                segment_batch_delay=args.segment_batch_delay,
+                probe_processes=args.probe_processes,
+                upload_part_size=args.upload_part_size * 1024 * 1024
+            ))
+        else:
+            output_timerange = asyncio.run(segment_ingest(
+                args.tams_url.rstrip("/"),
+                credentials,
+                list_filename,
+                start_segment,
+                segment_count,
+                flow_id or uuid4(),
+                source_id or uuid4(),
+                args.flow_params,
+                hls_mode=hls_mode,
+                sequence_force_start_time=args.force_start_time,
+                ingest_workers=args.ingest_workers,
+                segment_batch_size=args.segment_batch_size,
+                segment_batch_delay=args.segment_batch_delay,
+                probe_processes=args.probe_processes,
+                upload_part_size=args.upload_part_size * 1024 * 1024,
+                live=args.live,
+                live_state_filename=args.live_state_file,
+                journal=journal,
+                gop_index_store=GopIndexStore(args.gop_index_dir) if args.gop_index_dir else None
+            ))
+    finally:
+        if journal is not None:
+            journal.close()
@@ -1,14 +1,24 @@
 #!/usr/bin/env python
 # This script demonstrates outgest of a TAMS Flow to a local file
 
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, AsyncIterable, Callable, Optional
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
 from uuid import UUID
-from io import BytesIO
+from io import BufferedReader, BytesIO
+import mmap
 import os
 from fractions import Fraction
 import asyncio
+import dataclasses
+import functools
 import logging
+import math
+import queue
+import threading
+import time
 
 from mediatimestamp import Timestamp, TimeRange
 import aiohttp
@@ -16,11 +26,29 @@ import av
 
 from utils.credentials import Credentials, BasicCredentials, OAuth2ClientCredentials
 from utils.client import get_request
+from utils.streaming import StreamBuffer
+from utils.cache import MediaObjectCache
+from utils.url_selector import GetUrlSelector, DEFAULT_HEDGE_DELAY
+from utils.segments import SegmentLister, DEFAULT_PAGE_LIMIT, DEFAULT_READ_AHEAD
+from utils.segment_index import SegmentIndex
+from utils.metrics import metrics
+from utils.mpegts import GopIndex, GopIndexBuilder, GopIndexStore, offset_mpegts_timestamps, PTS_RATE, TS_PACKET_SIZE
 
 logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+DEFAULT_PREFETCH_COUNT = 4
+DEFAULT_MAX_PREFETCH_SIZE = 256 * 1024 * 1024
+DEFAULT_PACKET_QUEUE_SIZE = 1000
+PACKET_PUT_TIMEOUT = 0.1  # Seconds between checks that muxing hasn't failed whilst the packet queue is full
+DEFAULT_STREAM_BUFFER_SIZE = 4 * 1024 * 1024
+DEFAULT_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+DEFAULT_SHARD_RETRIES = 2
+RETIME_CHUNK_SIZE = 1024 * TS_PACKET_SIZE
+
+MediaObject = BytesIO | StreamBuffer | BufferedReader | mmap.mmap
+
 
 async def get_flow(tams_url: str, credentials: Credentials, flow_id: UUID) -> dict:
     """Returns a Flow dict for the given Flow ID"""
@@ -35,44 +63,49 @@ async def get_flow_segments(
     tams_url: str,
     credentials: Credentials,
     flow: dict,
-    timerange: TimeRange
+    timerange: TimeRange,
+    storage_ids: Optional[list[UUID]] = None,
+    segment_lister: Optional[SegmentLister] = None
 ) -> AsyncGenerator[dict, None]:
-    """Generator of Flow Segment dicts for the given Flow ID and timerange"""
+    """Generator of Flow Segment dicts for the given Flow ID and timerange
+
+    The `get_urls` include the storage backend IDs, limited to those in `storage_ids` if given. The pages of
+    segments are fetched using the `segment_lister`, which may fetch parts of the timerange concurrently.
+    """
+    if segment_lister is None:
+        segment_lister = SegmentLister()
+
     segments_url = (
-        f"{tams_url}/flows/{flow['id']}/segments?timerange={timerange!s}"
-        "&presigned=true&include_object_timerange=true")
-    async with aiohttp.ClientSession(trust_env=True) as session:
-        while True:
-            async with get_request(session, credentials, segments_url) as resp:
-                resp.raise_for_status()
-
-                segments = await resp.json()
-                for segment in segments:
-                    segment_timerange = TimeRange.from_str(segment["timerange"])
-                    if segment_timerange.overlaps_with_timerange(timerange):
-                        yield segment
-                    else:
-                        logger.warning(
-                            f"Skipping segment returned by TAMS with a timerange {segment_timerange!s} "
-                            f"that does not overlap with the target timerange {timerange!s}"
-                        )
+        f"{tams_url}/flows/{flow['id']}/segments"
+        "?presigned=true&include_object_timerange=true&verbose_storage=true")
+    if storage_ids:
+        segments_url += "&accept_storage_ids=" + ",".join(str(storage_id) for storage_id in storage_ids)
 
-                try:
-                    segments_url = str(resp.links["next"]["url"])
-                except KeyError:
-                    break
+    # Limit an unbounded timerange to the Flow's timerange so that it can be split into sub-timeranges
+    if "timerange" in flow and (timerange.start is None or timerange.end is None):
+        timerange = timerange.intersect_with(TimeRange.from_str(flow["timerange"]))
+        if timerange.is_empty():
+            return
+
+    async with aiohttp.ClientSession(trust_env=True) as session:
+        async for segment in segment_lister.segments(session, credentials, segments_url, timerange):
+            yield segment
 
 
 def normalise_and_transfer_media(
     flow: dict,
     segment: dict,
-    media_essence: BytesIO,
+    media_essence: MediaObject,
     av_output: av.container.OutputContainer,
-    check_timing: bool
+    check_timing: bool,
+    mux: Optional[Callable[[av.Packet], None]] = None
 ) -> TimeRange:
     """Transfer the essence from the media object to the output file.
 
     Also normalise the included sample range and timing using the Flow Segment information.
+
+    The output stream is added to `av_output` if needed and the packets are assigned to it. The packets are
+    then passed to `mux` if given, e.g. to be muxed in another thread, otherwise they are muxed directly.
     """
     # Identify the stream in the input MPEG-TS container
     if "container_mapping" in flow:
@@ -226,7 +259,10 @@ def normalise_and_transfer_media(
             if pkt.dts is not None:
                 pkt.dts = pkt.dts + ts_offset.to_count(1/pkt.time_base)
 
-            av_output.mux([pkt])
+            if mux is not None:
+                mux(pkt)
+            else:
+                av_output.mux([pkt])
 
             # Discard media units after segment_timerange end
             if process_media_packet_offsets and not output_timerange.ends_earlier_than_timerange(segment_timerange):
@@ -257,14 +293,323 @@ def normalise_and_transfer_media(
     return output_timerange
 
 
+def get_download_urls(segment: dict) -> list[dict]:
+    """Returns the `get_urls` that the segment's media object can be downloaded from"""
+    if not segment.get("get_urls"):
+        raise ValueError("Unable to find download URL for segment "
+                         f"{segment['object_id']} at {segment['timerange']}")
+    return segment["get_urls"]
+
+
+def get_partial_segment(segment: dict, gop_index: GopIndex) -> Optional[tuple[int, int, dict]]:
+    """Returns the byte range of the media object containing the segment's timerange, if not the whole object
+
+    The byte range is returned as the start and (exclusive) end offsets, along with a copy of the segment
+    with an `object_timerange` describing the media in the byte range.
+    """
+    if "object_timerange" not in segment:
+        return None
+
+    ts_offset = Timestamp.from_str(segment.get("ts_offset", "0:0"))
+    segment_timerange = TimeRange.from_str(segment["timerange"])
+    if segment_timerange.start is None or segment_timerange.end is None:
+        return None
+
+    byte_range = gop_index.byte_range(
+        TimeRange(
+            segment_timerange.start - ts_offset,
+            segment_timerange.end - ts_offset,
+            segment_timerange.inclusivity
+        ),
+        TimeRange.from_str(segment["object_timerange"])
+    )
+    if byte_range is None:
+        return None
+
+    start_offset, end_offset, partial_timerange = byte_range
+    return (start_offset, end_offset, segment | {"object_timerange": str(partial_timerange)})
+
+
+async def prefetch_media_objects(
+    session: aiohttp.ClientSession,
+    segments: AsyncIterable[dict],
+    prefetch_count: int = DEFAULT_PREFETCH_COUNT,
+    max_prefetch_size: int = DEFAULT_MAX_PREFETCH_SIZE,
+    stream_buffer_size: Optional[int] = None,
+    cache: Optional[MediaObjectCache] = None,
+    url_selector: Optional[GetUrlSelector] = None,
+    gop_index_store: Optional[GopIndexStore] = None
+) -> AsyncGenerator[tuple[dict, MediaObject], None]:
+    """Generator of Flow Segment dicts along with their media object, in timeline order
+
+    Up to `prefetch_count` media objects are downloaded concurrently, ahead of the media object being
+    returned. This hides the latency of each download when fetching from remote object storage. Each media
+    object is downloaded from one of its `get_urls` chosen by the `url_selector`, see `GetUrlSelector`.
+
+    If `stream_buffer_size` is set then each media object is returned as a `StreamBuffer` of that size as soon
+    as the download starts, so that the media can be read whilst it is being downloaded. The memory used for
+    each media object is then limited to the buffer size. Otherwise each media object is downloaded
+    completely into a `BytesIO` before it is returned.
+
+    If a `cache` is given then media objects are read from it, instead of being downloaded, if present. Each
+    media object that is downloaded completely is added to the cache.
+
+    If a `gop_index_store` is given then the MPEG-TS media objects that are downloaded completely are indexed.
+    Where a segment only needs part of an indexed media object, only the GOPs covering the segment are
+    downloaded using a HTTP Range request. These are returned following the PAT and PMT packets, along with a
+    copy of the segment whose `object_timerange` is that of the GOPs.
+
+    The media objects waiting to be returned, and the last media object returned, are limited to a total of
+    `max_prefetch_size` bytes. Each download reserves its size (from the Content-Length, or the stream buffer
+    size if smaller) before reading the response body, in timeline order, so that the next media object to be
+    returned can always be downloaded. A single media object larger than the limit is still downloaded once
+    nothing else is held.
+    """
+    if url_selector is None:
+        url_selector = GetUrlSelector()
+
+    buffer_size = 0
+    buffer_changed = asyncio.Condition()
+
+    async def reserve(size: int) -> None:
+        nonlocal buffer_size
+        async with buffer_changed:
+            await buffer_changed.wait_for(lambda: buffer_size == 0 or buffer_size + size <= max_prefetch_size)
+            buffer_size += size
+
+    async def release(size: int) -> None:
+        nonlocal buffer_size
+        async with buffer_changed:
+            buffer_size -= size
+            buffer_changed.notify_all()
+
+    async def download(
+        segment: dict,
+        reserved_turn: asyncio.Future[int],
+        reserved: asyncio.Future[int],
+        media: asyncio.Future[tuple[dict, MediaObject]]
+    ) -> None:
+        """Download the media object, passing it (or any error) back through the `media` Future"""
+        try:
+            if cache is not None:
+                cached_media = await asyncio.to_thread(cache.open, segment["object_id"])
+                if cached_media is not None:
+                    # Cached media objects are read from disk rather than held in memory
+                    await reserved_turn
+                    reserved.set_result(0)
+                    media.set_result((segment, cached_media))
+                    return
+
+            gop_index = None
+            partial_segment = None
+            headers = {}
+            if gop_index_store is not None:
+                gop_index = await asyncio.to_thread(gop_index_store.get, segment["object_id"])
+                if gop_index is not None:
+                    partial_segment = get_partial_segment(segment, gop_index)
+                if partial_segment is not None:
+                    headers["Range"] = f"bytes={partial_segment[0]}-{partial_segment[1] - 1}"
+
+            async with url_selector.get(session, get_download_urls(segment), headers=headers) as resp:
+                # The Range header is ignored by servers that don't support it
+                prefix = b""
+                index_builder = None
+                if partial_segment is not None and resp.status == 206:
+                    assert gop_index is not None
+                    prefix = gop_index.psi
+                    segment = partial_segment[2]
+                    media_cache = None  # Only complete media objects are cached
+                else:
+                    if gop_index_store is not None and gop_index is None:
+                        index_builder = GopIndexBuilder()
+                    media_cache = cache
+
+                size = len(prefix) + (resp.content_length or 0)
+                if stream_buffer_size is not None:
+                    size = min(size, stream_buffer_size) if size > 0 else stream_buffer_size
+
+                # Reserve space in the buffer in timeline order, after the previous download
+                await reserved_turn
+                await reserve(size)
+                reserved.set_result(size)
+
+                if stream_buffer_size is None:
+                    data = await resp.read()
+                    media.set_result((segment, BytesIO(prefix + data)))
+                    if media_cache is not None:
+                        await asyncio.to_thread(media_cache.put, segment["object_id"], data)
+                    if index_builder is not None:
+                        await asyncio.to_thread(index_builder.feed, data)
+                        await asyncio.to_thread(store_index, segment["object_id"], index_builder)
+                    return
+
+                stream_buffer = StreamBuffer(stream_buffer_size)
+                media.set_result((segment, stream_buffer))
+                cache_writer = media_cache.writer(segment["object_id"]) if media_cache is not None else None
+                try:
+                    if prefix:
+                        await stream_buffer.write_async(prefix)
+                    async for chunk in resp.content.iter_any():
+                        if cache_writer is not None:
+                            cache_writer.write(chunk)
+                        if index_builder is not None:
+                            await asyncio.to_thread(index_builder.feed, chunk)
+                        if not await stream_buffer.write_async(chunk):
+                            break  # The reader no longer needs the data
+                    else:
+                        if cache_writer is not None:
+                            cache_writer.commit()
+                            cache_writer = None
+                        if index_builder is not None:
+                            await asyncio.to_thread(store_index, segment["object_id"], index_builder)
+                except Exception as e:
+                    stream_buffer.close_write(e)
+                else:
+                    stream_buffer.close_write()
+                finally:
+                    if cache_writer is not None:
+                        cache_writer.abort()
+        except Exception as e:
+            if not media.done():
+                media.set_exception(e)
+        finally:
+            if not reserved.done():
+                reserved.cancel()
+            if not media.done():
+                media.cancel()
+
+    def store_index(object_id: str, index_builder: GopIndexBuilder) -> None:
+        assert gop_index_store is not None
+        gop_index = index_builder.index()
+        if gop_index is not None:
+            gop_index_store.put(object_id, gop_index)
+
+    downloads: asyncio.Queue[Optional[tuple[asyncio.Task, asyncio.Future[int], asyncio.Future]]] = asyncio.Queue()
+    download_slots = asyncio.Semaphore(prefetch_count)
+
+    async def start_downloads() -> None:
+        loop = asyncio.get_running_loop()
+        reserved_turn: asyncio.Future[int] = loop.create_future()
+        reserved_turn.set_result(0)
+        try:
+            async for segment in segments:
+                await download_slots.acquire()
+                reserved = loop.create_future()
+                media = loop.create_future()
+                media_download = asyncio.create_task(download(segment, reserved_turn, reserved, media))
+                media_download.add_done_callback(lambda _: download_slots.release())
+                downloads.put_nowait((media_download, reserved, media))
+                reserved_turn = reserved
+        finally:
+            downloads.put_nowait(None)
+
+    producer = asyncio.create_task(start_downloads())
+    returned_size = 0
+    returned_media: Optional[MediaObject] = None
+    try:
+        while (queued := await downloads.get()) is not None:
+            media_download, reserved, media = queued
+
+            # The previous media object is no longer needed by the caller
+            if returned_media is not None:
+                returned_media.close()
+                returned_media = None
+            await release(returned_size)
+            returned_size = 0
+
+            segment, returned_media = await media
+            returned_size = reserved.result()
+
+            yield (segment, returned_media)
+
+        await producer  # Raises if getting the segments failed
+    finally:
+        producer.cancel()
+        if returned_media is not None:
+            returned_media.close()
+        while not downloads.empty():
+            queued = downloads.get_nowait()
+            if queued is not None:
+                queued[0].cancel()
+
+
+def mux_packets(
+    av_output: av.container.OutputContainer,
+    packets: queue.Queue[Optional[av.Packet]],
+    mux_failed: threading.Event
+) -> None:
+    """Mux the packets from the queue to the output until None is received
+
+    If muxing fails then `mux_failed` is set, so that `put_packet` stops waiting for space in the queue, and the
+    exception is raised straight away.
+    """
+    try:
+        while (pkt := packets.get()) is not None:
+            av_output.mux([pkt])
+    except Exception:
+        mux_failed.set()
+        raise
+
+
+def put_packet(
+    packets: queue.Queue[Optional[av.Packet]],
+    mux_failed: threading.Event,
+    pkt: Optional[av.Packet]
+) -> None:
+    """Put the packet on the queue read by `mux_packets`, raising an exception if muxing has failed"""
+    while not mux_failed.is_set():
+        try:
+            packets.put(pkt, timeout=PACKET_PUT_TIMEOUT)
+            return
+        except queue.Full:
+            pass
+
+    raise RuntimeError("Muxing the output has failed")
+
+
 async def outgest_file(
     tams_url: str,
     credentials: Credentials,
     flow_id: UUID,
     timerange: TimeRange,
     output_filename: str,
-    check_timing: bool
+    check_timing: bool,
+    prefetch_count: int = DEFAULT_PREFETCH_COUNT,
+    max_prefetch_size: int = DEFAULT_MAX_PREFETCH_SIZE,
+    packet_queue_size: int = DEFAULT_PACKET_QUEUE_SIZE,
+    stream_buffer_size: int = DEFAULT_STREAM_BUFFER_SIZE,
+    cache: Optional[MediaObjectCache] = None,
+    url_selector: Optional[GetUrlSelector] = None,
+    storage_ids: Optional[list[UUID]] = None,
+    gop_index_store: Optional[GopIndexStore] = None,
+    segment_lister: Optional[SegmentLister] = None
 ) -> TimeRange:
+    """Outgest the timerange of the Flow to a file
+
+    Up to `prefetch_count` media objects are downloaded concurrently, limited to `max_prefetch_size` bytes
+    in total. See `prefetch_media_objects`. MPEG-TS media objects are demuxed whilst they are being
+    downloaded, using a buffer of `stream_buffer_size` bytes per media object, unless it is set to 0. Other
+    containers are downloaded completely first because they may need to be read out of order.
+
+    If a `cache` is given then it is checked for each media object before downloading it. This avoids
+    downloading the same media object again, e.g. when outgesting an edit Flow that references the same
+    media objects multiple times, or when repeating an outgest.
+
+    Each media object is downloaded from the fastest healthy storage backend in its `get_urls`, limited to
+    the backends in `storage_ids` if given. See `GetUrlSelector`.
+
+    The segments are listed using the `segment_lister`, which adapts the page size to the response time of the
+    service and may list parts of a long timerange concurrently. Listing runs in the background, ahead of the
+    downloads, so that the latency of fetching each page of segments is hidden. See `SegmentLister`.
+
+    If a `gop_index_store` is given then MPEG-TS media objects are indexed when they are first downloaded, or
+    by `ingest_hls`, so that only the GOPs needed by segments using part of a media object are downloaded
+    subsequently, e.g. for the short segments of an interval edit made by `simple_edit`.
+
+    Each media object is demuxed and its timing normalised in a worker thread, which passes the packets
+    through a queue (of up to `packet_queue_size` packets) to a separate muxer thread. This allows demuxing
+    of the next media object to overlap with muxing, whilst the event loop is left to handle the downloads.
+    """
     flow = await get_flow(tams_url, credentials, flow_id)
 
     # Support is limited to Flows with MPEG-TS media objects containing audio or video
@@ -275,45 +620,392 @@ async def outgest_file(
     if flow["format"] not in ["urn:x-nmos:format:video", "urn:x-nmos:format:audio"]:
         raise NotImplementedError(f"Flow format '{flow['format']}' is not supported")
 
+    if url_selector is None:
+        url_selector = GetUrlSelector()
+
+    loop = asyncio.get_running_loop()
     output_timerange = TimeRange.never()
     with av.open(output_filename, mode="w") as av_output:
-        async with aiohttp.ClientSession(trust_env=True) as media_object_session:
-            async for segment in get_flow_segments(tams_url, credentials, flow, timerange):
-                try:
-                    download_url = segment["get_urls"][0]["url"]
-                except KeyError:
-                    raise ValueError("Unable to find download URL for segment "
-                                     f"{segment['object_id']} at {segment['timerange']}")
-
-                # Assuming the media object is small enough to load into memory. An alternative
-                # would be to use streaming responses, although that's complicated here as
-                # PyAV doesn't support async file / stream inputs.
-                # An optimisation would be to add some concurrency by fetching media objects
-                # in multiple asyncio tasks and to also use a queue + threads to parse and process
-                # the packets.
-                async with media_object_session.get(download_url) as resp:
-                    resp.raise_for_status()
-                    media_essence = BytesIO(await resp.read())
-
-                # Note: not passing timerange to discard media units outside the target timerange.
-                # This is because they may be needed for video precharge / audio priming or
-                # video rollout / audio remainder. The output may therefore have more media than
-                # that requested using the timerange.
-                # An alternative is to take the timerange into account and then deal with precharge etc.
-                # Formats such as MP4 could identify how much precharge etc. there is.
-
-                seg_output_timerange = await asyncio.get_running_loop().run_in_executor(
-                    None,
-                    normalise_and_transfer_media,
-                    flow,
-                    segment,
-                    media_essence,
-                    av_output,
-                    check_timing
+        packets: queue.Queue[Optional[av.Packet]] = queue.Queue(maxsize=packet_queue_size)
+        mux_failed = threading.Event()
+        muxer = loop.run_in_executor(None, mux_packets, av_output, packets, mux_failed)
+        try:
+            async with aiohttp.ClientSession(trust_env=True) as media_object_session:
+                # Non-MPEG-TS media objects are assumed to be small enough to load into memory
+                prefetched_segments = prefetch_media_objects(
+                    media_object_session,
+                    get_flow_segments(tams_url, credentials, flow, timerange, storage_ids, segment_lister),
+                    prefetch_count,
+                    max_prefetch_size,
+                    stream_buffer_size if flow["container"] == "video/mp2t" and stream_buffer_size > 0 else None,
+                    cache,
+                    url_selector,
+                    gop_index_store if flow["container"] == "video/mp2t" else None
+                )
+                async for segment, media_essence in prefetched_segments:
+                    # Stop early (re-raising the exception) if muxing has failed
+                    if muxer.done():
+                        await muxer
+
+                    # Note: not passing timerange to discard media units outside the target timerange.
+                    # This is because they may be needed for video precharge / audio priming or
+                    # video rollout / audio remainder. The output may therefore have more media than
+                    # that requested using the timerange.
+                    # An alternative is to take the timerange into account and then deal with precharge etc.
+                    # Formats such as MP4 could identify how much precharge etc. there is.
+
+                    seg_output_timerange = await loop.run_in_executor(
+                        None,
+                        normalise_and_transfer_media,
+                        flow,
+                        segment,
+                        media_essence,
+                        av_output,
+                        check_timing,
+                        functools.partial(put_packet, packets, mux_failed)
+                    )
+                    output_timerange = output_timerange.extend_to_encompass_timerange(seg_output_timerange)
+
+                    logger.info(f"Outgested flow segment at {segment['timerange']}")
+        finally:
+            # Wait for the muxer to finish before the output is closed. This raises the exception if muxing failed
+            try:
+                await loop.run_in_executor(None, put_packet, packets, mux_failed, None)
+            finally:
+                await muxer
+
+    url_selector.log_summary()
+    if cache is not None:
+        logger.info(f"Media object cache: {cache.hits} hits, {cache.misses} misses")
+    metrics.log_summary()
+
+    return output_timerange
+
+
+def split_timerange(timerange: TimeRange, segment_index: SegmentIndex, shard_count: int) -> list[TimeRange]:
+    """Split the timerange into up to `shard_count` contiguous timeranges, at segment boundaries
+
+    Each timerange contains a similar total duration of the segments in the `segment_index`. The timeranges
+    together cover the whole of `timerange`.
+    """
+    if not len(segment_index):
+        return [timerange]
+
+    total_duration = segment_index.duration_before(len(segment_index))
+
+    # Start a new shard at the first segment that starts after each fraction of the total duration
+    boundaries = [timerange.start]
+    previous_row = 0
+    for shard in range(1, shard_count):
+        row = max(segment_index.row_at_duration(-(-total_duration * shard // shard_count)), previous_row + 1)
+        if row >= len(segment_index):
+            break
+        boundaries.append(TimeRange.from_str(segment_index.segments[row]["timerange"]).start)
+        previous_row = row
+
+    shards = []
+    for index, start in enumerate(boundaries):
+        if index + 1 < len(boundaries):
+            end = boundaries[index + 1]
+            inclusivity = TimeRange.INCLUDE_START
+        else:
+            end = timerange.end
+            inclusivity = TimeRange.INCLUDE_START | (TimeRange.INCLUDE_END if timerange.includes_end() else 0)
+        if index == 0 and not timerange.includes_start():
+            inclusivity &= ~TimeRange.INCLUDE_START
+        shards.append(TimeRange(start, end, inclusivity))
+
+    return shards
+
+
+def run_outgest_file(*args: Any, **kwargs: Any) -> TimeRange:
+    """Run `outgest_file` in a worker process"""
+    return asyncio.run(outgest_file(*args, **kwargs))
+
+
+def concatenate_files(filenames: list[str], output_filename: str) -> None:
+    """Concatenate the files, each containing a single stream, by copying their packets to the output"""
+    with av.open(output_filename, mode="w") as av_output:
+        for filename in filenames:
+            with av.open(filename, mode="r") as av_input:
+                # Added whilst the input is open as the template stream must not be closed
+                if len(av_output.streams) == 0:
+                    av_output.add_stream_from_template(av_input.streams[0])
+
+                for pkt in av_input.demux(av_input.streams[0]):
+                    if pkt.dts is None and pkt.pts is None:
+                        continue  # Flush packet at the end of the stream
+                    pkt.stream = av_output.streams[0]
+                    av_output.mux([pkt])
+
+
+@dataclasses.dataclass
+class HlsPlaylistEntry:
+    """A HLS media segment: a local MPEG-TS filename or a URL, and its duration in seconds"""
+    uri: str
+    duration: float
+    discontinuity: bool = False
+
+
+def write_hls_playlist(filename: str, entries: list[HlsPlaylistEntry]) -> None:
+    """Write a VOD HLS playlist, with local filenames made relative to the playlist"""
+    playlist_dir = os.path.dirname(os.path.abspath(filename))
+    with open(filename, "w") as f:
+        f.write("#EXTM3U\n")
+        f.write("#EXT-X-VERSION:3\n")
+        f.write(f"#EXT-X-TARGETDURATION:{math.ceil(max((entry.duration for entry in entries), default=0))}\n")
+        f.write("#EXT-X-MEDIA-SEQUENCE:0\n")
+        f.write("#EXT-X-PLAYLIST-TYPE:VOD\n")
+        for entry in entries:
+            if entry.discontinuity:
+                f.write("#EXT-X-DISCONTINUITY\n")
+            f.write(f"#EXTINF:{entry.duration:.6f},\n")
+            if urlparse(entry.uri).scheme in ("http", "https"):
+                f.write(entry.uri + "\n")
+            else:
+                f.write(os.path.relpath(os.path.abspath(entry.uri), playlist_dir) + "\n")
+        f.write("#EXT-X-ENDLIST\n")
+
+
+async def sharded_outgest_file(
+    tams_url: str,
+    credentials: Credentials,
+    flow_id: UUID,
+    timerange: TimeRange,
+    output_filename: str,
+    check_timing: bool,
+    shard_count: int,
+    hls_output: bool = False,
+    shard_retries: int = DEFAULT_SHARD_RETRIES,
+    **outgest_kwargs: Any
+) -> TimeRange:
+    """Outgest the timerange of the Flow in `shard_count` shards, each outgested to a part file concurrently
+
+    The timerange is split at segment boundaries into shards with a similar duration of segments, see
+    `split_timerange`. Each shard is outgested using `outgest_file` (with `outgest_kwargs`) in its own
+    process, so that the demuxing and muxing is spread across CPU cores. Note that the limits such as
+    `max_prefetch_size` apply to each shard. A shard that fails is retried up to `shard_retries` times.
+
+    The part files are then concatenated to `output_filename`, or if `hls_output` is set then they are
+    kept as MPEG-TS files referenced by a HLS playlist written to `output_filename`.
+    """
+    flow = await get_flow(tams_url, credentials, flow_id)
+    segment_index = await SegmentIndex.from_listing(
+        get_flow_segments(tams_url, credentials, flow, timerange, segment_lister=outgest_kwargs.get("segment_lister"))
+    )
+    shard_timeranges = split_timerange(timerange, segment_index, shard_count)
+
+    output_base, output_ext = os.path.splitext(output_filename)
+    part_ext = ".ts" if hls_output else output_ext
+    part_filenames = [f"{output_base}_part{index:04d}{part_ext}" for index in range(len(shard_timeranges))]
+    logger.info(f"Outgesting {len(segment_index)} segments in {len(shard_timeranges)} shards")
+
+    loop = asyncio.get_running_loop()
+    completed_count = 0
+
+    async def outgest_shard(index: int, executor: ProcessPoolExecutor) -> TimeRange:
+        nonlocal completed_count
+        shard_name = f"Shard {index + 1}/{len(shard_timeranges)} ({shard_timeranges[index]!s})"
+        attempt = 0
+        while True:
+            start_time = time.monotonic()
+            try:
+                part_timerange = await loop.run_in_executor(executor, functools.partial(
+                    run_outgest_file,
+                    tams_url,
+                    credentials,
+                    flow_id,
+                    shard_timeranges[index],
+                    part_filenames[index],
+                    check_timing,
+                    **outgest_kwargs
+                ))
+                break
+            except Exception as e:
+                attempt += 1
+                if attempt > shard_retries:
+                    raise
+
+                logger.warning(f"{shard_name} failed ({e!r}). Retrying (attempt {attempt})")
+
+        completed_count += 1
+        logger.info(
+            f"{shard_name} outgested to {part_filenames[index]} in {time.monotonic() - start_time:.3f}s "
+            f"({completed_count} of {len(shard_timeranges)} shards complete)"
+        )
+        return part_timerange
+
+    with ProcessPoolExecutor(len(shard_timeranges)) as executor:
+        shard_tasks = [
+            asyncio.create_task(outgest_shard(index, executor)) for index in range(len(shard_timeranges))
+        ]
+        try:
+            part_timeranges = await asyncio.gather(*shard_tasks)
+        finally:
+            for task in shard_tasks:
+                task.cancel()
+
+    output_timerange = TimeRange.never()
+    for part_timerange in part_timeranges:
+        output_timerange = output_timerange.extend_to_encompass_timerange(part_timerange)
+
+    if hls_output:
+        write_hls_playlist(output_filename, [
+            HlsPlaylistEntry(part_filename, part_timerange.length.to_float())
+            for (part_filename, part_timerange) in zip(part_filenames, part_timeranges)
+        ])
+    else:
+        await loop.run_in_executor(None, concatenate_files, part_filenames, output_filename)
+        for part_filename in part_filenames:
+            os.remove(part_filename)
+
+    return output_timerange
+
+
+def segment_needs_trimming(segment: dict) -> bool:
+    """Returns True if the segment's timerange doesn't cover all of its media object"""
+    if "object_timerange" not in segment:
+        return False
+
+    ts_offset = Timestamp.from_str(segment.get("ts_offset", "0:0"))
+    segment_timerange = TimeRange.from_str(segment["timerange"])
+    object_timerange = TimeRange.from_str(segment["object_timerange"])
+    return (
+        object_timerange.start is None or object_timerange.end is None or
+        segment_timerange.start != object_timerange.start + ts_offset or
+        segment_timerange.end != object_timerange.end + ts_offset
+    )
+
+
+def retime_media_object(media_essence: MediaObject, filename: str, offset: int) -> None:
+    """Copy the MPEG-TS media object to the file, adding `offset` (in 90kHz units) to its timestamps"""
+    with open(filename, "wb") as f:
+        pending = bytearray()
+        while chunk := media_essence.read(RETIME_CHUNK_SIZE):
+            pending += chunk
+            data = pending[:len(pending) - len(pending) % TS_PACKET_SIZE]
+            del pending[:len(data)]
+
+            offset_mpegts_timestamps(data, offset)
+            f.write(data)
+
+        if pending:
+            raise ValueError("MPEG-TS media object is not a whole number of packets")
+
+
+def remux_segment(
+    flow: dict,
+    segment: dict,
+    media_essence: MediaObject,
+    filename: str,
+    check_timing: bool
+) -> TimeRange:
+    """Remux the segment's media to a MPEG-TS file, trimming and re-timing it as for `outgest_file`"""
+    with av.open(filename, mode="w", format="mpegts") as av_output:
+        return normalise_and_transfer_media(flow, segment, media_essence, av_output, check_timing)
+
+
+async def outgest_hls(
+    tams_url: str,
+    credentials: Credentials,
+    flow_id: UUID,
+    timerange: TimeRange,
+    output_filename: str,
+    check_timing: bool,
+    link_objects: bool = False,
+    prefetch_count: int = DEFAULT_PREFETCH_COUNT,
+    max_prefetch_size: int = DEFAULT_MAX_PREFETCH_SIZE,
+    stream_buffer_size: int = DEFAULT_STREAM_BUFFER_SIZE,
+    cache: Optional[MediaObjectCache] = None,
+    url_selector: Optional[GetUrlSelector] = None,
+    storage_ids: Optional[list[UUID]] = None,
+    gop_index_store: Optional[GopIndexStore] = None,
+    segment_lister: Optional[SegmentLister] = None
+) -> TimeRange:
+    """Outgest the timerange of a Flow with MPEG-TS media objects to a HLS playlist, without remuxing where possible
+
+    Each segment becomes a HLS media segment. Segments that use all of their media object are copied to a
+    MPEG-TS file with the `ts_offset` applied by rewriting the timestamps in the TS packet and PES headers.
+    Only segments that use part of their media object are remuxed, using `normalise_and_transfer_media`.
+    The files are named after the `output_filename` playlist.
+
+    If `link_objects` is set then the segments that use all of their media object aren't copied. Instead the
+    playlist references the media object in the `cache`, if present, or the preferred of its `get_urls`.
+    These keep their media timestamps, so a discontinuity is signalled wherever the `ts_offset` changes.
+    Note that pre-signed URLs expire and that cached media objects may be evicted.
+
+    The other arguments are as for `outgest_file`.
+    """
+    flow = await get_flow(tams_url, credentials, flow_id)
+    if flow.get("container") != "video/mp2t":
+        raise NotImplementedError("HLS outgest requires a Flow with MPEG-TS media objects")
+
+    if url_selector is None:
+        url_selector = GetUrlSelector()
+
+    output_base = os.path.splitext(output_filename)[0]
+    entries: list[HlsPlaylistEntry] = []
+    fetch_filenames: deque[str] = deque()
+    output_timerange = TimeRange.never()
+
+    async def segments_to_fetch() -> AsyncGenerator[dict, None]:
+        """Add each segment to the playlist, yielding those whose media object must be fetched"""
+        nonlocal output_timerange
+        previous: Optional[tuple[Optional[Timestamp], Timestamp]] = None
+        async for segment in get_flow_segments(tams_url, credentials, flow, timerange, storage_ids, segment_lister):
+            segment_timerange = TimeRange.from_str(segment["timerange"])
+            output_timerange = output_timerange.extend_to_encompass_timerange(segment_timerange)
+
+            fetch = not link_objects or segment_needs_trimming(segment)
+            if fetch:
+                uri = f"{output_base}_{len(entries):05d}.ts"
+                timeline_offset = Timestamp()  # Written on the Flow timeline
+            else:
+                cache_filename = cache.filename(segment["object_id"]) if cache is not None else None
+                uri = cache_filename or url_selector.order(get_download_urls(segment))[0]["url"]
+                timeline_offset = Timestamp.from_str(segment.get("ts_offset", "0:0"))
+
+            # Signal a discontinuity for a gap in the Flow or a jump in the media timestamps
+            discontinuity = previous is not None and previous != (segment_timerange.start, timeline_offset)
+            previous = (segment_timerange.end, timeline_offset)
+
+            entries.append(HlsPlaylistEntry(uri, segment_timerange.length.to_float(), discontinuity))
+            if fetch:
+                fetch_filenames.append(uri)
+                yield segment
+
+    loop = asyncio.get_running_loop()
+    async with aiohttp.ClientSession(trust_env=True) as media_object_session:
+        prefetched_segments = prefetch_media_objects(
+            media_object_session,
+            segments_to_fetch(),
+            prefetch_count,
+            max_prefetch_size,
+            stream_buffer_size if stream_buffer_size > 0 else None,
+            cache,
+            url_selector,
+            gop_index_store
+        )
+        async for segment, media_essence in prefetched_segments:
+            filename = fetch_filenames.popleft()
+            if segment_needs_trimming(segment):
+                await loop.run_in_executor(
+                    None, remux_segment, flow, segment, media_essence, filename, check_timing
                 )
-                output_timerange = output_timerange.extend_to_encompass_timerange(seg_output_timerange)
+                logger.info(f"Remuxed flow segment at {segment['timerange']} to {filename}")
+            else:
+                ts_offset = Timestamp.from_str(segment.get("ts_offset", "0:0"))
+                await loop.run_in_executor(
+                    None, retime_media_object, media_essence, filename, ts_offset.to_count(PTS_RATE)
+                )
+                logger.info(f"Copied flow segment at {segment['timerange']} to {filename}")
+
+    write_hls_playlist(output_filename, entries)
 
-                logger.info(f"Outgested flow segment at {segment['timerange']}")
+    url_selector.log_summary()
+    if cache is not None:
+        logger.info(f"Media object cache: {cache.hits} hits, {cache.misses} misses")
+    metrics.log_summary()
 
     return output_timerange
 
@@ -364,6 +1056,84 @@ if __name__ == "__main__":
         "--check-timing", action="store_true",
         help="Enable timing checks"
     )
+    parser.add_argument(
+        "--prefetch-count", type=int, default=DEFAULT_PREFETCH_COUNT,
+        help="Maximum number of media objects to download concurrently, ahead of them being written to the output"
+    )
+    parser.add_argument(
+        "--max-prefetch-size", type=int, default=DEFAULT_MAX_PREFETCH_SIZE // (1024 * 1024),
+        help="Maximum size in MiB of the downloaded media objects held in memory"
+    )
+    parser.add_argument(
+        "--stream-buffer-size", type=int, default=DEFAULT_STREAM_BUFFER_SIZE // (1024 * 1024),
+        help=("Size in MiB of the buffer used to demux each MPEG-TS media object whilst it is downloaded. "
+              "Set to 0 to download each media object completely before demuxing")
+    )
+    parser.add_argument(
+        "--cache-dir", type=str, default=None,
+        help="Directory in which to cache media objects, which are re-used instead of being downloaded again"
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+        help="Maximum size in MiB of the media object cache. The least recently used media objects are removed"
+    )
+    parser.add_argument(
+        "--cache-mmap", action="store_true",
+        help="Memory map the media objects read from the cache rather than reading them as files"
+    )
+    parser.add_argument(
+        "--gop-index-dir", type=str, default=None,
+        help=("Directory in which to store indexes of the GOPs in MPEG-TS media objects, which allow part of a "
+              "media object to be downloaded. Indexes can also be stored by ingest_hls")
+    )
+    parser.add_argument(
+        "--hedge-delay", type=int, default=int(DEFAULT_HEDGE_DELAY * 1000),
+        help=("Time in milliseconds to wait for a response to a media object download before also trying the "
+              "next URL, if the media object has multiple URLs. Set to 0 to disable")
+    )
+    parser.add_argument(
+        "--segment-page-limit", type=int, default=DEFAULT_PAGE_LIMIT,
+        help=("Initial number of segments requested per page when listing the Flow's segments, which is then "
+              "adapted to the response time of the service")
+    )
+    parser.add_argument(
+        "--segment-list-parallelism", type=int, default=1,
+        help="Split the timerange into this number of parts whose segments are listed concurrently"
+    )
+    parser.add_argument(
+        "--segment-read-ahead", type=int, default=DEFAULT_READ_AHEAD,
+        help=("Number of pages of segments to list ahead of the media object downloads, in the background. "
+              "Set to 0 to only list the next page once the previous page has been used")
+    )
+    parser.add_argument(
+        "--storage-ids", type=lambda ids: [UUID(storage_id) for storage_id in ids.split(",")], default=None,
+        help="Comma separated list of storage backend IDs to download media objects from. Default is all"
+    )
+
+    parser.add_argument(
+        "--shards", type=int, default=1,
+        help=("Split the timerange into this number of shards, at segment boundaries, which are outgested "
+              "concurrently in separate processes to part files and then concatenated")
+    )
+    parser.add_argument(
+        "--shard-hls", action="store_true",
+        help="Keep the MPEG-TS part files of the shards and write a HLS playlist referencing them to the output"
+    )
+    parser.add_argument(
+        "--shard-retries", type=int, default=DEFAULT_SHARD_RETRIES,
+        help="Number of times to retry the outgest of a shard that fails"
+    )
+
+    parser.add_argument(
+        "--hls-package", action="store_true",
+        help=("Write a HLS playlist to the output, copying each MPEG-TS media object with re-written timestamps "
+              "and only remuxing segments that use part of their media object")
+    )
+    parser.add_argument(
+        "--hls-link-objects", action="store_true",
+        help=("With --hls-package, reference the media objects in the cache (--cache-dir) or their URLs from the "
+              "playlist rather than copying them")
+    )
 
     args = parser.parse_args()
 
@@ -384,13 +1154,57 @@ if __name__ == "__main__":
     if args.timerange.end is not None:
         logger.info(f"Timerange end as UTC is {args.timerange.end.to_iso8601_utc()}")
 
-    output_timerange = asyncio.run(outgest_file(
-        args.tams_url.rstrip("/"),
-        credentials,
-        args.flow_id,
-        args.timerange,
-        args.output,
-        args.check_timing
-    ))
+    outgest_kwargs: dict[str, Any] = dict(
+        prefetch_count=args.prefetch_count,
+        max_prefetch_size=args.max_prefetch_size * 1024 * 1024,
+        stream_buffer_size=args.stream_buffer_size * 1024 * 1024,
+        cache=(
+            MediaObjectCache(args.cache_dir, args.cache_size * 1024 * 1024, use_mmap=args.cache_mmap)
+            if args.cache_dir is not None else None
+        ),
+        url_selector=GetUrlSelector(args.hedge_delay / 1000 if args.hedge_delay > 0 else None),
+        storage_ids=args.storage_ids,
+        gop_index_store=GopIndexStore(args.gop_index_dir) if args.gop_index_dir is not None else None,
+        segment_lister=SegmentLister(
+            args.segment_page_limit,
+            parallelism=args.segment_list_parallelism,
+            read_ahead=args.segment_read_ahead
+        )
+    )
+
+    if args.hls_package:
+        output_timerange = asyncio.run(outgest_hls(
+            args.tams_url.rstrip("/"),
+            credentials,
+            args.flow_id,
+            args.timerange,
+            args.output,
+            args.check_timing,
+            link_objects=args.hls_link_objects,
+            **outgest_kwargs
+        ))
+    elif args.shards > 1 or args.shard_hls:
+        output_timerange = asyncio.run(sharded_outgest_file(
+            args.tams_url.rstrip("/"),
+            credentials,
+            args.flow_id,
+            args.timerange,
+            args.output,
+            args.check_timing,
+            args.shards,
+            hls_output=args.shard_hls,
+            shard_retries=args.shard_retries,
+            **outgest_kwargs
+        ))
+    else:
+        output_timerange = asyncio.run(outgest_file(
+            args.tams_url.rstrip("/"),
+            credentials,
+            args.flow_id,
+            args.timerange,
+            args.output,
+            args.check_timing,
+            **outgest_kwargs
+        ))
 
     logger.info(f"Output timerange {output_timerange!s}")
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 # This script demonstrates a simple edit of 2 Flows using segment metadata only
 
+from typing import AsyncGenerator, AsyncIterator, Optional
+from contextlib import aclosing
 import asyncio
-from collections import deque
 import os
 import logging
 from argparse import ArgumentParser
@@ -14,7 +15,9 @@ from mediatimestamp import TimeRange, Timestamp
 import mediajson
 
 from utils.credentials import Credentials, BasicCredentials, OAuth2ClientCredentials
-from utils.client import post_request, put_request, get_request
+from utils.client import put_request, get_request, SegmentRegistrationBatcher
+from utils.segments import SegmentLister, DEFAULT_PAGE_LIMIT
+from utils.timeline import SegmentTable, timerange_to_counts, timestamp_to_count
 
 logging.basicConfig()
 logger = logging.getLogger()
@@ -72,14 +75,77 @@ async def get_segments(
     tams_url: str,
     flow_id: UUID,
     timerange: TimeRange
-) -> list[dict]:
-    """Fetch a single page of segments from the given Flow"""
-    async with get_request(
-        session,
-        credentials,
-        f"{tams_url}/flows/{flow_id}/segments?timerange={timerange!s}"
-    ) as resp:
-        return await resp.json()
+) -> AsyncGenerator[dict, None]:
+    """Generator of the segments from the given Flow, following all the pages
+
+    The pages are fetched in the background, a few pages ahead of the segments being used. See `SegmentLister`.
+    """
+    segment_lister = SegmentLister()
+    async for segment in segment_lister.segments(
+        session, credentials, f"{tams_url}/flows/{flow_id}/segments", timerange
+    ):
+        yield segment
+
+
+class SegmentStream:
+    """Wraps a generator of segments so that the next segment can be inspected before it is used"""
+    def __init__(self, segments: AsyncIterator[dict]) -> None:
+        self._segments = segments
+        self._next: Optional[dict] = None
+        self._exhausted = False
+
+    async def peek(self) -> Optional[dict]:
+        """Returns the next segment without using it, or None if there are no more segments"""
+        if self._next is None and not self._exhausted:
+            try:
+                self._next = await anext(self._segments)
+            except StopAsyncIteration:
+                self._exhausted = True
+        return self._next
+
+    def pop(self) -> None:
+        """Use the segment returned by `peek`"""
+        self._next = None
+
+
+class IntervalEditInput:
+    """The segments of an input to an interval edit that have been read but not yet cut, on the output timeline
+
+    The segments are read in chunks of up to `chunk_size` segments. All the segments that start before `read_to` on
+    the output timeline have been read. Once the input is `exhausted`, `read_to` is the end of its last segment.
+    """
+    def __init__(
+        self,
+        segments: SegmentStream,
+        edit_rate: Fraction,
+        timeshift: int,
+        chunk_size: int = DEFAULT_PAGE_LIMIT
+    ) -> None:
+        self.segments = segments
+        self.edit_rate = edit_rate
+        self.timeshift = timeshift
+        self.chunk_size = chunk_size
+        self.table = SegmentTable(edit_rate)
+        self.read_to = 0
+        self.exhausted = False
+
+    async def read(self) -> None:
+        """Read the next chunk of segments"""
+        chunk = []
+        while len(chunk) < self.chunk_size and (segment := await self.segments.peek()) is not None:
+            chunk.append(segment)
+            self.segments.pop()
+
+        chunk_table = SegmentTable.from_segments(chunk, self.edit_rate).offset(-self.timeshift)
+        self.table = SegmentTable.concat([self.table, chunk_table])
+
+        next_segment = await self.segments.peek()
+        if next_segment is not None:
+            next_start, _ = timerange_to_counts(TimeRange.from_str(next_segment["timerange"]), self.edit_rate)
+            self.read_to = max(self.read_to, next_start - self.timeshift)
+        else:
+            self.exhausted = True
+            self.read_to = max(self.read_to, self.table.end or 0)
 
 
 async def get_flow(
@@ -110,67 +176,57 @@ async def simple_edit(
     async with aiohttp.ClientSession(trust_env=True) as session:
         await put_flow(session, credentials, tams_url, output_flow_id, output_source_id)
 
-        # Add segments from input 1 to output
-        flow_1_segments = await get_segments(session, credentials, tams_url, input_1_flow_id, input_1_timerange)
-
-        for segment in flow_1_segments:
-            async with post_request(
-                session,
-                credentials,
-                f"{tams_url}/flows/{output_flow_id}/segments",
-                json=mediajson.encode_value({
+        # Segments are registered in bulk as they are only metadata
+        async with SegmentRegistrationBatcher(session, credentials, tams_url, output_flow_id) as segment_batcher:
+            # Add segments from input 1 to output
+            last_segment = None
+            async for segment in get_segments(session, credentials, tams_url, input_1_flow_id, input_1_timerange):
+                await segment_batcher.add(mediajson.encode_value({
                     "object_id": segment["object_id"],
                     "timerange": segment["timerange"]
-                })
-            ) as resp:
+                }))
                 print(f"Added segment from Flow {input_1_flow_id} from and to timerange {segment['timerange']}")
-
-        # Add segments from input 2 to output after the input 1 segments
-        if flow_1_segments:
-            seg_tr = TimeRange.from_str(segment["timerange"])
-            if seg_tr.includes_end():
-                part_2_offset = seg_tr.end + Timestamp.from_count(1, Fraction(FLOW_FRAME_RATE))
+                last_segment = segment
+
+            # Add segments from input 2 to output after the input 1 segments
+            if last_segment is not None:
+                seg_tr = TimeRange.from_str(last_segment["timerange"])
+                if seg_tr.includes_end():
+                    part_2_offset = seg_tr.end + Timestamp.from_count(1, Fraction(FLOW_FRAME_RATE))
+                else:
+                    part_2_offset = seg_tr.end
             else:
-                part_2_offset = seg_tr.end
-        else:
-            part_2_offset = Timestamp(0)
-
-        flow_2_segments = await get_segments(session, credentials, tams_url, input_2_flow_id, input_2_timerange)
-
-        seg_tr_offset = None
-        for segment in flow_2_segments:
-            seg_tr = TimeRange.from_str(segment["timerange"])
-
-            # Calculate the offset to place the segment on the output flow timeline starting
-            # at `part_2_offset`
-            if seg_tr_offset is None:
-                seg_tr_offset = part_2_offset - seg_tr.start
-
-            new_seg_tr = TimeRange(
-                seg_tr.start + seg_tr_offset,
-                seg_tr.end + seg_tr_offset,
-                seg_tr.inclusivity
-            )
-
-            # The media timeline started at zero when the ingest started, so `ts_offset` indicates what must be
-            # added to the media time to get the Flow time.
-            # So we can calculate media time at the start of the segment
-            seg_offset = Timestamp.from_str(segment.get("ts_offset", "0:0"))
-            media_time = seg_tr.start - seg_offset
-
-            # Now we want to know what to add to that media time to get the new start time
-            new_ts_offset = new_seg_tr.start - media_time
-
-            async with post_request(
-                session,
-                credentials,
-                f"{tams_url}/flows/{output_flow_id}/segments",
-                json=mediajson.encode_value({
+                part_2_offset = Timestamp(0)
+
+            seg_tr_offset = None
+            async for segment in get_segments(session, credentials, tams_url, input_2_flow_id, input_2_timerange):
+                seg_tr = TimeRange.from_str(segment["timerange"])
+
+                # Calculate the offset to place the segment on the output flow timeline starting
+                # at `part_2_offset`
+                if seg_tr_offset is None:
+                    seg_tr_offset = part_2_offset - seg_tr.start
+
+                new_seg_tr = TimeRange(
+                    seg_tr.start + seg_tr_offset,
+                    seg_tr.end + seg_tr_offset,
+                    seg_tr.inclusivity
+                )
+
+                # The media timeline started at zero when the ingest started, so `ts_offset` indicates what must be
+                # added to the media time to get the Flow time.
+                # So we can calculate media time at the start of the segment
+                seg_offset = Timestamp.from_str(segment.get("ts_offset", "0:0"))
+                media_time = seg_tr.start - seg_offset
+
+                # Now we want to know what to add to that media time to get the new start time
+                new_ts_offset = new_seg_tr.start - media_time
+
+                await segment_batcher.add(mediajson.encode_value({
                     "object_id": segment["object_id"],
                     "timerange": new_seg_tr,
                     "ts_offset": new_ts_offset
-                })
-            ) as resp:
+                }))
                 print(f"Added segment from Flow {input_2_flow_id} and timerange "
                       "{segment['timerange']} to {new_seg_tr!s}")
 
@@ -188,7 +244,11 @@ async def interval_edit(
     output_source_id: UUID,
     cut_interval_sec: float
 ) -> None:
-    """Cut between inputs 1 and 2 at fixed interval. Note: this will only handle a single page of segments"""
+    """Cut between inputs 1 and 2 at fixed interval
+
+    The segments of both inputs are read lazily, a page at a time, so that long inputs are edited in constant
+    memory and output segments are registered whilst the later input pages are still being fetched.
+    """
     cut_interval_ts = Timestamp.from_millisec(int(cut_interval_sec * 1000))
 
     edit_rate = Fraction(FLOW_FRAME_RATE, 1)
@@ -198,93 +258,52 @@ async def interval_edit(
         "_copy_edit_interval": cut_interval_ts.to_sec_nsec()
     }
 
-    async with aiohttp.ClientSession(trust_env=True) as session:
+    async with (
+        aiohttp.ClientSession(trust_env=True) as session,
+        aclosing(get_segments(session, credentials, tams_url, input_1_flow_id, input_1_timerange)) as input_1_segments,
+        aclosing(get_segments(session, credentials, tams_url, input_2_flow_id, input_2_timerange)) as input_2_segments,
+        SegmentRegistrationBatcher(session, credentials, tams_url, output_flow_id) as segment_batcher
+    ):
         # Create output Flow
         await put_flow(session, credentials, tams_url, output_flow_id, output_source_id, custom_tags=custom_tags)
 
-        flow_1_segments = deque(await get_segments(session, credentials, tams_url, input_1_flow_id, input_1_timerange))
-        flow_2_segments = deque(await get_segments(session, credentials, tams_url, input_2_flow_id, input_2_timerange))
-        working_time = Timestamp.from_str("0:0")
-
-        next_switch_at = working_time + cut_interval_ts
-
-        current_seg = {
-            "id": input_1_flow_id,
-            "list": flow_1_segments,
-            "timeshift": input_1_timerange.start
-        }
-        other_seg = {
-            "id": input_2_flow_id,
-            "list": flow_2_segments,
-            "timeshift": input_2_timerange.start
-        }
-
-        while (len(flow_1_segments) > 0 and len(flow_2_segments) > 0):
-            position_in_flow_timeline = working_time + current_seg["timeshift"]
-
-            # Draw a segment from the current list (and drop segments if we've passed them)
-            next_seg = current_seg["list"][0]
-            next_seg_tr = TimeRange.from_str(next_seg["timerange"]).normalise(edit_rate.numerator,
-                                                                              edit_rate.denominator)
-            if next_seg_tr.ends_earlier_than_timerange(position_in_flow_timeline):
-                print(f"Segment {next_seg_tr} is before current position {position_in_flow_timeline} - dropping")
-                current_seg["list"].popleft()
-                continue
-
-            next_seg_ts_offset = Timestamp.from_str(next_seg.get("ts_offset", "0:0"))
-
-            # Work out how many seconds into the underlying segment we start
-            seg_start_offset = (working_time + current_seg["timeshift"]) - next_seg_tr.start
-
-            # Work out how much of the segment to include in the output
-            segment_length_remaining = next_seg_tr.end - position_in_flow_timeline
-            remaining_time_in_cut = next_switch_at - working_time
-
-            # Note that for non-integer media rates this simple approach may lead to rounding anomalies
-            # however this approach is used to keep the example simple.
-            if (remaining_time_in_cut < segment_length_remaining):
-                # Rest of this cut fits in the current segment, so we can write a new segment
-                new_seg_tr = TimeRange(working_time, next_switch_at, TimeRange.INCLUDE_START)
-            else:
-                # We need to add all of the rest of this segment,
-                # and then some more of the next one before cutting
-                new_seg_tr = TimeRange.from_start_length(working_time, segment_length_remaining,
-                                                         TimeRange.INCLUDE_START)
-
-            # Note that `sample_offset` and `sample_count` are deprecated but still set for backwards compatibility.
-            # They have been replaced by `object_timerange`.
-            # As this is referencing an existing Object, `object_timerange` will already be set against the Object and
-            # will not need setting here.
-            # When `sample_offset` and `sample_count` are dropped from the spec, they will be deleted here.
-            new_segment = {
-                "object_id": next_seg["object_id"],
-                "timerange": new_seg_tr,
-                "ts_offset": next_seg_ts_offset - current_seg["timeshift"],
-                "sample_offset": seg_start_offset.to_count(edit_rate.numerator, edit_rate.denominator),
-                "sample_count": new_seg_tr.length.to_count(edit_rate.numerator, edit_rate.denominator)
-            }
-
-            async with post_request(
-                session,
-                credentials,
-                f"{tams_url}/flows/{output_flow_id}/segments",
-                json=mediajson.encode_value(new_segment)
-            ) as resp:
-                print(f"Added segment from Flow {current_seg['id']} and timerange {next_seg_tr} to {new_seg_tr!s}")
-
-            # Advance our time pointer
-            working_time = new_seg_tr.end
-
-            if (remaining_time_in_cut <= segment_length_remaining):
-                # We've finished this cut, so swap to the other Flow
-                past_seg = current_seg
-                current_seg = other_seg
-                other_seg = past_seg
-
-                next_switch_at += cut_interval_ts
-            else:
-                # Drop the fully consumed segment
-                current_seg["list"].popleft()
+        # Segments are fetched, a few pages ahead, once the first segment of each input is needed. Each input's
+        # timeline is shifted so that the start of its timerange is at sample 0 on the output timeline
+        interval = cut_interval_ts.to_count(edit_rate.numerator, edit_rate.denominator)
+        inputs = [
+            IntervalEditInput(SegmentStream(segments), edit_rate, timestamp_to_count(input_timerange.start, edit_rate))
+            for segments, input_timerange in [
+                (input_1_segments, input_1_timerange),
+                (input_2_segments, input_2_timerange)
+            ]
+        ]
+        for edit_input in inputs:
+            await edit_input.read()
+
+        # Cut `k` takes the samples from `k * interval` up to `(k + 1) * interval` on the output timeline from input
+        # `k % 2`. The cuts are made in bulk up to the point that the segments of both inputs have been read, and then
+        # more segments are read from the input(s) holding up the edit
+        position = 0
+        while True:
+            end = min(edit_input.read_to for edit_input in inputs)
+            if end > position:
+                # The sample counts are exact, so the cuts line up without rounding anomalies at any edit rate.
+                # As this is referencing an existing Object, `object_timerange` will already be set against the Object
+                # and will not need setting here.
+                cut_table = SegmentTable.interval_cut([edit_input.table for edit_input in inputs], interval)
+                for new_segment in cut_table.window(position, end).to_segments():
+                    await segment_batcher.add(mediajson.encode_value(new_segment))
+                    print(f"Added segment from object {new_segment['object_id']} to {new_segment['timerange']!s}")
+
+                for edit_input in inputs:
+                    edit_input.table = edit_input.table.window(start=end)
+                position = end
+
+            if any(edit_input.exhausted and edit_input.read_to <= position for edit_input in inputs):
+                break
+            for edit_input in inputs:
+                if edit_input.read_to <= position:
+                    await edit_input.read()
 
         print(f"At least one Flow segment list exhausted: stopping writing output {output_flow_id}")
 
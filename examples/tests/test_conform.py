@@ -0,0 +1,115 @@
+from fractions import Fraction
+from uuid import UUID
+import json
+
+from mediatimestamp import Timestamp, TimeRange
+import pytest
+
+from conform import EditEvent, load_edl, parse_cut_list, parse_otio
+from utils.timeline import counts_to_timerange, timerange_to_counts
+
+FLOW_ID = UUID("1f4b7b0e-8d3a-4a4f-9d0e-0a6c1f9e2b3c")
+
+
+def make_clip(start_ns: int, duration: int, rate: float, target_url: str = f"tams://tams.example.com/flows/{FLOW_ID}",
+              enabled: bool = True) -> dict:
+    return {
+        "OTIO_SCHEMA": "Clip.2",
+        "name": "clip",
+        "enabled": enabled,
+        "media_references": {
+            "DEFAULT_MEDIA": {"OTIO_SCHEMA": "ExternalReference.1", "target_url": target_url}
+        },
+        "active_media_reference_key": "DEFAULT_MEDIA",
+        "source_range": {
+            "OTIO_SCHEMA": "TimeRange.1",
+            "start_time": {"OTIO_SCHEMA": "RationalTime.1", "value": start_ns, "rate": 1000000000},
+            "duration": {"OTIO_SCHEMA": "RationalTime.1", "value": duration, "rate": rate}
+        }
+    }
+
+
+def make_gap(duration: int, rate: float) -> dict:
+    return {
+        "OTIO_SCHEMA": "Gap.1",
+        "source_range": {
+            "OTIO_SCHEMA": "TimeRange.1",
+            "start_time": {"OTIO_SCHEMA": "RationalTime.1", "value": 0, "rate": rate},
+            "duration": {"OTIO_SCHEMA": "RationalTime.1", "value": duration, "rate": rate}
+        }
+    }
+
+
+def make_timeline(items: list[dict]) -> dict:
+    return {
+        "OTIO_SCHEMA": "Timeline.1",
+        "tracks": {
+            "OTIO_SCHEMA": "Stack.1",
+            "children": [{"OTIO_SCHEMA": "Track.1", "kind": "Video", "children": items}]
+        }
+    }
+
+
+def test_parse_cut_list():
+    events, edit_rate = parse_cut_list({
+        "edit_rate": "30000/1001",
+        "events": [
+            {"flow_id": str(FLOW_ID), "timerange": "[10:0_20:0)"},
+            {"gap": "1:0"}
+        ]
+    })
+
+    assert edit_rate == Fraction(30000, 1001)
+    assert events == [
+        EditEvent(FLOW_ID, TimeRange.from_str("[10:0_20:0)")),
+        EditEvent(None, duration=Timestamp.from_str("1:0"))
+    ]
+
+
+def test_parse_cut_list_without_edit_rate():
+    assert parse_cut_list({"events": []}) == ([], None)
+
+
+def test_parse_otio():
+    events, edit_rate = parse_otio(make_timeline([
+        make_clip(10_000_000_000, 50, 25.0),
+        make_gap(25, 25.0),
+        make_clip(30_000_000_000, 25, 25.0, enabled=False)
+    ]))
+
+    assert edit_rate == Fraction(25)
+    assert events == [
+        EditEvent(FLOW_ID, TimeRange.from_str("[10:0_12:0)")),
+        EditEvent(None, duration=Timestamp.from_str("1:0")),
+        EditEvent(None, duration=Timestamp.from_str("1:0"))
+    ]
+
+
+def test_parse_otio_snaps_float_rate():
+    # Sample-aligned 30000/1001 timeranges around a TAI timestamp in 2022
+    rate = Fraction(30000, 1001)
+    for start in range(50_000_000_000, 50_000_000_300, 7):
+        source_timerange = counts_to_timerange(start, start + 100, rate)
+        events, edit_rate = parse_otio(make_timeline([
+            make_clip(source_timerange.start.to_nanosec(), 100, 30000 / 1001)
+        ]))
+
+        assert edit_rate == rate
+        assert events[0].source_timerange.start == source_timerange.start
+        assert timerange_to_counts(events[0].source_timerange, edit_rate) == (start, start + 100)
+
+
+def test_parse_otio_rejects_unsupported_items():
+    with pytest.raises(ValueError):
+        parse_otio(make_timeline([{"OTIO_SCHEMA": "Transition.1", "name": "dissolve"}]))
+
+    with pytest.raises(ValueError):
+        parse_otio(make_timeline([make_clip(0, 25, 25.0, target_url="https://example.com/media.mxf")]))
+
+
+def test_load_edl_otio_timestamps_are_exact(tmp_path):
+    filename = tmp_path / "edit.otio"
+    filename.write_text(json.dumps(make_timeline([make_clip(1668333433_299866666, 100, 30000 / 1001)])))
+
+    events, _ = load_edl(str(filename))
+    assert events[0].source_timerange.start == Timestamp.from_str("1668333433:299866666")
@@ -0,0 +1,88 @@
+from flow_report import TimelineReport
+
+
+def make_segment(timerange: str, ts_offset: str = "0:0") -> dict:
+    return {"object_id": "object", "timerange": timerange, "ts_offset": ts_offset}
+
+
+# Segments with a gap at 20, an overlap at 35 and a ts_offset change at 60
+SEGMENTS = [
+    make_segment("[0:0_10:0)"),
+    make_segment("[10:0_20:0)"),
+    make_segment("[25:0_40:0)"),
+    make_segment("[35:0_50:0)"),
+    make_segment("[50:0_60:0)"),
+    make_segment("[60:0_70:0)", "10:0"),
+    make_segment("[70:0_80:0)", "10:0")
+]
+
+
+def report_of(segments: list[dict], max_issues: int = 100) -> TimelineReport:
+    report = TimelineReport(max_issues)
+    for segment in segments:
+        report.add(segment)
+    return report
+
+
+def test_contiguous_segments():
+    report = report_of(SEGMENTS[:2]).to_json()
+    assert report["segment_count"] == 2
+    assert report["segments_timerange"] == "[0:0_20:0)"
+    assert report["coverage"] == 1.0
+    assert report["gap_count"] == 0
+    assert report["overlap_count"] == 0
+    assert report["ts_offset_discontinuity_count"] == 0
+
+
+def test_gaps_overlaps_and_discontinuities():
+    report = report_of(SEGMENTS).to_json()
+    assert report["segment_count"] == 7
+    assert report["segments_timerange"] == "[0:0_80:0)"
+    assert report["covered_duration"] == "75:0"
+    assert report["coverage"] == 75 / 80
+    assert report["gaps"] == ["[20:0_25:0)"]
+    assert report["gap_duration"] == "5:0"
+    assert report["overlaps"] == ["[35:0_40:0)"]
+    assert report["overlap_duration"] == "5:0"
+    assert report["ts_offset_discontinuities"] == [{"at": "60:0", "from_ts_offset": "0:0", "to_ts_offset": "10:0"}]
+
+
+def test_inclusive_end_is_contiguous():
+    report = report_of([make_segment("[0:0_10:0]"), make_segment("(10:0_20:0)")]).to_json()
+    assert report["gap_count"] == 0
+    assert report["overlap_count"] == 0
+
+
+def test_max_issues_limits_listed_issues():
+    segments = [make_segment(f"[{start}:0_{start + 1}:0)") for start in range(0, 20, 2)]
+    report = report_of(segments, max_issues=3).to_json()
+    assert report["gap_count"] == 9
+    assert len(report["gaps"]) == 3
+
+
+def test_empty_report():
+    assert TimelineReport().to_json() == {"segment_count": 0}
+
+
+def test_extend_matches_single_report():
+    expected = report_of(SEGMENTS).to_json()
+    for split in range(len(SEGMENTS) + 1):
+        report = report_of(SEGMENTS[:split])
+        report.extend(report_of(SEGMENTS[split:]))
+        assert report.to_json() == expected, f"Shard boundary before segment {split}"
+
+
+def test_extend_multiple_shards():
+    expected = report_of(SEGMENTS).to_json()
+    report = TimelineReport()
+    for start in range(0, len(SEGMENTS), 2):
+        report.extend(report_of(SEGMENTS[start:start + 2]))
+    assert report.to_json() == expected
+
+
+def test_extend_limits_listed_issues():
+    segments = [make_segment(f"[{start}:0_{start + 1}:0)") for start in range(0, 20, 2)]
+    report = report_of(segments[:5], max_issues=3)
+    report.extend(report_of(segments[5:], max_issues=3))
+    assert report.gap_count == 9
+    assert report.gaps == ["[1:0_2:0)", "[3:0_4:0)", "[5:0_6:0)"]
@@ -0,0 +1,181 @@
+from fractions import Fraction
+
+from mediatimestamp import Timestamp, TimeRange
+import av
+import numpy as np
+import pytest
+
+from utils.mpegts import (
+    GopIndexBuilder,
+    GopIndexStore,
+    PTS_RATE,
+    PTS_ROLLOVER,
+    TS_PACKET_SIZE,
+    build_gop_index,
+    extract_mpegts_timerange,
+    offset_mpegts_timestamps
+)
+
+FRAME_RATE = 25
+GOP_SIZE = 10
+FRAME_COUNT = 50
+
+
+def write_mpegts(filename: str, frame_count: int = FRAME_COUNT, start_frame: int = 0) -> None:
+    """Write an H.264 MPEG-TS with B-frames, so that the PTS and DTS differ, and a fixed GOP size"""
+    with av.open(filename, "w", format="mpegts") as output:
+        stream = output.add_stream(
+            "libx264", rate=FRAME_RATE, options={"x264-params": f"keyint={GOP_SIZE}:scenecut=0:bframes=2"}
+        )
+        stream.width = 64
+        stream.height = 64
+        stream.pix_fmt = "yuv420p"
+        for index in range(frame_count):
+            frame = av.VideoFrame.from_ndarray(np.full((64, 64, 3), index * 5 % 256, dtype=np.uint8), format="rgb24")
+            frame.pts = start_frame + index
+            frame.time_base = Fraction(1, FRAME_RATE)
+            output.mux(stream.encode(frame))
+        output.mux(stream.encode())
+
+
+def demux_packets(filename: str) -> list[av.Packet]:
+    with av.open(filename, "r") as input:
+        return [packet for packet in input.demux() if packet.pts is not None]
+
+
+def demux_timerange(filename: str) -> TimeRange:
+    """Returns the timerange from demuxing every packet, as `ingest_hls.PacketTimeRange` does"""
+    packets = demux_packets(filename)
+    start = min(packet.pts * packet.time_base for packet in packets)
+    end = max((packet.pts + packet.duration) * packet.time_base for packet in packets)
+    return TimeRange(
+        Timestamp.from_count(start * PTS_RATE, PTS_RATE),
+        Timestamp.from_count(end * PTS_RATE, PTS_RATE),
+        TimeRange.INCLUDE_START
+    )
+
+
+@pytest.fixture
+def mpegts_file(tmp_path) -> str:
+    filename = str(tmp_path / "segment.ts")
+    write_mpegts(filename)
+    return filename
+
+
+def test_extract_timerange_matches_demux(mpegts_file):
+    timerange = extract_mpegts_timerange(mpegts_file)
+    assert timerange is not None
+    assert timerange == demux_timerange(mpegts_file)
+    assert timerange.length == Timestamp.from_count(FRAME_COUNT, FRAME_RATE)
+
+
+def test_extract_timerange_matches_demux_at_later_start(tmp_path):
+    filename = str(tmp_path / "segment.ts")
+    write_mpegts(filename, frame_count=23, start_frame=1000)
+    assert extract_mpegts_timerange(filename) == demux_timerange(filename)
+
+
+def test_extract_timerange_not_mpegts(tmp_path):
+    filename = tmp_path / "segment.ts"
+    filename.write_bytes(b"\x00" * 188 * 4)
+    assert extract_mpegts_timerange(str(filename)) is None
+
+
+def test_gop_index_offsets_are_keyframes(mpegts_file):
+    index = build_gop_index(mpegts_file)
+    assert index is not None
+
+    keyframes = [(packet.pos, packet.pts) for packet in demux_packets(mpegts_file) if packet.is_keyframe]
+    assert len(keyframes) == FRAME_COUNT // GOP_SIZE
+    assert index.gops == keyframes
+    with open(mpegts_file, "rb") as f:
+        assert index.size == len(f.read())
+
+
+def test_gop_index_in_small_chunks(mpegts_file):
+    with open(mpegts_file, "rb") as f:
+        data = f.read()
+
+    builder = GopIndexBuilder()
+    for pos in range(0, len(data), 100):
+        builder.feed(data[pos:pos + 100])
+    assert builder.index() == build_gop_index(mpegts_file)
+
+
+def test_gop_index_byte_range_demuxes(mpegts_file, tmp_path):
+    index = build_gop_index(mpegts_file)
+    assert index is not None
+    object_timerange = extract_mpegts_timerange(mpegts_file)
+    assert object_timerange is not None
+
+    # The timerange of the 3rd GOP (frames 20 to 29) starts and ends inside the 2nd and 4th GOPs
+    timerange = TimeRange(
+        object_timerange.start + Timestamp.from_count(15, FRAME_RATE),
+        object_timerange.start + Timestamp.from_count(35, FRAME_RATE),
+        TimeRange.INCLUDE_START
+    )
+    byte_range = index.byte_range(timerange, object_timerange)
+    assert byte_range is not None
+    start_offset, end_offset, gops_timerange = byte_range
+    assert (start_offset, end_offset) == (index.gops[1][0], index.gops[4][0])
+    assert gops_timerange == TimeRange(
+        Timestamp.from_count(index.gops[1][1], PTS_RATE),
+        Timestamp.from_count(index.gops[4][1], PTS_RATE),
+        TimeRange.INCLUDE_START
+    )
+
+    # The PAT and PMT followed by the byte range can be demuxed on its own
+    with open(mpegts_file, "rb") as f:
+        data = f.read()
+    part_filename = tmp_path / "part.ts"
+    part_filename.write_bytes(index.psi + data[start_offset:end_offset])
+    packets = demux_packets(str(part_filename))
+    assert packets[0].is_keyframe
+    assert len(packets) == 3 * GOP_SIZE
+    assert demux_timerange(str(part_filename)) == gops_timerange
+
+    # The complete object only skips the PAT and PMT before the first GOP
+    assert index.byte_range(object_timerange, object_timerange) == (index.gops[0][0], index.size, object_timerange)
+
+
+def test_gop_index_store(mpegts_file, tmp_path):
+    index = build_gop_index(mpegts_file)
+    assert index is not None
+
+    store = GopIndexStore(str(tmp_path / "indexes"))
+    assert store.get("object/1") is None
+    store.put("object/1", index)
+    assert store.get("object/1") == index
+
+
+def test_offset_timestamps_across_rollover(mpegts_file, tmp_path):
+    with open(mpegts_file, "rb") as f:
+        data = bytearray(f.read())
+    original = bytes(data)
+    packets = demux_packets(mpegts_file)
+
+    # Move the 25th frame (in decode order) to the 33-bit rollover, so the timestamps wrap in the middle of the file
+    offset = PTS_ROLLOVER - packets[25].dts
+    offset_mpegts_timestamps(data, offset)
+    retimed_filename = tmp_path / "retimed.ts"
+    retimed_filename.write_bytes(data)
+
+    retimed_packets = demux_packets(str(retimed_filename))
+    assert len(retimed_packets) == len(packets)
+    assert any(packet.pts < offset for packet in retimed_packets)
+    for packet, retimed_packet in zip(packets, retimed_packets):
+        assert retimed_packet.pos == packet.pos
+        assert (retimed_packet.pts - packet.pts - offset) % PTS_ROLLOVER == 0
+        assert (retimed_packet.dts - packet.dts - offset) % PTS_ROLLOVER == 0
+
+    # The fast path isn't used for timestamps around the rollover
+    assert extract_mpegts_timerange(str(retimed_filename)) is None
+
+    # Offsetting back restores the original timestamps, including the PCR
+    offset_mpegts_timestamps(data, -offset)
+    assert data == original
+
+
+def test_offset_timestamps_partial_packet():
+    with pytest.raises(ValueError):
+        offset_mpegts_timestamps(bytearray(TS_PACKET_SIZE + 1), 0)
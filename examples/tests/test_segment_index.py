@@ -0,0 +1,106 @@
+import random
+
+from mediatimestamp import Timestamp, TimeRange
+
+from utils.segment_index import SegmentIndex, end_position, positions_to_timerange, start_position
+
+
+def make_segment(object_id: str, timerange: str) -> dict:
+    return {"object_id": object_id, "timerange": timerange}
+
+
+def object_ids(segments: list[dict]) -> list[str]:
+    return [segment["object_id"] for segment in segments]
+
+
+def test_positions_round_trip():
+    for timerange in ["[1:0_2:0)", "(1:0_2:0]", "[1:0_2:0]", "(1:0_2:0)", "_2:0)", "[1:0_", "_"]:
+        timerange = TimeRange.from_str(timerange)
+        assert positions_to_timerange(start_position(timerange), end_position(timerange)) == timerange
+
+
+def test_overlapping_and_at():
+    index = SegmentIndex([
+        make_segment("a", "[0:0_10:0)"),
+        make_segment("b", "[10:0_20:0)"),
+        make_segment("c", "[25:0_30:0)")
+    ])
+
+    assert object_ids(index.overlapping(TimeRange.from_str("[5:0_12:0)"))) == ["a", "b"]
+    assert object_ids(index.overlapping(TimeRange.from_str("[20:0_25:0)"))) == []
+    assert object_ids(index.overlapping(TimeRange.from_str("[20:0_25:0]"))) == ["c"]
+    assert object_ids(index.at(Timestamp.from_str("10:0"))) == ["b"]
+    assert object_ids(index.at(Timestamp.from_str("22:0"))) == []
+
+
+def test_overlapping_long_segment():
+    # A long segment overlaps queries after segments that start later
+    index = SegmentIndex([
+        make_segment("long", "[0:0_100:0)"),
+        make_segment("a", "[10:0_20:0)"),
+        make_segment("b", "[30:0_40:0)")
+    ])
+
+    assert object_ids(index.overlapping(TimeRange.from_str("[50:0_60:0)"))) == ["long"]
+    assert object_ids(index.at(Timestamp.from_str("35:0"))) == ["long", "b"]
+
+
+def test_out_of_order_add():
+    index = SegmentIndex([make_segment("b", "[10:0_20:0)"), make_segment("c", "[20:0_30:0)")])
+    index.add(make_segment("a", "[0:0_10:0)"))
+
+    assert object_ids(index.segments) == ["a", "b", "c"]
+    assert object_ids(index.overlapping(TimeRange.from_str("[5:0_15:0)"))) == ["a", "b"]
+    assert index.timerange == TimeRange.from_str("[0:0_30:0)")
+    assert index.duration_before(2) == 20_000_000_000
+
+
+def test_overlapping_matches_scan():
+    rng = random.Random(1)
+    segments = []
+    for index in range(200):
+        start = rng.randrange(0, 1000)
+        segments.append(make_segment(str(index), f"[{start}:0_{start + rng.randrange(1, 50)}:0)"))
+
+    index = SegmentIndex()
+    for segment in rng.sample(segments, len(segments)):
+        index.add(segment)
+
+    for _ in range(200):
+        start = rng.randrange(0, 1000)
+        timerange = TimeRange.from_str(f"[{start}:0_{start + rng.randrange(0, 100)}:0)")
+        expected = {
+            segment["object_id"] for segment in segments
+            if TimeRange.from_str(segment["timerange"]).overlaps_with_timerange(timerange)
+        }
+        assert set(object_ids(index.overlapping(timerange))) == expected
+
+
+def test_gaps():
+    index = SegmentIndex([
+        make_segment("a", "[0:0_10:0)"),
+        make_segment("b", "[5:0_15:0)"),
+        make_segment("c", "[20:0_30:0]")
+    ])
+
+    assert index.gaps() == [TimeRange.from_str("[15:0_20:0)")]
+    assert index.gaps(TimeRange.from_str("[10:0_40:0)")) == [
+        TimeRange.from_str("[15:0_20:0)"),
+        TimeRange.from_str("(30:0_40:0)")
+    ]
+    assert SegmentIndex().gaps(TimeRange.from_str("[0:0_1:0)")) == [TimeRange.from_str("[0:0_1:0)")]
+
+
+def test_row_at_duration():
+    index = SegmentIndex([
+        make_segment("a", "[0:0_10:0)"),
+        make_segment("b", "[10:0_15:0)"),
+        make_segment("c", "[15:0_30:0)")
+    ])
+
+    assert index.row_at_duration(0) == 0
+    assert index.row_at_duration(5_000_000_000) == 1
+    assert index.row_at_duration(10_000_000_000) == 1
+    assert index.row_at_duration(12_000_000_000) == 2
+    assert index.row_at_duration(15_000_000_000) == 2
+    assert index.row_at_duration(40_000_000_000) == 3
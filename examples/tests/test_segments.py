@@ -0,0 +1,86 @@
+from collections import Counter
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from mediatimestamp import TimeRange
+import aiohttp
+
+from utils.credentials import EmptyCredentials
+from utils.segments import SegmentLister
+
+SEGMENT_COUNT = 80
+PAGE_LIMIT = 2
+
+
+class PagedSegments:
+    """A segments endpoint with a 1 second segment per second, returned in pages of up to `PAGE_LIMIT` segments"""
+    def __init__(self) -> None:
+        self.pages_served: Counter[str] = Counter()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        timerange = TimeRange.from_str(request.query["timerange"])
+        limit = min(int(request.query["limit"]), PAGE_LIMIT)
+        page = int(request.query.get("page", "0"))
+
+        segments = [
+            {"object_id": str(index), "timerange": f"[{index}:0_{index + 1}:0)"}
+            for index in range(SEGMENT_COUNT)
+            if TimeRange.from_str(f"[{index}:0_{index + 1}:0)").overlaps_with_timerange(timerange)
+        ]
+        headers = {"X-Paging-Limit": str(limit)}
+        if page + limit < len(segments):
+            headers["Link"] = f'<{request.url.update_query(page=str(page + limit))}>; rel="next"'
+
+        await asyncio.sleep(0.01)
+        self.pages_served[str(timerange)] += 1
+        return web.json_response(segments[page:page + limit], headers=headers)
+
+
+async def list_segments(lister: SegmentLister, timerange: TimeRange) -> tuple[list[dict], PagedSegments, Counter]:
+    endpoint = PagedSegments()
+    app = web.Application()
+    app.router.add_get("/segments", endpoint.handle)
+
+    segments = []
+    served_at_last_sub_timerange: Counter = Counter()
+    last_sub_timerange = lister.split_timerange(timerange)[-1]
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        async for segment in lister.segments(session, EmptyCredentials(), str(server.make_url("/segments")), timerange):
+            if TimeRange.from_str(segment["timerange"]).overlaps_with_timerange(last_sub_timerange):
+                if not served_at_last_sub_timerange:
+                    served_at_last_sub_timerange = Counter(endpoint.pages_served)
+            else:
+                await asyncio.sleep(0.01)  # Process the segments slower than they are listed
+            segments.append(segment)
+
+    return (segments, endpoint, served_at_last_sub_timerange)
+
+
+def test_segments_in_timeline_order():
+    lister = SegmentLister(limit=PAGE_LIMIT, min_limit=1)
+    segments, _, _ = asyncio.run(list_segments(lister, TimeRange.from_str("[10:0_30:0)")))
+    assert [segment["object_id"] for segment in segments] == [str(index) for index in range(10, 30)]
+
+
+def test_parallel_segments_in_timeline_order_once():
+    lister = SegmentLister(limit=PAGE_LIMIT, min_limit=1, parallelism=4)
+    segments, _, _ = asyncio.run(list_segments(lister, TimeRange.from_str("[0:500000000_80:0)")))
+    assert [segment["object_id"] for segment in segments] == [str(index) for index in range(SEGMENT_COUNT)]
+
+
+def test_sub_timeranges_listed_concurrently():
+    timerange = TimeRange.from_str(f"[0:0_{SEGMENT_COUNT}:0)")
+    lister = SegmentLister(limit=PAGE_LIMIT, min_limit=1, parallelism=4, read_ahead=1)
+    sub_timeranges = lister.split_timerange(timerange)
+    assert len(sub_timeranges) == 4
+
+    _, endpoint, served = asyncio.run(list_segments(lister, timerange))
+
+    # The later sub-timeranges have been listed completely by the time the consumer reaches the last one, rather
+    # than stopping after `read_ahead` pages each until the earlier sub-timeranges have been consumed
+    pages_per_sub_timerange = SEGMENT_COUNT // len(sub_timeranges) // PAGE_LIMIT
+    for sub_timerange in sub_timeranges:
+        assert endpoint.pages_served[str(sub_timerange)] == pages_per_sub_timerange
+    for sub_timerange in sub_timeranges[1:]:
+        assert served[str(sub_timerange)] == pages_per_sub_timerange
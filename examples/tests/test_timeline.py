@@ -0,0 +1,142 @@
+from fractions import Fraction
+import random
+
+from mediatimestamp import Timestamp, TimeRange
+
+from utils.timeline import (
+    SegmentTable,
+    count_to_nanosec,
+    count_to_timestamp,
+    counts_to_timerange,
+    timerange_to_counts,
+    timestamp_to_count
+)
+
+NTSC_RATE = Fraction(30000, 1001)
+
+# A sample count at 30000/1001 around a TAI timestamp in 2022
+TAI_COUNT = 50_000_000_000
+
+
+def make_segment(object_id: str, timerange: str, ts_offset: str = "0:0") -> dict:
+    return {"object_id": object_id, "timerange": timerange, "ts_offset": ts_offset}
+
+
+def test_count_to_nanosec_matches_timestamp():
+    for count in [0, 1, 2, 1001, -1, -1001, TAI_COUNT, -TAI_COUNT]:
+        assert count_to_nanosec(count, NTSC_RATE) == count_to_timestamp(count, NTSC_RATE).to_nanosec()
+
+
+def test_timestamp_to_count_is_exact_at_ntsc_rate():
+    for count in range(TAI_COUNT, TAI_COUNT + 3000):
+        timestamp = count_to_timestamp(count, NTSC_RATE)
+        assert timestamp_to_count(timestamp, NTSC_RATE) == count
+        assert timestamp_to_count(timestamp, NTSC_RATE, inclusive=False) == count + 1
+
+
+def test_timestamp_to_count_between_samples():
+    timestamp = Timestamp.from_nanosec(count_to_nanosec(TAI_COUNT, NTSC_RATE) + 1)
+    assert timestamp_to_count(timestamp, NTSC_RATE) == TAI_COUNT + 1
+
+
+def test_timerange_counts_round_trip():
+    for start in range(TAI_COUNT, TAI_COUNT + 300, 7):
+        timerange = counts_to_timerange(start, start + 5, NTSC_RATE)
+        assert timerange_to_counts(timerange, NTSC_RATE) == (start, start + 5)
+        assert counts_to_timerange(*timerange_to_counts(timerange, NTSC_RATE), NTSC_RATE) == timerange
+
+
+def test_timerange_to_counts_inclusive_end():
+    timerange = TimeRange(count_to_timestamp(10, NTSC_RATE), count_to_timestamp(14, NTSC_RATE), TimeRange.INCLUSIVE)
+    assert timerange_to_counts(timerange, NTSC_RATE) == (10, 15)
+
+
+def test_window_trims_and_drops_segments():
+    table = SegmentTable.from_segments([
+        make_segment("a", "[0:0_1:0)"),
+        make_segment("b", "[1:0_2:0)"),
+        make_segment("c", "[2:0_3:0)")
+    ], Fraction(25))
+
+    window = table.window(30, 50)
+    assert list(window.object_ids) == ["b"]
+    assert list(window.starts) == [30]
+    assert list(window.ends) == [50]
+    assert len(table) == 3
+
+
+def test_offset_keeps_source_samples():
+    table = SegmentTable.from_segments([make_segment("a", "[1:0_2:0)")], Fraction(25)).offset(-25)
+    assert list(table.starts) == [0]
+    assert list(table.ends) == [25]
+    assert list(table.shifts) == [25]
+
+    segment = table.to_segments()[0]
+    assert segment["timerange"] == TimeRange.from_str("[0:0_1:0)")
+    assert segment["ts_offset"] == Timestamp.from_str("-1:0")
+    assert segment["sample_offset"] == 0
+    assert segment["sample_count"] == 25
+
+
+def test_interval_cut_alternates_inputs():
+    rate = Fraction(25)
+    tables = [
+        SegmentTable.from_segments([make_segment("a1", "[0:0_2:0)"), make_segment("a2", "[2:0_4:0)")], rate),
+        SegmentTable.from_segments([make_segment("b1", "[10:0_14:0)")], rate).offset(-250)
+    ]
+
+    output = SegmentTable.interval_cut(tables, 30)
+    assert list(output.object_ids) == ["a1", "b1", "a2", "b1"]
+    assert list(output.starts) == [0, 30, 60, 90]
+    assert list(output.ends) == [30, 60, 90, 100]
+
+    segments = output.to_segments()
+    assert [segment["sample_offset"] for segment in segments] == [0, 30, 10, 90]
+    assert segments[1]["ts_offset"] == Timestamp.from_str("-10:0")
+
+
+def test_interval_cut_is_exact_at_ntsc_rate():
+    start = TAI_COUNT
+    segments = [
+        make_segment(f"s{index}", str(counts_to_timerange(start + 10 * index, start + 10 * (index + 1), NTSC_RATE)))
+        for index in range(30)
+    ]
+    tables = [SegmentTable.from_segments(segments, NTSC_RATE).offset(-start) for _ in range(2)]
+
+    segments = SegmentTable.interval_cut(tables, 7).to_segments()
+    assert segments[0]["timerange"].start == Timestamp()
+    assert segments[0]["ts_offset"] == Timestamp.from_nanosec(-count_to_nanosec(start, NTSC_RATE))
+    for previous, segment in zip(segments, segments[1:]):
+        assert previous["timerange"].end == segment["timerange"].start
+    assert segments[-1]["timerange"] == counts_to_timerange(294, 300, NTSC_RATE)
+
+
+def test_interval_cut_matches_sample_scan():
+    rng = random.Random(1)
+    rate = Fraction(25)
+    tables = []
+    for index in range(3):
+        segments = []
+        start = rng.randrange(-20, 20)
+        for row in range(20):
+            length = rng.randrange(1, 30)
+            segments.append(make_segment(f"{index}-{row}", f"[{start / 25}_{(start + length) / 25})"))
+            start += length + rng.randrange(-5, 5)
+        tables.append(SegmentTable.from_segments(segments, rate))
+
+    interval = 7
+    output = SegmentTable.interval_cut(tables, interval)
+    assert list(output.starts) == sorted(output.starts)
+
+    # Each sample is taken from the segment(s) covering it in the table for its interval
+    expected = set()
+    for index, table in enumerate(tables):
+        for object_id, start, end in zip(table.object_ids, table.starts, table.ends):
+            expected.update(
+                (object_id, int(sample)) for sample in range(start, end) if (sample // interval) % len(tables) == index
+            )
+    output_samples = set()
+    for object_id, start, end in zip(output.object_ids, output.starts, output.ends):
+        assert start // interval == (end - 1) // interval
+        output_samples.update((object_id, int(sample)) for sample in range(start, end))
+    assert output_samples == expected
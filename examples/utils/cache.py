@@ -0,0 +1,180 @@
+# This file provides a local on-disk cache of media objects, keyed by object ID.
+# TAMS media objects are immutable, so a cached media object never needs to be revalidated.
+
+from typing import Optional
+from collections import OrderedDict
+from io import BufferedReader
+from urllib.parse import quote
+import logging
+import mmap
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+TEMP_FILE_SUFFIX = ".tmp"
+
+
+class MediaObjectCache:
+    """A size-bounded, least recently used cache of media objects in a local directory
+
+    Each media object is stored in a file named after its (quoted) object ID. Files are written to a
+    temporary file in the same directory and then renamed, so that a partially written media object is never
+    read from the cache. When the total size exceeds `max_size` bytes the least recently used media objects
+    are deleted. The cache directory can be shared between runs, in which case the existing files are
+    ordered by their modification time, which is updated whenever a media object is read.
+
+    The number of cache `hits` and `misses` are counted by `open`. The methods may be called from multiple
+    threads. Multiple processes may share the directory, but each one limits the size independently.
+    """
+    def __init__(self, directory: str, max_size: int, use_mmap: bool = False) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.use_mmap = use_mmap
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        for entry in os.scandir(directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(TEMP_FILE_SUFFIX):
+                # Left behind by an interrupted write
+                os.unlink(entry.path)
+                continue
+            stat = entry.stat()
+            existing.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, name, size in sorted(existing):
+            self._entries[name] = size
+            self._size += size
+        self._evict()
+
+        if self._entries:
+            logger.info(f"Media object cache {directory} holds {len(self._entries)} media objects ({self._size} bytes)")
+
+    def __reduce__(self) -> tuple:
+        # Re-opened from the directory when passed to another process, e.g. for a sharded outgest
+        return (MediaObjectCache, (self.directory, self.max_size, self.use_mmap))
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _evict(self) -> None:
+        """Delete the least recently used media objects until the cache size is within `max_size`"""
+        while self._size > self.max_size and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.unlink(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def open(self, object_id: str) -> Optional[BufferedReader | mmap.mmap]:
+        """Returns the cached media object opened for reading, or None if it isn't in the cache
+
+        The media object is memory mapped if `use_mmap` is set. The caller is responsible for closing it.
+        """
+        name = quote(object_id, safe="")
+        with self._lock:
+            if name not in self._entries:
+                self.misses += 1
+                return None
+
+            try:
+                fp = open(self._path(name), "rb")
+            except FileNotFoundError:
+                # Deleted from outside this cache
+                self._size -= self._entries.pop(name)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(name)
+            size = self._entries[name]
+            os.utime(fp.fileno())
+            self.hits += 1
+
+        if not self.use_mmap or size == 0:
+            return fp  # An empty file can't be memory mapped
+
+        with fp:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def filename(self, object_id: str) -> Optional[str]:
+        """Returns the filename of the cached media object, or None if it isn't in the cache
+
+        This counts as a use of the media object, as for `open`. Note that the file will be deleted if the
+        media object is later evicted from the cache.
+        """
+        media_object = self.open(object_id)
+        if media_object is None:
+            return None
+
+        media_object.close()
+        return self._path(quote(object_id, safe=""))
+
+    def writer(self, object_id: str) -> "MediaObjectCacheWriter":
+        """Returns a writer that adds the media object to the cache once it is committed"""
+        return MediaObjectCacheWriter(self, quote(object_id, safe=""))
+
+    def put(self, object_id: str, data: bytes) -> None:
+        """Add the media object data to the cache"""
+        writer = self.writer(object_id)
+        try:
+            writer.write(data)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+
+    def _add(self, name: str, temp_path: str, size: int) -> None:
+        with self._lock:
+            if size > self.max_size:
+                os.unlink(temp_path)
+                return
+
+            os.replace(temp_path, self._path(name))
+            self._size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            self._evict()
+
+
+class MediaObjectCacheWriter:
+    """Writes a media object to a temporary file, which is added to the cache by `commit`
+
+    A writer that isn't committed must be aborted to delete the temporary file.
+    """
+    def __init__(self, cache: MediaObjectCache, name: str) -> None:
+        self._cache = cache
+        self._name = name
+        self._size = 0
+        self._fp = tempfile.NamedTemporaryFile(
+            dir=cache.directory, prefix=f".{name}.", suffix=TEMP_FILE_SUFFIX, delete=False
+        )
+
+    def write(self, data: bytes) -> None:
+        self._fp.write(data)
+        self._size += len(data)
+
+    def commit(self) -> None:
+        try:
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+            self._fp.close()
+            self._cache._add(self._name, self._fp.name, self._size)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self) -> None:
+        self._fp.close()
+        try:
+            os.unlink(self._fp.name)
+        except FileNotFoundError:
+            pass
@@ -1,14 +1,19 @@
 # This file provides functions to make HTTP requests to the TAMS API.
 # The functions include a retry on authentication failures when using renewable credentials.
 
+import asyncio
 import dataclasses
-from typing import AsyncGenerator, Optional
+import logging
+from typing import AsyncGenerator, Callable, Optional
 from contextlib import asynccontextmanager
+from uuid import UUID
 
 import aiohttp
 import aiohttp.client_exceptions
+from mediatimestamp import TimeRange
 
 from .credentials import Credentials, RenewableCredentials
+from .metrics import metrics
 
 
 @dataclasses.dataclass
@@ -23,6 +28,17 @@ class TAMSClientException(Exception):
         return f"{type(self).__name__}({self.error.__repr__}, body={self.body})"
 
 
+@dataclasses.dataclass
+class TAMSSegmentRegistrationException(Exception):
+    failed_segments: list[dict]
+
+    def __str__(self) -> str:
+        return f"Failed to register {len(self.failed_segments)} segment(s): {self.failed_segments}"
+
+
+logger = logging.getLogger(__name__)
+
+
 @asynccontextmanager
 async def request(
     session: aiohttp.ClientSession,
@@ -91,7 +107,7 @@ async def post_request(
     session: aiohttp.ClientSession,
     credentials: Credentials,
     url: str,
-    json: dict = {},
+    json: dict | list = {},
     raise_on_error: bool = True,
     **kwargs
 ) -> AsyncGenerator[aiohttp.ClientResponse, None]:
@@ -111,3 +127,154 @@ async def delete_request(
     """Execute a DELETE request and retry once if there is a credentials failure"""
     async with request(session, credentials, "DELETE", url, raise_on_error=raise_on_error, **kwargs) as resp:
         yield resp
+
+
+class SegmentRegistrationBatcher:
+    """Registers Flow Segments in bulk using a list body on the Flow segments endpoint
+
+    Segments are collected until `max_segments` have been added or `max_delay` seconds have passed since
+    the first segment was added, and are then POSTed in a single request. If the service responds with a
+    partial failure then only the failed segments are retried, up to `max_retries` times.
+
+    The batcher should be used as an async context manager so that any remaining segments are flushed.
+
+    The optional `on_registered` callback is called with the list of segments that have been registered
+    after each successful request.
+    """
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        credentials: Credentials,
+        tams_url: str,
+        flow_id: UUID,
+        max_segments: int = 100,
+        max_delay: float = 1.0,
+        max_retries: int = 3,
+        retry_delay: float = 0.5,
+        on_registered: Optional[Callable[[list[dict]], None]] = None
+    ) -> None:
+        self.session = session
+        self.credentials = credentials
+        self.segments_url = f"{tams_url}/flows/{flow_id}/segments"
+        self.max_segments = max_segments
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.on_registered = on_registered
+
+        self._pending: list[dict] = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_timer: Optional[asyncio.Task] = None
+        self._timer_error: Optional[BaseException] = None
+
+    async def __aenter__(self) -> "SegmentRegistrationBatcher":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.flush()
+
+    async def add(self, segment: dict) -> None:
+        """Add a (JSON encoded) segment to the next batch, flushing the batch if it is full"""
+        self._raise_timer_error()
+
+        self._pending.append(segment)
+        metrics.gauge("registration_queue_depth", len(self._pending))
+        if len(self._pending) >= self.max_segments:
+            await self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.create_task(self._flush_after_delay())
+
+    async def flush(self) -> None:
+        """Register all the pending segments"""
+        if self._flush_timer is not None and self._flush_timer is not asyncio.current_task():
+            self._flush_timer.cancel()
+        self._flush_timer = None
+
+        async with self._flush_lock:
+            # Segments may have been added whilst waiting for a previous flush to complete
+            while self._pending:
+                segments = self._pending[:self.max_segments]
+                self._pending = self._pending[self.max_segments:]
+                await self._register_segments(segments)
+
+        self._raise_timer_error()
+
+    async def _register_segments(self, segments: list[dict]) -> None:
+        """Register the segments in a single request, retrying any failed segments"""
+        attempt = 0
+        while segments:
+            failed_segments = await self._post_segments(segments)
+            retry_segments = self._match_failed_segments(segments, failed_segments)
+            if len(retry_segments) < len(failed_segments):
+                # It isn't known which of the submitted segments failed, so none can be assumed to be registered
+                raise TAMSSegmentRegistrationException(failed_segments)
+
+            if self.on_registered is not None:
+                self.on_registered([
+                    segment for segment in segments
+                    if not any(segment is retry_segment for retry_segment in retry_segments)
+                ])
+
+            if not failed_segments:
+                break
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise TAMSSegmentRegistrationException(failed_segments)
+
+            segments = retry_segments
+            metrics.count("register_retries", len(segments))
+            logger.warning(f"Retrying registration of {len(segments)} failed segment(s) (attempt {attempt})")
+            await asyncio.sleep(self.retry_delay * 2**(attempt - 1))
+
+    async def _post_segments(self, segments: list[dict]) -> list[dict]:
+        """POST the segments and return the list of failed segments from a partial failure response"""
+        with metrics.timed("register", url=self.segments_url, segments=len(segments)) as fields:
+            async with post_request(self.session, self.credentials, self.segments_url, json=segments) as resp:
+                # Context manager will raise on failure
+                if resp.status == 200:
+                    failure = await resp.json()
+                    failed_segments = failure.get("failed_segments", [])
+                else:
+                    logger.info(f"Registered {len(segments)} segment(s) at {self.segments_url}")
+                    failed_segments = []
+            fields["failed_segments"] = len(failed_segments)
+
+        metrics.count("segments_registered", len(segments) - len(failed_segments))
+        return failed_segments
+
+    @staticmethod
+    def _match_failed_segments(segments: list[dict], failed_segments: list[dict]) -> list[dict]:
+        """Return the submitted segments that match the failed segments in a partial failure response
+
+        Segments are matched on `object_id` and, if given, `timerange` because the same Object can be
+        used in multiple segments.
+        """
+        matched = []
+        for segment in segments:
+            for failed_segment in failed_segments:
+                if segment["object_id"] != failed_segment["object_id"]:
+                    continue
+                if "timerange" in failed_segment and (
+                        TimeRange.from_str(str(segment["timerange"])) !=
+                        TimeRange.from_str(failed_segment["timerange"])):
+                    continue
+
+                matched.append(segment)
+                break
+
+        return matched
+
+    async def _flush_after_delay(self) -> None:
+        await asyncio.sleep(self.max_delay)
+        try:
+            await self.flush()
+        except Exception as e:
+            # Raise the error in the next call to `add` or `flush`
+            self._timer_error = e
+
+    def _raise_timer_error(self) -> None:
+        if self._timer_error is not None:
+            e = self._timer_error
+            self._timer_error = None
+            raise e
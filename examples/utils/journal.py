@@ -0,0 +1,127 @@
+# This file provides a local journal of ingest progress, allowing an interrupted ingest to be resumed.
+
+from typing import Any, Optional
+import dataclasses
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class JournalSegment:
+    """A segment whose media object has been uploaded, along with whether it has been registered"""
+    key: str
+    segment: dict[str, Any]
+    registered: bool = False
+
+
+class IngestJournal:
+    """An append-only journal of the progress of an ingest into a Flow
+
+    Each step is written as a JSON line and flushed to disk before the ingest continues:
+
+    * `start`: the Flow and Source IDs that the ingest is writing to
+    * `allocated`: media objects allocated by the TAMS, along with their `put_url`
+    * `uploaded`: a segment media file (identified by a key) uploaded to a media object, with the segment
+      to be registered
+    * `registered`: media objects that have been registered as Flow segments
+
+    When an existing journal is opened it is replayed to find the segments that have been completed, the
+    segments that were uploaded but not registered, and the media objects that were allocated but not used.
+    A partially written line at the end of the journal (e.g. following a crash) is ignored.
+    """
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.flow_id: Optional[str] = None
+        self.source_id: Optional[str] = None
+        self.segments: dict[str, JournalSegment] = {}
+
+        self._allocated: dict[str, tuple[dict[str, Any], float]] = {}
+        self._object_keys: dict[str, str] = {}
+
+        valid_length = 0
+        if os.path.exists(filename):
+            with open(filename, "rb") as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Ignoring incomplete record at the end of journal {filename}")
+                        break
+                    self._replay(record)
+                    valid_length += len(line)
+
+            if self.segments or self._allocated:
+                logger.info(
+                    f"Resuming from journal {filename}: {len(self.segments)} segments uploaded, "
+                    f"{len(self.unregistered_segments())} waiting to be registered"
+                )
+
+        self._fp = open(filename, "ab")
+        self._fp.truncate(valid_length)
+
+    def _replay(self, record: dict[str, Any]) -> None:
+        match record["event"]:
+            case "start":
+                self.flow_id = record["flow_id"]
+                self.source_id = record["source_id"]
+            case "allocated":
+                for object_url in record["media_objects"]:
+                    self._allocated[object_url["object_id"]] = (object_url, record["time"])
+            case "uploaded":
+                self._allocated.pop(record["segment"]["object_id"], None)
+                self.segments[record["key"]] = JournalSegment(record["key"], record["segment"])
+                self._object_keys[record["segment"]["object_id"]] = record["key"]
+            case "registered":
+                for object_id in record["object_ids"]:
+                    if object_id in self._object_keys:
+                        self.segments[self._object_keys[object_id]].registered = True
+
+    def _append(self, record: dict[str, Any]) -> None:
+        self._fp.write(json.dumps(record).encode() + b"\n")
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def close(self) -> None:
+        self._fp.close()
+
+    def start(self, flow_id: str, source_id: str) -> None:
+        """Record the Flow and Source being ingested, checking that they match an existing journal"""
+        if self.flow_id is None:
+            self.flow_id = flow_id
+            self.source_id = source_id
+            self._append({"event": "start", "flow_id": flow_id, "source_id": source_id})
+        elif self.flow_id != flow_id:
+            raise ValueError(f"Journal {self.filename} is for Flow {self.flow_id}, not Flow {flow_id}")
+
+    def unused_media_objects(self, max_age: float) -> list[dict[str, Any]]:
+        """Returns the allocated media objects that haven't been used and were allocated within `max_age` seconds
+
+        Older media objects are not returned because their pre-signed URLs may have expired.
+        """
+        now = time.time()
+        return [object_url for (object_url, allocated_at) in self._allocated.values() if now - allocated_at < max_age]
+
+    def unregistered_segments(self) -> list[JournalSegment]:
+        """Returns the segments that were uploaded but not registered"""
+        return [segment for segment in self.segments.values() if not segment.registered]
+
+    def allocated(self, media_objects: list[dict[str, Any]]) -> None:
+        self._append({"event": "allocated", "time": time.time(), "media_objects": media_objects})
+        for object_url in media_objects:
+            self._allocated[object_url["object_id"]] = (object_url, time.time())
+
+    def uploaded(self, key: str, segment: dict[str, Any]) -> None:
+        self._append({"event": "uploaded", "key": key, "segment": segment})
+        self._allocated.pop(segment["object_id"], None)
+        self.segments[key] = JournalSegment(key, segment)
+        self._object_keys[segment["object_id"]] = key
+
+    def registered(self, segments: list[dict[str, Any]]) -> None:
+        self._append({"event": "registered", "object_ids": [segment["object_id"] for segment in segments]})
+        for segment in segments:
+            if segment["object_id"] in self._object_keys:
+                self.segments[self._object_keys[segment["object_id"]]].registered = True
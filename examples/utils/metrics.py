@@ -0,0 +1,102 @@
+# This file provides a simple way to collect metrics about the stages of an ingest or outgest.
+# Metrics are recorded against the module level `metrics` instance, which can write them to a JSON lines file
+# and log a summary of the timings at the end of a run.
+
+from typing import Any, Generator, Optional, TextIO
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    """Returns the nearest-rank percentile of the (sorted) values"""
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Metrics:
+    """Collects timings, counters and gauges, identified by name
+
+    * timings record how long each instance of a stage took, e.g. the upload of a single media object
+    * counters accumulate values such as the number of bytes uploaded or retries
+    * gauges sample values such as queue depths, of which the maximum is summarised
+
+    Each metric can be given additional fields (e.g. the media object ID) that are written to the JSON lines
+    file, if opened, but not used in the summary.
+    """
+    def __init__(self) -> None:
+        self.timings: defaultdict[str, list[float]] = defaultdict(list)
+        self.counters: defaultdict[str, float] = defaultdict(float)
+        self.gauges: dict[str, float] = {}
+        self._sink: Optional[TextIO] = None
+
+    def open(self, filename: str) -> None:
+        """Write each metric to the JSON lines file `filename`"""
+        self.close()
+        self._sink = open(filename, "a", buffering=1)
+
+    def close(self) -> None:
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+    def _write(self, metric_type: str, name: str, value: float, fields: dict[str, Any]) -> None:
+        if self._sink is not None:
+            self._sink.write(json.dumps(
+                {"time": time.time(), "type": metric_type, "name": name, "value": value} | fields,
+                default=str
+            ) + "\n")
+
+    def timing(self, name: str, seconds: float, **fields: Any) -> None:
+        self.timings[name].append(seconds)
+        self._write("timing", name, seconds, fields)
+
+    def count(self, name: str, value: float = 1, **fields: Any) -> None:
+        self.counters[name] += value
+        self._write("counter", name, value, fields)
+
+    def gauge(self, name: str, value: float, **fields: Any) -> None:
+        self.gauges[name] = max(value, self.gauges.get(name, value))
+        self._write("gauge", name, value, fields)
+
+    @contextmanager
+    def timed(self, name: str, **fields: Any) -> Generator[dict[str, Any], None, None]:
+        """Record the time taken by the block as a timing
+
+        The yielded dict can be used to add fields that are only known at the end of the block. The timing
+        isn't recorded if the block raises an exception.
+        """
+        start_time = time.monotonic()
+        yield fields
+        self.timing(name, time.monotonic() - start_time, **fields)
+
+    def summary(self) -> list[str]:
+        """Returns lines summarising the metrics, with percentiles for the timings"""
+        lines = []
+        for name, values in sorted(self.timings.items()):
+            sorted_values = sorted(values)
+            percentiles = ", ".join(
+                f"p{percent}={percentile(sorted_values, percent):.3f}s" for percent in SUMMARY_PERCENTILES
+            )
+            lines.append(f"{name}: count={len(values)}, total={sum(values):.3f}s, {percentiles}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name}: total={value:g}")
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"{name}: max={value:g}")
+
+        return lines
+
+    def log_summary(self) -> None:
+        lines = self.summary()
+        if lines:
+            logger.info("Metrics summary:\n  " + "\n  ".join(lines))
+
+
+metrics = Metrics()
@@ -0,0 +1,472 @@
+# This file provides functions to read timing information directly from MPEG-TS packet and PES headers.
+# This avoids demuxing (and parsing) every packet in a segment when only its timerange is required.
+# It also provides an index of the GOP byte offsets, which allows part of a media object to be read, and
+# re-timing of MPEG-TS by rewriting the timestamps in the headers.
+
+from typing import Any, Optional
+from bisect import bisect_left, bisect_right
+from fractions import Fraction
+from urllib.parse import quote
+import base64
+import dataclasses
+import json
+import mmap
+import os
+import tempfile
+
+from mediatimestamp import TimeRange, Timestamp
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+
+PAT_PID = 0x0000
+
+PTS_RATE = Fraction(90000)
+PTS_ROLLOVER = 2**33
+
+# Video stream types (ISO/IEC 13818-1 Table 2-34) where each PES packet is expected to contain a single frame
+VIDEO_STREAM_TYPES = {
+    0x01,  # MPEG-1 Video
+    0x02,  # MPEG-2 Video
+    0x1B,  # H.264
+    0x24,  # H.265
+}
+
+# The fast path is not used for timestamps this close to the rollover point. This avoids having to
+# replicate the timestamp wrap adjustments that ffmpeg makes near the rollover
+ROLLOVER_GUARD = 120 * 90000
+
+
+def _parse_packet_header(data: bytes | bytearray | mmap.mmap, pos: int) -> tuple[int, bool, bool, int]:
+    """Returns the PID, payload unit start indicator, random access indicator and payload position"""
+    pid = ((data[pos + 1] & 0x1F) << 8) | data[pos + 2]
+    payload_unit_start = bool(data[pos + 1] & 0x40)
+    adaptation_field_control = (data[pos + 3] >> 4) & 0x03
+
+    random_access = False
+    payload_pos = pos + 4
+    if adaptation_field_control & 0x02:
+        adaptation_field_length = data[pos + 4]
+        if adaptation_field_length > 0:
+            random_access = bool(data[pos + 5] & 0x40)
+        payload_pos += 1 + adaptation_field_length
+    if not adaptation_field_control & 0x01:
+        # No payload
+        payload_pos = pos + TS_PACKET_SIZE
+
+    return (pid, payload_unit_start, random_access, payload_pos)
+
+
+def _parse_section(data: bytes | mmap.mmap, pos: int, table_id: int) -> Optional[bytes]:
+    """Returns the PSI section (excluding the CRC) with the given table ID that starts in the packet at `pos`
+
+    This assumes that the section is contained in a single TS packet, which is typical for the PAT and PMT.
+    """
+    _, payload_unit_start, _, payload_pos = _parse_packet_header(data, pos)
+    packet_end = pos + TS_PACKET_SIZE
+    if not payload_unit_start or payload_pos >= packet_end:
+        return None
+
+    section_pos = payload_pos + 1 + data[payload_pos]  # skip the pointer_field
+    if section_pos + 3 > packet_end or data[section_pos] != table_id:
+        return None
+
+    section_length = ((data[section_pos + 1] & 0x0F) << 8) | data[section_pos + 2]
+    section_end = section_pos + 3 + section_length - 4
+    if section_end > packet_end:
+        return None
+
+    return data[section_pos:section_end]
+
+
+def _find_video_pid(data: mmap.mmap, max_packets: int = 1000) -> Optional[int]:
+    """Returns the PID of the video stream if the MPEG-TS contains a single video elementary stream"""
+    pmt_pid = None
+    end = min(len(data), max_packets * TS_PACKET_SIZE)
+    for pos in range(0, end, TS_PACKET_SIZE):
+        pid = ((data[pos + 1] & 0x1F) << 8) | data[pos + 2]
+
+        if pmt_pid is None and pid == PAT_PID:
+            pat = _parse_section(data, pos, 0x00)
+            if pat is not None:
+                pmt_pid = _parse_pat_pmt_pid(pat)
+
+        elif pmt_pid is not None and pid == pmt_pid:
+            pmt = _parse_section(data, pos, 0x02)
+            if pmt is not None:
+                return _parse_pmt_video_pid(pmt)
+
+    return None
+
+
+def _parse_pat_pmt_pid(pat: bytes) -> Optional[int]:
+    """Returns the PID of the PMT of the first program in the PAT section"""
+    for program_pos in range(8, len(pat) - 3, 4):
+        program_number = (pat[program_pos] << 8) | pat[program_pos + 1]
+        if program_number != 0:
+            return ((pat[program_pos + 2] & 0x1F) << 8) | pat[program_pos + 3]
+
+    return None
+
+
+def _parse_pmt_video_pid(pmt: bytes) -> Optional[int]:
+    """Returns the PID of the video stream if the PMT section describes a single video elementary stream"""
+    streams = []
+    program_info_length = ((pmt[10] & 0x0F) << 8) | pmt[11]
+    es_pos = 12 + program_info_length
+    while es_pos + 5 <= len(pmt):
+        stream_type = pmt[es_pos]
+        es_pid = ((pmt[es_pos + 1] & 0x1F) << 8) | pmt[es_pos + 2]
+        es_info_length = ((pmt[es_pos + 3] & 0x0F) << 8) | pmt[es_pos + 4]
+        streams.append((stream_type, es_pid))
+        es_pos += 5 + es_info_length
+
+    if len(streams) == 1 and streams[0][0] in VIDEO_STREAM_TYPES:
+        return streams[0][1]
+    else:
+        return None
+
+
+def _parse_pes_pts(data: bytes | mmap.mmap, payload_pos: int, packet_end: int) -> Optional[int]:
+    """Returns the PTS in the PES header that starts at `payload_pos`, or None if it isn't available"""
+    if payload_pos + 14 > packet_end:
+        return None
+    if data[payload_pos:payload_pos + 3] != b"\x00\x00\x01":
+        return None
+    if not data[payload_pos + 7] & 0x80:
+        # PTS_DTS_flags indicate there is no PTS
+        return None
+
+    pts_pos = payload_pos + 9
+    return (
+        ((data[pts_pos] >> 1) & 0x07) << 30 |
+        data[pts_pos + 1] << 22 |
+        (data[pts_pos + 2] >> 1) << 15 |
+        data[pts_pos + 3] << 7 |
+        data[pts_pos + 4] >> 1
+    )
+
+
+def _read_gop_pts(data: mmap.mmap, video_pid: int, reverse: bool) -> list[int]:
+    """Returns the PTS values of the first (or last if `reverse`) GOP
+
+    The GOP boundaries are identified using the random access indicator in the adaptation field of the
+    TS packets that start a PES packet.
+    """
+    packet_count = len(data) // TS_PACKET_SIZE
+    if reverse:
+        positions = range((packet_count - 1) * TS_PACKET_SIZE, -1, -TS_PACKET_SIZE)
+    else:
+        positions = range(0, packet_count * TS_PACKET_SIZE, TS_PACKET_SIZE)
+
+    gop_pts = []
+    seen_random_access = False
+    for pos in positions:
+        if not data[pos + 1] & 0x40:
+            continue  # not a payload unit start
+
+        pid, _, random_access, payload_pos = _parse_packet_header(data, pos)
+        if pid != video_pid:
+            continue
+
+        if not reverse and random_access and seen_random_access:
+            # Start of the second GOP
+            break
+
+        pts = _parse_pes_pts(data, payload_pos, pos + TS_PACKET_SIZE)
+        if pts is not None:
+            gop_pts.append(pts)
+
+        seen_random_access = seen_random_access or random_access
+        if reverse and random_access:
+            # Start of the last GOP
+            break
+
+    return gop_pts
+
+
+def _min_pts_difference(pts_values: list[int]) -> Optional[int]:
+    sorted_pts = sorted(set(pts_values))
+    differences = [b - a for (a, b) in zip(sorted_pts, sorted_pts[1:])]
+    return min(differences) if differences else None
+
+
+def extract_mpegts_timerange(filename: str) -> Optional[TimeRange]:
+    """Extract the presentation timerange from an MPEG-TS file using only the TS packet and PES headers
+
+    Only the PES headers in the first and last GOPs are read. The start is the lowest PTS in the first GOP
+    and the exclusive end is the highest PTS in the last GOP plus a frame duration. The frame duration is
+    taken to be the smallest difference between PTS values in the last (or first) GOP, which matches the
+    packet duration set by the demuxer for constant frame rate video.
+
+    Returns None if the file can't be handled this way, e.g. because it isn't a 188-byte packet MPEG-TS
+    containing a single video stream or the timestamps are close to the 33-bit rollover. The caller is
+    expected to fall back to demuxing the complete file.
+    """
+    if os.path.getsize(filename) < TS_PACKET_SIZE:
+        return None
+
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if len(data) % TS_PACKET_SIZE != 0 or data[0] != TS_SYNC_BYTE:
+                return None
+
+            video_pid = _find_video_pid(data)
+            if video_pid is None:
+                return None
+
+            first_gop_pts = _read_gop_pts(data, video_pid, reverse=False)
+            last_gop_pts = _read_gop_pts(data, video_pid, reverse=True)
+
+    if not first_gop_pts or not last_gop_pts:
+        return None
+
+    start_pts = min(first_gop_pts)
+    end_pts = max(last_gop_pts)
+    # The end is before the start if the timestamps wrap around the rollover within the file
+    if not 0 <= end_pts - start_pts <= PTS_ROLLOVER // 2 or end_pts >= PTS_ROLLOVER - ROLLOVER_GUARD:
+        return None
+
+    frame_duration = _min_pts_difference(last_gop_pts)
+    if frame_duration is None:
+        frame_duration = _min_pts_difference(first_gop_pts)
+    if frame_duration is None:
+        return None
+
+    return TimeRange(
+        Timestamp.from_count(start_pts, PTS_RATE),
+        Timestamp.from_count(end_pts + frame_duration, PTS_RATE),
+        TimeRange.INCLUDE_START
+    )
+
+
+# PES stream IDs without the optional PES header containing the PTS and DTS (ISO/IEC 13818-1 Table 2-22)
+PES_STREAM_IDS_WITHOUT_HEADER = {0xBC, 0xBE, 0xBF, 0xF0, 0xF1, 0xF2, 0xF8, 0xFF}
+
+
+def _offset_pes_timestamp(data: bytearray, pos: int, offset: int) -> None:
+    """Add the offset to the 33-bit PTS or DTS encoded in the 5 bytes at `pos`, keeping the prefix and markers"""
+    value = (
+        ((data[pos] >> 1) & 0x07) << 30 |
+        data[pos + 1] << 22 |
+        (data[pos + 2] >> 1) << 15 |
+        data[pos + 3] << 7 |
+        data[pos + 4] >> 1
+    )
+    value = (value + offset) % PTS_ROLLOVER
+    data[pos] = (data[pos] & 0xF0) | ((value >> 29) & 0x0E) | 0x01
+    data[pos + 1] = (value >> 22) & 0xFF
+    data[pos + 2] = ((value >> 14) & 0xFE) | 0x01
+    data[pos + 3] = (value >> 7) & 0xFF
+    data[pos + 4] = ((value << 1) & 0xFE) | 0x01
+
+
+def _offset_clock_reference(data: bytearray, pos: int, offset: int) -> None:
+    """Add the offset to the 33-bit base of the PCR or OPCR encoded in the 6 bytes at `pos`"""
+    base = data[pos] << 25 | data[pos + 1] << 17 | data[pos + 2] << 9 | data[pos + 3] << 1 | data[pos + 4] >> 7
+    base = (base + offset) % PTS_ROLLOVER
+    data[pos] = (base >> 25) & 0xFF
+    data[pos + 1] = (base >> 17) & 0xFF
+    data[pos + 2] = (base >> 9) & 0xFF
+    data[pos + 3] = (base >> 1) & 0xFF
+    data[pos + 4] = ((base & 0x01) << 7) | (data[pos + 4] & 0x7F)
+
+
+def offset_mpegts_timestamps(data: bytearray, offset: int) -> None:
+    """Add `offset` (in 90kHz units) to the PCR, OPCR, PTS and DTS in the MPEG-TS packets, in place
+
+    The timestamps wrap around at the 33-bit rollover. This re-times the MPEG-TS without demuxing and
+    remuxing it. `data` must contain whole 188-byte packets.
+    """
+    if len(data) % TS_PACKET_SIZE != 0:
+        raise ValueError("MPEG-TS data is not a whole number of packets")
+
+    for pos in range(0, len(data), TS_PACKET_SIZE):
+        if data[pos] != TS_SYNC_BYTE:
+            raise ValueError(f"MPEG-TS sync byte not found at offset {pos}")
+
+        adaptation_field_control = (data[pos + 3] >> 4) & 0x03
+        if adaptation_field_control & 0x02 and data[pos + 4] > 0:
+            flags = data[pos + 5]
+            field_pos = pos + 6
+            if flags & 0x10:
+                _offset_clock_reference(data, field_pos, offset)
+                field_pos += 6
+            if flags & 0x08:
+                _offset_clock_reference(data, field_pos, offset)
+
+        _, payload_unit_start, _, payload_pos = _parse_packet_header(data, pos)
+        if (
+            not payload_unit_start or
+            payload_pos + 14 > pos + TS_PACKET_SIZE or
+            data[payload_pos:payload_pos + 3] != b"\x00\x00\x01" or
+            data[payload_pos + 3] in PES_STREAM_IDS_WITHOUT_HEADER
+        ):
+            continue
+
+        pts_dts_flags = data[payload_pos + 7] >> 6
+        if pts_dts_flags & 0x02:
+            _offset_pes_timestamp(data, payload_pos + 9, offset)
+        if pts_dts_flags == 0x03 and payload_pos + 19 <= pos + TS_PACKET_SIZE:
+            _offset_pes_timestamp(data, payload_pos + 14, offset)
+
+
+@dataclasses.dataclass
+class GopIndex:
+    """The byte offsets of the GOPs in an MPEG-TS media object containing a single video stream
+
+    `psi` holds the PAT and PMT packets, which are needed to demux a byte range read from the middle of the
+    media object. `gops` holds the byte offset and PTS of the TS packet starting each GOP, in order.
+    """
+    size: int
+    psi: bytes
+    gops: list[tuple[int, int]]
+
+    def byte_range(self, timerange: TimeRange, object_timerange: TimeRange) -> Optional[tuple[int, int, TimeRange]]:
+        """Returns the byte range of the GOPs covering the timerange, along with their timerange
+
+        The byte range is returned as the start and (exclusive) end offsets. The media object's
+        `object_timerange` provides the timerange of the data before the first GOP and after the last GOP.
+        Returns None if the byte range would be the complete media object.
+        """
+        if timerange.start is None or timerange.end is None:
+            return None
+        assert object_timerange.start is not None and object_timerange.end is not None
+
+        gop_pts = [pts for (_, pts) in self.gops]
+
+        # The GOP containing the start, or the start of the media object if the start is before the first GOP
+        start_index = bisect_right(gop_pts, timerange.start.to_count(PTS_RATE)) - 1
+        if start_index < 0:
+            start_offset = 0
+            start = object_timerange.start
+        else:
+            start_offset = self.gops[start_index][0]
+            start = Timestamp.from_count(gop_pts[start_index], PTS_RATE)
+
+        # The GOP following the one containing the end
+        end_pts = timerange.end.to_count(PTS_RATE)
+        if timerange.includes_end():
+            end_index = bisect_right(gop_pts, end_pts)
+        else:
+            end_index = bisect_left(gop_pts, end_pts)
+        if end_index >= len(self.gops):
+            end_offset = self.size
+            end = object_timerange.end
+        else:
+            end_offset = self.gops[end_index][0]
+            end = Timestamp.from_count(gop_pts[end_index], PTS_RATE)
+
+        if start_offset == 0 and end_offset == self.size:
+            return None
+
+        return (start_offset, end_offset, TimeRange(start, end, TimeRange.INCLUDE_START))
+
+    def to_json(self) -> dict[str, Any]:
+        return {"size": self.size, "psi": base64.b64encode(self.psi).decode(), "gops": self.gops}
+
+    @classmethod
+    def from_json(cls, value: dict[str, Any]) -> "GopIndex":
+        return cls(value["size"], base64.b64decode(value["psi"]), [(offset, pts) for (offset, pts) in value["gops"]])
+
+
+class GopIndexBuilder:
+    """Builds a `GopIndex` from the data of an MPEG-TS media object, which is fed in order in chunks of any size
+
+    The GOP boundaries are identified using the random access indicator in the adaptation field, as for
+    `extract_mpegts_timerange`.
+    """
+    def __init__(self) -> None:
+        self._pending = b""
+        self._offset = 0
+        self._valid = True
+        self._pmt_pid: Optional[int] = None
+        self._video_pid: Optional[int] = None
+        self._psi: list[bytes] = []
+        self._gops: list[tuple[int, int]] = []
+
+    def feed(self, data: bytes) -> None:
+        if not self._valid:
+            return
+
+        data = self._pending + data
+        end = len(data) - len(data) % TS_PACKET_SIZE
+        for pos in range(0, end, TS_PACKET_SIZE):
+            if data[pos] != TS_SYNC_BYTE:
+                self._valid = False
+                return
+
+            pid, payload_unit_start, random_access, payload_pos = _parse_packet_header(data, pos)
+            if pid == self._video_pid:
+                if payload_unit_start and random_access:
+                    pts = _parse_pes_pts(data, payload_pos, pos + TS_PACKET_SIZE)
+                    if pts is not None:
+                        self._gops.append((self._offset + pos, pts))
+
+            elif self._pmt_pid is None and pid == PAT_PID:
+                pat = _parse_section(data, pos, 0x00)
+                if pat is not None:
+                    self._pmt_pid = _parse_pat_pmt_pid(pat)
+                    self._psi.append(data[pos:pos + TS_PACKET_SIZE])
+
+            elif self._video_pid is None and pid == self._pmt_pid:
+                pmt = _parse_section(data, pos, 0x02)
+                if pmt is not None:
+                    self._video_pid = _parse_pmt_video_pid(pmt)
+                    self._psi.append(data[pos:pos + TS_PACKET_SIZE])
+                    if self._video_pid is None:
+                        self._valid = False
+                        return
+
+        self._pending = data[end:]
+        self._offset += end
+
+    def index(self) -> Optional[GopIndex]:
+        """Returns the index once all the data has been fed, or None if the media object can't be indexed
+
+        Media objects with timestamps that are close to or wrap around the 33-bit rollover aren't indexed.
+        """
+        if not self._valid or self._pending or self._video_pid is None or not self._gops:
+            return None
+
+        gop_pts = [pts for (_, pts) in self._gops]
+        if gop_pts != sorted(gop_pts) or gop_pts[-1] >= PTS_ROLLOVER - ROLLOVER_GUARD:
+            return None
+
+        return GopIndex(self._offset, b"".join(self._psi), self._gops)
+
+
+def build_gop_index(filename: str, chunk_size: int = 1024 * 1024) -> Optional[GopIndex]:
+    """Returns the GOP index of the MPEG-TS file, or None if it can't be indexed"""
+    builder = GopIndexBuilder()
+    with open(filename, "rb") as f:
+        while chunk := f.read(chunk_size):
+            builder.feed(chunk)
+
+    return builder.index()
+
+
+class GopIndexStore:
+    """A local directory of GOP indexes, stored as JSON files named after the (quoted) object ID
+
+    TAMS media objects are immutable, so an index never needs to be updated once it has been stored.
+    """
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, object_id: str) -> str:
+        return os.path.join(self.directory, quote(object_id, safe="") + ".json")
+
+    def get(self, object_id: str) -> Optional[GopIndex]:
+        try:
+            with open(self._path(object_id), "r") as f:
+                return GopIndex.from_json(json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def put(self, object_id: str, index: GopIndex) -> None:
+        """Write the index to a temporary file which is then renamed, so that a partial index is never read"""
+        with tempfile.NamedTemporaryFile("w", dir=self.directory, suffix=".tmp", delete=False) as f:
+            json.dump(index.to_json(), f)
+        os.replace(f.name, self._path(object_id))
@@ -0,0 +1,155 @@
+# This file provides an in-memory index of Flow segments for answering timerange queries without scanning the segments.
+# The index is built incrementally, e.g. from the pages of a segment listing, which are in timeline order.
+
+from typing import AsyncIterable, Iterable, Optional
+from bisect import bisect_left, bisect_right
+
+from mediatimestamp import Timestamp, TimeRange
+
+# Positions of unbounded timerange ends
+MIN_POSITION = -(1 << 127)
+MAX_POSITION = 1 << 127
+
+
+def start_position(timerange: TimeRange) -> int:
+    """Returns the position of the start of the timerange, such that timestamp `t` (in nanoseconds) is at position 2t
+
+    The positions of the timerange are half-open, i.e. it contains the positions from the start position up to, but not
+    including, the end position. This takes account of the inclusivity of the timerange.
+    """
+    if timerange.start is None:
+        return MIN_POSITION
+    return 2 * timerange.start.to_nanosec() + (0 if timerange.includes_start() else 1)
+
+
+def end_position(timerange: TimeRange) -> int:
+    """Returns the position following the end of the timerange. See `start_position`"""
+    if timerange.end is None:
+        return MAX_POSITION
+    return 2 * timerange.end.to_nanosec() + (1 if timerange.includes_end() else 0)
+
+
+def positions_to_timerange(start: int, end: int) -> TimeRange:
+    """Returns the timerange covering the positions from `start` up to, but not including, `end`"""
+    inclusivity = TimeRange.EXCLUSIVE
+    start_ts = None
+    end_ts = None
+    if start != MIN_POSITION:
+        start_ts = Timestamp.from_nanosec(start // 2)
+        if start % 2 == 0:
+            inclusivity |= TimeRange.INCLUDE_START
+    if end != MAX_POSITION:
+        end_ts = Timestamp.from_nanosec(end // 2)
+        if end % 2 == 1:
+            inclusivity |= TimeRange.INCLUDE_END
+    return TimeRange(start_ts, end_ts, inclusivity)
+
+
+class SegmentIndex:
+    """An index of (JSON) Flow segments, sorted by the start of their timerange
+
+    The segments are held in sorted arrays of their start and end positions, along with the running maximum of the end
+    positions so that the segments overlapping a timerange are found by binary search, even if segments overlap. The
+    queries take O(log n + k) time for n segments of which k are returned.
+
+    Adding a segment that starts at or after the last segment is O(1), so the index can be built incrementally from a
+    segment listing. Adding a segment out of order is O(n).
+    """
+    def __init__(self, segments: Iterable[dict] = ()) -> None:
+        self.segments: list[dict] = []
+        self._starts: list[int] = []
+        self._ends: list[int] = []
+        self._max_ends: list[int] = []
+        self._durations: list[int] = []
+        self.extend(segments)
+
+    @classmethod
+    async def from_listing(cls, segments: AsyncIterable[dict]) -> "SegmentIndex":
+        """Returns the index of the segments, e.g. from `SegmentLister.segments`"""
+        index = cls()
+        async for segment in segments:
+            index.add(segment)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    def add(self, segment: dict) -> None:
+        timerange = TimeRange.from_str(segment["timerange"])
+        start = start_position(timerange)
+        end = end_position(timerange)
+
+        if not self._starts or start >= self._starts[-1]:
+            self.segments.append(segment)
+            self._starts.append(start)
+            self._ends.append(end)
+            self._max_ends.append(max(end, self._max_ends[-1]) if self._max_ends else end)
+            self._durations.append((self._durations[-1] if self._durations else 0) + max(end - start, 0) // 2)
+            return
+
+        row = bisect_right(self._starts, start)
+        self.segments.insert(row, segment)
+        self._starts.insert(row, start)
+        self._ends.insert(row, end)
+        self._max_ends.insert(row, 0)
+        self._durations.insert(row, 0)
+        for row in range(row, len(self.segments)):
+            self._max_ends[row] = max(self._ends[row], self._max_ends[row - 1]) if row > 0 else self._ends[row]
+            self._durations[row] = self.duration_before(row) + max(self._ends[row] - self._starts[row], 0) // 2
+
+    def extend(self, segments: Iterable[dict]) -> None:
+        for segment in segments:
+            self.add(segment)
+
+    def _rows(self, start: int, end: int) -> Iterable[int]:
+        """Yields the rows of the segments overlapping the positions from `start` up to `end`"""
+        # The segments before `first` all end at or before `start`, and those from `last` all start at or after `end`
+        first = bisect_right(self._max_ends, start)
+        last = bisect_left(self._starts, end)
+        return (row for row in range(first, last) if self._ends[row] > start)
+
+    def overlapping(self, timerange: TimeRange) -> list[dict]:
+        """Returns the segments that overlap the timerange, in timeline order"""
+        return [self.segments[row] for row in self._rows(start_position(timerange), end_position(timerange))]
+
+    def at(self, timestamp: Timestamp) -> list[dict]:
+        """Returns the segments that contain the timestamp"""
+        position = 2 * timestamp.to_nanosec()
+        return [self.segments[row] for row in self._rows(position, position + 1)]
+
+    def gaps(self, timerange: Optional[TimeRange] = None) -> list[TimeRange]:
+        """Returns the parts of the timerange, by default the whole timerange of the index, not covered by a segment"""
+        if timerange is None:
+            timerange = self.timerange
+        start = start_position(timerange)
+        end = end_position(timerange)
+
+        gaps = []
+        covered_to = start
+        for row in self._rows(start, end):
+            if self._starts[row] > covered_to:
+                gaps.append(positions_to_timerange(covered_to, self._starts[row]))
+            covered_to = max(covered_to, self._ends[row])
+        if covered_to < end:
+            gaps.append(positions_to_timerange(covered_to, end))
+        return gaps
+
+    @property
+    def timerange(self) -> TimeRange:
+        """The timerange from the start of the first segment to the end of the last"""
+        if not self.segments:
+            return TimeRange.never()
+        return positions_to_timerange(self._starts[0], self._max_ends[-1])
+
+    def duration_before(self, row: int) -> int:
+        """Returns the total duration, in nanoseconds, of the segments before the row"""
+        return self._durations[row - 1] if row > 0 else 0
+
+    def row_at_duration(self, duration: int) -> int:
+        """Returns the first row after segments with a total duration of at least `duration` nanoseconds
+
+        The number of segments is returned if there is no such row.
+        """
+        if duration <= 0:
+            return 0
+        return min(bisect_left(self._durations, duration) + 1, len(self.segments))
@@ -0,0 +1,210 @@
+# This file provides listing of the Flow Segments in a timerange using the paged segments endpoint.
+# The page size (`limit`) is adapted to the response time of the service, and a large timerange can be split into
+# sub-timeranges whose pages are fetched concurrently.
+
+from typing import AsyncGenerator, Optional
+import asyncio
+import logging
+import time
+
+from mediatimestamp import Timestamp, TimeRange
+from yarl import URL
+import aiohttp
+
+from .credentials import Credentials
+from .client import get_request
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_LIMIT = 100
+DEFAULT_MIN_PAGE_LIMIT = 10
+DEFAULT_MAX_PAGE_LIMIT = 5000
+DEFAULT_TARGET_PAGE_TIME = 1.0
+
+DEFAULT_READ_AHEAD = 4
+
+# Maximum factor by which the limit changes after each page, to avoid over-reacting to a single slow response
+MAX_LIMIT_CHANGE = 2.0
+
+
+class SegmentLister:
+    """Lists the Flow Segments in a timerange, following the `Link: next` header of each page
+
+    The `limit` query parameter is always set, starting at `limit`. After each full page it is scaled so that
+    a page takes about `target_page_time` seconds to be returned, within `min_limit` and `max_limit`. If the
+    service reports (in the `X-Paging-Limit` header) that it used a lower limit than that requested then that
+    becomes the maximum. The limit is shared by subsequent listings.
+
+    If `parallelism` is more than 1 then a bounded timerange is split into that number of disjoint
+    sub-timeranges of equal duration, whose pages are fetched concurrently. The segments are still yielded
+    in timeline order, with a segment that spans the boundary of a sub-timerange yielded once.
+
+    The pages are listed by a separate task that runs ahead of the consumer of the segments, holding up to
+    `read_ahead` pages of the first sub-timerange in a queue. The later sub-timeranges are listed to completion
+    whilst the earlier ones are consumed, so that they are listed concurrently, and their pages are held in
+    memory until they are needed. The time that the consumer waits for a page is recorded in the
+    `segment_page_wait` timing metric. If `read_ahead` is 0 and the timerange isn't split then each page is only
+    requested once the segments of the previous page have been consumed.
+    """
+    def __init__(
+        self,
+        limit: int = DEFAULT_PAGE_LIMIT,
+        min_limit: int = DEFAULT_MIN_PAGE_LIMIT,
+        max_limit: int = DEFAULT_MAX_PAGE_LIMIT,
+        target_page_time: float = DEFAULT_TARGET_PAGE_TIME,
+        parallelism: int = 1,
+        read_ahead: int = DEFAULT_READ_AHEAD
+    ) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+        self.target_page_time = target_page_time
+        self.parallelism = max(parallelism, 1)
+        self.read_ahead = max(read_ahead, 0)
+
+    def _adapt_limit(self, requested_limit: int, count: int, elapsed: float, server_limit: Optional[int]) -> None:
+        if server_limit is not None and server_limit < min(requested_limit, self.max_limit):
+            logger.info(f"Service limits segment pages to {server_limit} segments")
+            self.max_limit = max(server_limit, 1)
+            self.min_limit = min(self.min_limit, self.max_limit)
+
+        # A partial (i.e. the last) page says little about how the response time depends on the limit
+        if count >= requested_limit and elapsed > 0:
+            change = min(max(self.target_page_time / elapsed, 1 / MAX_LIMIT_CHANGE), MAX_LIMIT_CHANGE)
+            limit = round(requested_limit * change)
+        else:
+            limit = self.limit
+        limit = min(max(limit, self.min_limit), self.max_limit)
+
+        if limit != self.limit:
+            logger.debug(f"Segment page limit changed from {self.limit} to {limit} ({elapsed:.3f}s for {count})")
+            self.limit = limit
+
+    async def pages(
+        self,
+        session: aiohttp.ClientSession,
+        credentials: Credentials,
+        segments_url: str,
+        timerange: TimeRange
+    ) -> AsyncGenerator[list[dict], None]:
+        """Generator of the pages of segments in the timerange, from the `segments_url` with any other query
+        parameters (e.g. `presigned=true`) already set
+        """
+        url = URL(segments_url).update_query(timerange=str(timerange))
+        while True:
+            requested_limit = self.limit
+            start_time = time.monotonic()
+            async with get_request(session, credentials, str(url.update_query(limit=requested_limit))) as resp:
+                resp.raise_for_status()
+                segments = await resp.json()
+                elapsed = time.monotonic() - start_time
+
+                server_limit = resp.headers.get("X-Paging-Limit")
+                next_link = resp.links.get("next")
+
+            metrics.timing("segment_page", elapsed, limit=requested_limit, count=len(segments))
+            self._adapt_limit(
+                requested_limit,
+                len(segments),
+                elapsed,
+                int(server_limit) if server_limit is not None and server_limit.isdigit() else None
+            )
+
+            yield segments
+
+            if next_link is None:
+                break
+            url = URL(str(next_link["url"]))
+
+    def split_timerange(self, timerange: TimeRange) -> list[TimeRange]:
+        """Split a bounded timerange into `parallelism` disjoint sub-timeranges of equal duration"""
+        if self.parallelism <= 1 or timerange.start is None or timerange.end is None or timerange.is_empty():
+            return [timerange]
+
+        start = timerange.start.to_nanosec()
+        duration = timerange.end.to_nanosec() - start
+        sub_timeranges = []
+        remainder = timerange
+        for index in range(1, self.parallelism):
+            split_point = Timestamp.from_nanosec(start + duration * index // self.parallelism)
+            if split_point not in remainder or split_point == remainder.start:
+                continue
+            sub_timerange, remainder = remainder.split_at(split_point)
+            sub_timeranges.append(sub_timerange)
+        sub_timeranges.append(remainder)
+
+        return sub_timeranges
+
+    async def segments(
+        self,
+        session: aiohttp.ClientSession,
+        credentials: Credentials,
+        segments_url: str,
+        timerange: TimeRange
+    ) -> AsyncGenerator[dict, None]:
+        """Generator of the segments that overlap the timerange, in timeline order. See `pages`"""
+        sub_timeranges = self.split_timerange(timerange)
+        if len(sub_timeranges) == 1 and self.read_ahead == 0:
+            async for page in self.pages(session, credentials, segments_url, timerange):
+                for segment in page:
+                    if _overlaps(segment, timerange):
+                        yield segment
+            return
+
+        # Each sub-timerange is listed by its own task into a queue, so that the next pages are fetched whilst the
+        # segments already listed are being processed. The queues are consumed in timeline order. Only the first
+        # queue is bounded: bounding the later queues would stop their tasks after a few pages until the consumer
+        # reaches them, so the sub-timeranges wouldn't be listed concurrently
+        queues: list[asyncio.Queue[Optional[list[dict] | BaseException]]] = [
+            asyncio.Queue(maxsize=max(self.read_ahead, 1) if index == 0 else 0) for index in range(len(sub_timeranges))
+        ]
+
+        async def list_sub_timerange(index: int) -> None:
+            try:
+                async for page in self.pages(session, credentials, segments_url, sub_timeranges[index]):
+                    await queues[index].put(page)
+                    metrics.gauge("segment_page_queue_depth", queues[index].qsize())
+            except Exception as e:
+                await queues[index].put(e)
+            else:
+                await queues[index].put(None)
+
+        tasks = [asyncio.create_task(list_sub_timerange(index)) for index in range(len(sub_timeranges))]
+        try:
+            for index in range(len(sub_timeranges)):
+                previous_sub_timerange = sub_timeranges[index - 1] if index > 0 else None
+                while True:
+                    # Time spent waiting here is page fetch latency that isn't hidden behind the processing
+                    start_time = time.monotonic()
+                    page = await queues[index].get()
+                    metrics.timing("segment_page_wait", time.monotonic() - start_time)
+                    if page is None:
+                        break
+                    if isinstance(page, BaseException):
+                        raise page
+
+                    for segment in page:
+                        # A segment spanning sub-timeranges is yielded for the first one only
+                        if previous_sub_timerange is not None and TimeRange.from_str(
+                            segment["timerange"]
+                        ).overlaps_with_timerange(previous_sub_timerange):
+                            continue
+                        if _overlaps(segment, timerange):
+                            yield segment
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _overlaps(segment: dict, timerange: TimeRange) -> bool:
+    segment_timerange = TimeRange.from_str(segment["timerange"])
+    if segment_timerange.overlaps_with_timerange(timerange):
+        return True
+
+    logger.warning(
+        f"Skipping segment returned by TAMS with a timerange {segment_timerange!s} "
+        f"that does not overlap with the target timerange {timerange!s}"
+    )
+    return False
@@ -0,0 +1,107 @@
+# This file provides a file-like object for streaming downloaded media to (synchronous) readers such as PyAV.
+
+from typing import Optional
+import asyncio
+import io
+import threading
+
+
+class StreamBuffer(io.RawIOBase):
+    """A non-seekable, file-like object backed by a fixed-size ring buffer
+
+    Data is written asynchronously from the event loop (e.g. as chunks of a HTTP response arrive) and read
+    from another thread (e.g. by PyAV demuxing in a worker thread). Reads block until data is available and
+    writes wait until there is space in the buffer, so the memory used is limited to `capacity` bytes however
+    much data is streamed.
+
+    The writer calls `close_write` at the end of the data, optionally with an exception that is then raised
+    by the reader. The reader calls `close` if it no longer needs the data, which causes pending and future
+    writes to return False.
+    """
+    def __init__(self, capacity: int) -> None:
+        super().__init__()
+        self.capacity = capacity
+
+        self._buffer = bytearray(capacity)
+        self._start = 0
+        self._size = 0
+        self._write_closed = False
+        self._write_error: Optional[BaseException] = None
+        self._condition = threading.Condition()
+
+        self._loop = asyncio.get_running_loop()
+        self._space_available = asyncio.Event()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def readinto(self, b) -> int:  # type: ignore[override]
+        with self._condition:
+            self._condition.wait_for(lambda: self._size > 0 or self._write_closed or self.closed)
+            if self._size == 0:
+                if self._write_error is not None:
+                    raise self._write_error
+                return 0  # End of the data
+
+            read_size = min(len(b), self._size)
+            first_size = min(read_size, self.capacity - self._start)
+            view = memoryview(b)
+            view[:first_size] = self._buffer[self._start:self._start + first_size]
+            view[first_size:read_size] = self._buffer[:read_size - first_size]
+
+            self._start = (self._start + read_size) % self.capacity
+            self._size -= read_size
+
+        self._loop.call_soon_threadsafe(self._space_available.set)
+        return read_size
+
+    async def write_async(self, data: bytes) -> bool:
+        """Write all the data to the buffer, waiting for space as needed
+
+        Returns False if the reader has closed the buffer, in which case the data is discarded.
+        """
+        view = memoryview(data)
+        while len(view) > 0:
+            with self._condition:
+                if self.closed:
+                    return False
+
+                free_size = self.capacity - self._size
+                if free_size == 0:
+                    # Cleared whilst holding the lock so that a read that frees space will set it again
+                    self._space_available.clear()
+                else:
+                    write_size = min(len(view), free_size)
+                    write_start = (self._start + self._size) % self.capacity
+                    first_size = min(write_size, self.capacity - write_start)
+                    self._buffer[write_start:write_start + first_size] = view[:first_size]
+                    self._buffer[:write_size - first_size] = view[first_size:write_size]
+
+                    self._size += write_size
+                    view = view[write_size:]
+                    self._condition.notify_all()
+                    continue
+
+            await self._space_available.wait()
+
+        return True
+
+    def close_write(self, error: Optional[BaseException] = None) -> None:
+        """Mark the end of the data, or that writing failed with `error`"""
+        with self._condition:
+            self._write_closed = True
+            self._write_error = error
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        """Close the reader side, discarding the buffered data and stopping the writer"""
+        with self._condition:
+            super().close()
+            self._condition.notify_all()
+
+        # The reader may be in another thread to the writer's event loop
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._space_available.set)
@@ -0,0 +1,229 @@
+# This file provides exact timeline calculations for edits, with segments held as columns of edit rate sample counts.
+# Timestamps are only converted to and from the counts at the edge, when segments are read from or written to TAMS.
+
+from typing import Iterable, Optional, Union
+from fractions import Fraction
+import dataclasses
+
+from mediatimestamp import Timestamp, TimeRange
+import numpy as np
+
+NANOSEC_PER_SEC = 1_000_000_000
+
+
+def count_to_nanosec(count: int, rate: Fraction) -> int:
+    """Returns the time of the sample `count` in nanoseconds, rounded as for `Timestamp.from_count`"""
+    ns = (NANOSEC_PER_SEC * abs(count) * rate.denominator) // rate.numerator
+    return ns if count >= 0 else -ns
+
+
+def count_to_timestamp(count: int, rate: Fraction) -> Timestamp:
+    return Timestamp.from_count(count, rate.numerator, rate.denominator)
+
+
+def timestamp_to_count(timestamp: Timestamp, rate: Fraction, inclusive: bool = True) -> int:
+    """Returns the first sample at or after the timestamp, or after the timestamp if not `inclusive`
+
+    This is exact for the sample times given by `count_to_timestamp`, unlike `Timestamp.to_count` which can
+    round down to the previous sample when the rate isn't a whole number of nanoseconds per sample.
+    """
+    ns = timestamp.to_nanosec()
+    if not inclusive:
+        ns += 1
+
+    # Estimate the count from the exact rational time and then correct for the rounding of the sample times
+    count = -((-ns * rate.numerator) // (NANOSEC_PER_SEC * rate.denominator))
+    while count_to_nanosec(count - 1, rate) >= ns:
+        count -= 1
+    while count_to_nanosec(count, rate) < ns:
+        count += 1
+    return count
+
+
+def timerange_to_counts(timerange: TimeRange, rate: Fraction) -> tuple[int, int]:
+    """Returns the first sample in the timerange and the sample following the last, i.e. a half-open range"""
+    if timerange.start is None or timerange.end is None:
+        raise ValueError(f"Timerange {timerange!s} must be bounded to convert to sample counts")
+    if timerange.is_empty():
+        return (0, 0)
+
+    start = timestamp_to_count(timerange.start, rate, timerange.includes_start())
+    end = timestamp_to_count(timerange.end, rate, not timerange.includes_end())
+    return (start, max(start, end))
+
+
+def counts_to_timerange(start: int, end: int, rate: Fraction) -> TimeRange:
+    """Returns the timerange covering the samples from `start` up to, but not including, `end`"""
+    return TimeRange(count_to_timestamp(start, rate), count_to_timestamp(end, rate), TimeRange.INCLUDE_START)
+
+
+def _column(values: Iterable[int] = ()) -> np.ndarray:
+    return np.fromiter(values, dtype=np.int64)
+
+
+@dataclasses.dataclass
+class SegmentTable:
+    """Segments on an output timeline with a fixed edit `rate`, held as numpy columns of 64 bit integers
+
+    Each row is a segment referencing `object_ids[i]` that covers the samples from `starts[i]` up to, but not
+    including, `ends[i]` on the output timeline. The sample on the source Flow's timeline is the output sample
+    plus `shifts[i]`. The source segment started at sample `source_starts[i]` and had a `ts_offset` of
+    `ts_offsets[i]` nanoseconds.
+
+    The operations return a new table, leaving the table unchanged. They work on whole columns with array
+    arithmetic, so timestamps are not parsed or formatted until `to_segments`. Samples are counted exactly, so
+    cutting and moving segments doesn't accumulate rounding errors at rates such as 30000/1001. Rows are kept in
+    timeline order, i.e. sorted by `starts`.
+    """
+    rate: Fraction
+    object_ids: np.ndarray = dataclasses.field(default_factory=lambda: np.empty(0, dtype=object))
+    starts: np.ndarray = dataclasses.field(default_factory=_column)
+    ends: np.ndarray = dataclasses.field(default_factory=_column)
+    shifts: np.ndarray = dataclasses.field(default_factory=_column)
+    source_starts: np.ndarray = dataclasses.field(default_factory=_column)
+    ts_offsets: np.ndarray = dataclasses.field(default_factory=_column)
+
+    @classmethod
+    def from_segments(cls, segments: Iterable[dict], rate: Fraction) -> "SegmentTable":
+        """Returns a table of the (JSON) Flow segments, on their Flow's timeline"""
+        object_ids = []
+        starts = []
+        ends = []
+        ts_offsets = []
+        for segment in segments:
+            start, end = timerange_to_counts(TimeRange.from_str(segment["timerange"]), rate)
+            object_ids.append(segment["object_id"])
+            starts.append(start)
+            ends.append(end)
+            ts_offsets.append(Timestamp.from_str(segment.get("ts_offset", "0:0")).to_nanosec())
+
+        starts = _column(starts)
+        return cls(
+            rate,
+            np.array(object_ids, dtype=object),
+            starts,
+            _column(ends),
+            np.zeros_like(starts),
+            starts.copy(),
+            _column(ts_offsets)
+        )
+
+    def __len__(self) -> int:
+        return len(self.object_ids)
+
+    @property
+    def start(self) -> Optional[int]:
+        return int(self.starts[0]) if len(self) else None
+
+    @property
+    def end(self) -> Optional[int]:
+        return int(self.ends.max()) if len(self) else None
+
+    def _select(self, rows: Union[np.ndarray, slice]) -> "SegmentTable":
+        """Returns the rows given by an index array, boolean mask or slice"""
+        return SegmentTable(
+            self.rate,
+            self.object_ids[rows],
+            self.starts[rows],
+            self.ends[rows],
+            self.shifts[rows],
+            self.source_starts[rows],
+            self.ts_offsets[rows]
+        )
+
+    def offset(self, delta: int) -> "SegmentTable":
+        """Returns the table moved `delta` samples along the output timeline"""
+        return dataclasses.replace(
+            self._select(slice(None)),
+            starts=self.starts + delta,
+            ends=self.ends + delta,
+            shifts=self.shifts - delta
+        )
+
+    def window(self, start: Optional[int] = None, end: Optional[int] = None) -> "SegmentTable":
+        """Returns the segments trimmed to the samples from `start` up to `end`, dropping those outside"""
+        # The rows are sorted by start, so those starting at or after the end of the window can be cut off directly.
+        # Ends aren't sorted where segments overlap, so the rows ending before the window are found by a mask
+        table = self._select(slice(None, None if end is None else int(np.searchsorted(self.starts, end))))
+        if start is not None:
+            table.starts = np.maximum(table.starts, start)
+        if end is not None:
+            table.ends = np.minimum(table.ends, end)
+        return table._select(table.starts < table.ends)
+
+    @classmethod
+    def concat(cls, tables: list["SegmentTable"]) -> "SegmentTable":
+        """Returns the rows of the tables, which have the same rate and are in timeline order, in a single table"""
+        rate = tables[0].rate
+        for table in tables:
+            if table.rate != rate:
+                raise ValueError(f"Cannot concatenate segments at rates {table.rate} and {rate}")
+
+        return cls(
+            rate,
+            np.concatenate([table.object_ids for table in tables]),
+            np.concatenate([table.starts for table in tables]),
+            np.concatenate([table.ends for table in tables]),
+            np.concatenate([table.shifts for table in tables]),
+            np.concatenate([table.source_starts for table in tables]),
+            np.concatenate([table.ts_offsets for table in tables])
+        )
+
+    @classmethod
+    def interval_cut(cls, tables: list["SegmentTable"], interval: int) -> "SegmentTable":
+        """Returns the output that cuts between the tables every `interval` samples, starting at sample 0
+
+        The tables must already be on the output timeline. The output takes interval `k` from table
+        `k % len(tables)`.
+        """
+        if interval <= 0:
+            raise ValueError("The cut interval must be a positive number of samples")
+
+        pieces = []
+        for index, table in enumerate(tables):
+            # The first and last intervals each row overlaps, and the first of those that is taken from this table
+            first = table.starts // interval
+            last = (table.ends - 1) // interval
+            first_cut = first + (index - first) % len(tables)
+            cut_counts = np.where(last >= first_cut, (last - first_cut) // len(tables) + 1, 0)
+
+            # A row for each interval taken from each segment
+            rows = np.repeat(np.arange(len(table)), cut_counts)
+            cut_in_row = np.arange(len(rows)) - np.repeat(np.cumsum(cut_counts) - cut_counts, cut_counts)
+            cuts = first_cut[rows] + cut_in_row * len(tables)
+
+            piece = table._select(rows)
+            piece.starts = np.maximum(piece.starts, cuts * interval)
+            piece.ends = np.minimum(piece.ends, (cuts + 1) * interval)
+            pieces.append(piece)
+
+        combined = cls.concat(pieces)
+        combined = combined._select(combined.starts < combined.ends)
+        return combined._select(np.argsort(combined.starts, kind="stable"))
+
+    def to_segments(self) -> list[dict]:
+        """Returns the segments, with `TimeRange` and `Timestamp` values, for registering on the output Flow
+
+        The `ts_offset` is adjusted so that each sample of the media object is placed at its output time. This is
+        done with Python integers, as the nanosecond calculation can overflow 64 bits.
+        Note that `sample_offset` and `sample_count` are deprecated but still set for backwards compatibility.
+        """
+        segments = []
+        for object_id, start, end, shift, source_start_of_segment, ts_offset in zip(
+            self.object_ids.tolist(),
+            self.starts.tolist(),
+            self.ends.tolist(),
+            self.shifts.tolist(),
+            self.source_starts.tolist(),
+            self.ts_offsets.tolist()
+        ):
+            source_start = start + shift
+            ts_offset += count_to_nanosec(start, self.rate) - count_to_nanosec(source_start, self.rate)
+            segments.append({
+                "object_id": object_id,
+                "timerange": counts_to_timerange(start, end, self.rate),
+                "ts_offset": Timestamp.from_nanosec(ts_offset),
+                "sample_offset": source_start - source_start_of_segment,
+                "sample_count": end - start
+            })
+        return segments
@@ -0,0 +1,224 @@
+# This file provides selection between the `get_urls` of a media object, which may be on multiple storage backends.
+# The performance of each backend is measured so that the fastest healthy backend is preferred.
+
+from typing import AsyncGenerator, Optional
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+import asyncio
+import dataclasses
+import logging
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEDGE_DELAY = 0.5
+DEFAULT_FAILURE_BACKOFF = 30.0
+
+# Weight given to the latest measurement in the moving averages
+SMOOTHING = 0.2
+
+# Transfers smaller than this are dominated by latency and aren't used to estimate the throughput
+MIN_THROUGHPUT_BYTES = 256 * 1024
+
+
+@dataclasses.dataclass
+class BackendStats:
+    """Measurements of a storage backend, using exponentially weighted moving averages"""
+    requests: int = 0
+    failures: int = 0
+    latency: Optional[float] = None
+    throughput: Optional[float] = None
+    unhealthy_until: float = 0.0
+
+    def record_latency(self, seconds: float) -> None:
+        self.requests += 1
+        self.unhealthy_until = 0.0
+        self.latency = seconds if self.latency is None else (1 - SMOOTHING) * self.latency + SMOOTHING * seconds
+
+    def record_cancelled(self, seconds: float) -> None:
+        """Record a request cancelled after `seconds` without a response, which is a lower bound of the latency"""
+        if self.latency is None or seconds > self.latency:
+            self.latency = seconds if self.latency is None else (1 - SMOOTHING) * self.latency + SMOOTHING * seconds
+
+    def record_throughput(self, bytes_per_second: float) -> None:
+        self.throughput = (
+            bytes_per_second if self.throughput is None
+            else (1 - SMOOTHING) * self.throughput + SMOOTHING * bytes_per_second
+        )
+
+    def expected_time(self, size: int) -> float:
+        """Returns the expected time to download `size` bytes, or 0 if the backend hasn't been measured yet
+
+        Backends that haven't been measured are tried first so that they are measured.
+        """
+        expected = self.latency or 0.0
+        if self.throughput:
+            expected += size / self.throughput
+        return expected
+
+
+def backend_key(get_url: dict) -> str:
+    """Returns an identifier for the storage backend of the URL: the storage ID, label or URL host"""
+    return get_url.get("storage_id") or get_url.get("label") or urlparse(get_url["url"]).netloc
+
+
+class GetUrlSelector:
+    """Chooses between the `get_urls` of media objects, preferring the fastest healthy storage backend
+
+    The URLs are ordered by the expected download time, from the measured latency (to the response headers)
+    and throughput of each backend. A backend that fails is avoided for `failure_backoff` seconds, unless
+    there are no other URLs. If no response has been received from a URL after `hedge_delay` seconds then a
+    request is also made to the next URL and the first response is used. If a request fails then the next
+    URL is tried.
+
+    The server's order of the `get_urls` is kept for backends that haven't been measured or are equal.
+    """
+    def __init__(
+        self,
+        hedge_delay: Optional[float] = DEFAULT_HEDGE_DELAY,
+        failure_backoff: float = DEFAULT_FAILURE_BACKOFF
+    ) -> None:
+        self.hedge_delay = hedge_delay
+        self.failure_backoff = failure_backoff
+        self.backends: dict[str, BackendStats] = {}
+        self.hedged_requests = 0
+        self._mean_size = 0.0
+
+    def _stats(self, get_url: dict) -> BackendStats:
+        return self.backends.setdefault(backend_key(get_url), BackendStats())
+
+    def order(self, get_urls: list[dict], size: Optional[int] = None) -> list[dict]:
+        """Returns the `get_urls` in order of preference for downloading `size` bytes
+
+        The mean size of the media objects downloaded so far is used if `size` is not given.
+        """
+        if size is None:
+            size = int(self._mean_size)
+        now = time.monotonic()
+        return sorted(get_urls, key=lambda get_url: (
+            self._stats(get_url).unhealthy_until > now,
+            self._stats(get_url).expected_time(size)
+        ))
+
+    async def _attempt(
+        self,
+        session: aiohttp.ClientSession,
+        get_url: dict,
+        headers: Optional[dict[str, str]]
+    ) -> aiohttp.ClientResponse:
+        stats = self._stats(get_url)
+        start_time = time.monotonic()
+        try:
+            resp = await session.get(get_url["url"], headers=headers)
+            try:
+                resp.raise_for_status()
+            except BaseException:
+                resp.release()
+                raise
+        except asyncio.CancelledError:
+            raise  # Not a failure of the backend, e.g. another hedged request responded first
+        except Exception as e:
+            stats.failures += 1
+            stats.unhealthy_until = time.monotonic() + self.failure_backoff
+            logger.warning(f"Failed to get media object from storage backend {backend_key(get_url)}: {e!r}")
+            raise
+
+        stats.record_latency(time.monotonic() - start_time)
+        return resp
+
+    async def _request(
+        self,
+        session: aiohttp.ClientSession,
+        get_urls: list[dict],
+        size: Optional[int],
+        headers: Optional[dict[str, str]]
+    ) -> tuple[dict, aiohttp.ClientResponse]:
+        candidates = self.order(get_urls, size)
+        attempts: dict[asyncio.Task[aiohttp.ClientResponse], tuple[dict, float]] = {}
+        failed = 0
+        error: Optional[Exception] = None
+
+        def start_next() -> None:
+            get_url = candidates[len(attempts) + failed]
+            attempts[asyncio.create_task(self._attempt(session, get_url, headers))] = (get_url, time.monotonic())
+
+        start_next()
+        try:
+            while attempts:
+                can_hedge = self.hedge_delay is not None and len(attempts) + failed < len(candidates)
+                done, _ = await asyncio.wait(
+                    attempts,
+                    timeout=self.hedge_delay if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # Hedge the slow request with a request to the next URL
+                    self.hedged_requests += 1
+                    start_next()
+                    continue
+
+                for attempt in done:
+                    get_url, _ = attempts.pop(attempt)
+                    try:
+                        return get_url, attempt.result()
+                    except Exception as e:
+                        error = e
+                        failed += 1
+                        # Fail over to the next URL
+                        if len(attempts) + failed < len(candidates):
+                            start_next()
+
+            assert error is not None
+            raise error
+        finally:
+            for attempt, (get_url, start_time) in attempts.items():
+                if not attempt.done():
+                    attempt.cancel()
+                    self._stats(get_url).record_cancelled(time.monotonic() - start_time)
+                elif not attempt.cancelled() and attempt.exception() is None:
+                    attempt.result().release()
+
+    @asynccontextmanager
+    async def get(
+        self,
+        session: aiohttp.ClientSession,
+        get_urls: list[dict],
+        size: Optional[int] = None,
+        headers: Optional[dict[str, str]] = None
+    ) -> AsyncGenerator[aiohttp.ClientResponse, None]:
+        """Make a GET request to the preferred of the `get_urls`, with the optional `headers`, yielding the response
+
+        The expected `size` of the media object, if known, is used to choose between backends with different
+        latency and throughput. The throughput of the backend is measured from the response body read by the
+        caller. Note that this is limited by how fast the caller reads the response body.
+        """
+        if not get_urls:
+            raise ValueError("No URLs to get the media object from")
+
+        get_url, resp = await self._request(session, get_urls, size, headers)
+        start_time = time.monotonic()
+        try:
+            yield resp
+        finally:
+            resp.release()
+
+        duration = time.monotonic() - start_time
+        self._mean_size = (1 - SMOOTHING) * self._mean_size + SMOOTHING * resp.content.total_bytes
+        if resp.content.total_bytes >= MIN_THROUGHPUT_BYTES and duration > 0:
+            self._stats(get_url).record_throughput(resp.content.total_bytes / duration)
+
+    def log_summary(self) -> None:
+        lines = []
+        for key, stats in sorted(self.backends.items()):
+            latency = f"{stats.latency * 1000:.1f}ms" if stats.latency is not None else "-"
+            throughput = f"{stats.throughput / (1024 * 1024):.1f}MiB/s" if stats.throughput is not None else "-"
+            lines.append(
+                f"{key}: requests={stats.requests}, failures={stats.failures}, "
+                f"latency={latency}, throughput={throughput}"
+            )
+        if lines:
+            logger.info(
+                f"Storage backends ({self.hedged_requests} hedged requests):\n  " + "\n  ".join(lines)
+            )